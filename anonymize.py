@@ -1,10 +1,16 @@
+import io
 import os
+import shutil
+from threading import Lock
 from pathlib import Path
 from math import ceil, log10
 import pydicom
 import toml
 import hash_utils
 import dcm_utils
+import sink
+from pseudonym import PseudonymRegistry
+from config import settings
 
 SOP_UID_PREFIX = '11.'
 STUDY_UID_PREFIX = '12.'
@@ -34,41 +40,96 @@ with open('config/.salt') as f:
 
 hash_utils.set_default_salt(salt)
 
+registry = PseudonymRegistry(settings.PSEUDONYM_REGISTRY,
+                             maxsize=settings.PSEUDONYM_CACHE_SIZE,
+                             fingerprint=hash_utils.hash_id('autoqr'))
+
 
 def gen_sop_uid(dcm, base_uid, sop_prefix):
     suffix = '.'.join(base_uid.split('.')[-2:])
     return sop_prefix[:(64 - len(suffix) - 1)] + '.' + suffix
 
 
+def _generate_uid(prefix, key):
+    '''
+    key: Anonymized PatientID and original UID joined by a backslash
+    '''
+    return pydicom.uid.generate_uid(prefix=pydicom.uid.PYDICOM_ROOT_UID +
+                                    prefix,
+                                    entropy_srcs=key.split('\\'))
+
+
+def pseudonymize_id(kind, original):
+    '''
+    Return hashed PatientID or AccessionNumber registered in the registry.
+    '''
+    return registry.get(kind, original, lambda: hash_utils.hash_id(original))
+
+
 def anonymize_patient_id(dcm: pydicom.Dataset):
-    new_pid = hash_utils.hash_id(dcm.PatientID)
-    return new_pid
+    return pseudonymize_id('PatientID', dcm.PatientID)
+
+
+def anonymize_accession_number(accession_number: str):
+    return pseudonymize_id('AccessionNumber', accession_number)
 
 
 def anonymize_study_uid(dcm: pydicom.Dataset):
     '''
     dcm: Datset with at least PatientID and StudyInstanceUID
     '''
-    new_pid = hash_utils.hash_id(dcm.PatientID)
-    new_study_uid = pydicom.uid.generate_uid(
-        prefix=pydicom.uid.PYDICOM_ROOT_UID + STUDY_UID_PREFIX,
-        entropy_srcs=[new_pid, dcm[STUDY_UID_TAG].value])
-    return new_study_uid
+    return pseudonymize_study_uid(anonymize_patient_id(dcm),
+                                  dcm[STUDY_UID_TAG].value)
+
+
+def pseudonymize_study_uid(new_pid, study_uid):
+    '''
+    Args:
+        new_pid: Anonymized PatientID
+        study_uid: Original StudyInstanceUID
+    '''
+    key = new_pid + '\\' + study_uid
+    return registry.get('StudyInstanceUID', key,
+                        lambda: _generate_uid(STUDY_UID_PREFIX, key))
 
 
 def anonymize_series_uid(dcm):
     '''
     dcm: Datset with at least PatientID and SeriesInstanceUID
     '''
-    new_pid = hash_utils.hash_id(dcm.PatientID)
-    new_series_uid = pydicom.uid.generate_uid(
-        prefix=pydicom.uid.PYDICOM_ROOT_UID + SERIES_UID_PREFIX,
-        entropy_srcs=[new_pid, dcm[SERIES_UID_TAG].value])
-    return new_series_uid
+    key = anonymize_patient_id(dcm) + '\\' + dcm[SERIES_UID_TAG].value
+    return registry.get('SeriesInstanceUID', key,
+                        lambda: _generate_uid(SERIES_UID_PREFIX, key))
 
 
-def anonymize_dcm(dcms, zip_filename):
-    dcm = dcms[0]
+def precompute_pseudonyms(patient_ids, accession_numbers, study_uids):
+    '''
+    Register pseudonyms of the rows of an input list at once.
+
+    Returns:
+        int: Num of computed pseudonyms.
+    '''
+    patient_ids = list(patient_ids)
+    count = registry.precompute('PatientID', patient_ids, hash_utils.hash_id)
+    count += registry.precompute('AccessionNumber', accession_numbers,
+                                 hash_utils.hash_id)
+    new_pids = [pseudonymize_id('PatientID', pid) for pid in patient_ids]
+    count += registry.precompute(
+        'StudyInstanceUID', [
+            new_pid + '\\' + study_uid
+            for new_pid, study_uid in zip(new_pids, study_uids)
+        ], lambda key: _generate_uid(STUDY_UID_PREFIX, key))
+    return count
+
+
+def series_replace_rules(dcm, sop_entropy):
+    '''
+    Return replace rules for instances of the series of dcm.
+
+    Args:
+        dcm: Instance of the series.
+        sop_entropy (str): Entropy source for the prefix of anonymized SOPInstanceUIDs.
+    '''
     new_pid = anonymize_patient_id(dcm)
 
     replace_rules = []
@@ -78,7 +139,7 @@ def anonymize_dcm(dcms, zip_filename):
 
     sop_prefix = pydicom.uid.generate_uid(
         prefix=pydicom.uid.PYDICOM_ROOT_UID + SOP_UID_PREFIX,
-        entropy_srcs=[new_pid, dcm.file_meta[MSSOPUID_TAG].value])
+        entropy_srcs=[new_pid, sop_entropy])
 
     def anonymize_ms_sop_uid(dcm):
         uid = dcm.file_meta[MSSOPUID_TAG].value
@@ -103,63 +164,320 @@ def anonymize_dcm(dcms, zip_filename):
     new_series_uid = anonymize_series_uid(dcm)
     replace_rules.append((SERIES_UID_TAG, new_series_uid))
 
-    new_accession_n = hash_utils.hash_id(dcm[ACCESSION_N_TAG].value)
+    new_accession_n = anonymize_accession_number(dcm[ACCESSION_N_TAG].value)
     replace_rules.append((ACCESSION_N_TAG, new_accession_n))
 
+    return replace_rules
+
+
+def open_sink(filename):
+    '''
+    Sink of OUTPUT_FORMAT for an output filename
+    '''
+    return sink.SINKS[settings.OUTPUT_FORMAT](filename, settings.ZIP_WORKERS)
+
+
+def output_filename(outdir, new_series_uid, replace=False):
+    '''
+    Available output filename of a series with the extension of OUTPUT_FORMAT
+
+    Args:
+        replace (bool): Remove an existing output of the series (e.g. one left by a crash) instead of adding a suffix to the filename.
+    '''
+    left = str(Path(outdir) / new_series_uid)
+    right = sink.SINKS[settings.OUTPUT_FORMAT].extension
+    if replace:
+        sink.remove_output(left + right)
+        return left + right
+    return get_available_filename(left, right)
+
+
+# width of member numbers of a series whose num of instances is not known in advance
+UNKNOWN_COUNT_WIDTH = 5
+
+
+def member_name_format(n_instances):
+    '''
+    Format of member names of a series of n_instances, or of unknown size if None.
+    '''
+    width = UNKNOWN_COUNT_WIDTH if n_instances is None else ceil(
+        log10(n_instances))
+    return 'IMG{{:0{}d}}.dcm'.format(width)
+
+
+def anonymize_dcm(dcms, filename):
+    dcm = dcms[0]
+    new_pid = anonymize_patient_id(dcm)
+    replace_rules = series_replace_rules(dcm,
+                                         dcm.file_meta[MSSOPUID_TAG].value)
+
     dcm_generator = dcm_utils.DcmGenerator(dcms, replace_rules, remove_rules)
-    name_format = 'IMG{{:0{}d}}.dcm'.format(ceil(log10(len(dcms))))
-    dcm_utils.dcms2zip([name_format.format(i) for i in range(len(dcms))],
-                       dcm_generator, 1, zip_filename)
+    name_format = member_name_format(len(dcms))
+    open_sink(filename).save(
+        zip([name_format.format(i) for i in range(len(dcms))],
+            (dcm_utils.dcm2bytes(dcm) for dcm in dcm_generator)))
 
     return new_pid
 
 
-def anonymize_dcm_dir(indir, zip_filename):
+def anonymize_dcm_dir(indir, filename):
     fns = [os.path.join(indir, fn) for fn in sorted(os.listdir(indir))]
-    dcm = pydicom.dcmread(fns[0])
-    new_pid = hash_utils.hash_id(dcm.PatientID)
+    return anonymize_dcm_files(fns, filename)
 
-    replace_rules = []
 
-    # file meta
-    replace_rules.append((IMPL_VERISON_NAME_TAG, IMPL_VERISON_NAME))
+def anonymize_dcm_files(fns, filename):
+    '''
+    Anonymize DICOM files of a series into the output of OUTPUT_FORMAT.
+    '''
+    dcm = pydicom.dcmread(fns[0], stop_before_pixels=True)
+    new_pid = anonymize_patient_id(dcm)
+    replace_rules = series_replace_rules(dcm,
+                                         dcm.file_meta[MSSOPUID_TAG].value)
 
-    sop_prefix = pydicom.uid.generate_uid(
-        prefix=pydicom.uid.PYDICOM_ROOT_UID + SOP_UID_PREFIX,
-        entropy_srcs=[new_pid, dcm.file_meta[MSSOPUID_TAG].value])
+    # rewrite elements in the rules only. pydicom is used for unsupported files
+    contents = dcm_utils.DcmBytesGeneratorFN(fns, replace_rules, remove_rules)
+    name_format = member_name_format(len(fns))
+    open_sink(filename).save(
+        zip([name_format.format(i) for i in range(len(fns))], contents))
 
-    def anonymize_ms_sop_uid(dcm):
-        uid = dcm.file_meta[MSSOPUID_TAG].value
-        return gen_sop_uid(dcm, uid, sop_prefix)
+    return new_pid
 
-    def anonymize_sop_uid(dcm):
-        uid = dcm[SOPInstanceUID_TAG].value
-        return gen_sop_uid(dcm, uid, sop_prefix)
 
-    replace_rules.append((MSSOPUID_TAG, anonymize_ms_sop_uid))
-    replace_rules.append((SOPInstanceUID_TAG, anonymize_sop_uid))
+def anonymize_dcm_bytes(contents, filename):
+    '''
+    Anonymize encoded DICOM files of a series into the output of OUTPUT_FORMAT.
+    '''
+    dcm = pydicom.dcmread(io.BytesIO(contents[0]), stop_before_pixels=True)
+    new_pid = anonymize_patient_id(dcm)
+    plan = dcm_utils.AnonymizationPlan(
+        series_replace_rules(dcm, dcm.file_meta[MSSOPUID_TAG].value),
+        remove_rules)
 
-    # data
-    replace_rules.append((PID_TAG, new_pid))
-    replace_rules.append((PATIENT_NAME_TAG, new_pid))
-    replace_rules.append(
-        (ImplClassUID_TAG, pydicom.uid.PYDICOM_IMPLEMENTATION_UID))
+    name_format = member_name_format(len(contents))
+    open_sink(filename).save(
+        zip([name_format.format(i) for i in range(len(contents))],
+            (dcm_utils.anonymized_bytes(data, plan) for data in contents)))
 
-    new_study_uid = anonymize_study_uid(dcm)
-    replace_rules.append((STUDY_UID_TAG, new_study_uid))
+    return new_pid
 
-    new_series_uid = anonymize_series_uid(dcm)
-    replace_rules.append((SERIES_UID_TAG, new_series_uid))
 
-    new_accession_n = hash_utils.hash_id(dcm[ACCESSION_N_TAG].value)
-    replace_rules.append((ACCESSION_N_TAG, new_accession_n))
+class MemoryStage():
+    '''
+    Keep received instances of a study in memory to anonymize them without the temp directory.
 
-    dcm_generator = dcm_utils.DcmGeneratorFN(fns, replace_rules, remove_rules)
-    name_format = 'IMG{{:0{}d}}.dcm'.format(ceil(log10(len(fns))))
-    dcm_utils.dcms2zip([name_format.format(i) for i in range(len(fns))],
-                       dcm_generator, 1, zip_filename)
+    Args:
+        budget (utils.Backlog): Memory budget that the reservation is taken from. The reservation grows while the budget allows.
+        reserved (int): Bytes reserved in budget for the study
+        spill (callable): Returns a directory that all the instances are moved into once the study outgrows the reservation. Instances are kept in memory anyway if None.
+    '''
+    def __init__(self, budget=None, reserved=0, spill=None):
+        self.instances = {}  # SOPInstanceUID -> (SeriesInstanceUID, encoded dataset)
+        self.n_bytes = 0
+        self.budget = budget
+        self.reserved = reserved
+        self.spill = spill
+        self.spill_dir = None
+        self.spilled = set()
+        self._lock = Lock()
+
+    @property
+    def received(self):
+        with self._lock:
+            return set(self.instances.keys()) | self.spilled
+
+    def _fits(self, n_bytes):
+        extra = self.n_bytes + n_bytes - self.reserved
+        if extra <= 0:
+            return True
+        if self.budget is not None and self.budget.try_add_bytes(extra):
+            self.reserved += extra
+            return True
+        return False
+
+    def _move_to(self, outdir):
+        self.spill_dir = Path(outdir)
+        for sop_uid, (_, data) in self.instances.items():
+            with open(self.spill_dir / sop_uid, 'wb') as f:
+                f.write(data)
+            self.spilled.add(sop_uid)
+        self.instances = {}
+        self.n_bytes = 0
+
+    def handle_store(self, event):
+        '''
+        C-STORE handler for storage_scp.StorageRouter
+        '''
+        data = event.encoded_dataset()
+        series_uid = event.dataset.SeriesInstanceUID
+        sop_uid = event.request.AffectedSOPInstanceUID
+        with self._lock:
+            if (self.spill_dir is None and self.spill is not None
+                    and sop_uid not in self.instances
+                    and not self._fits(len(data))):
+                self._move_to(self.spill())
+            if self.spill_dir is not None:
+                with open(self.spill_dir / sop_uid, 'wb') as f:
+                    f.write(data)
+                self.spilled.add(sop_uid)
+                return 0x0000
+            if sop_uid not in self.instances:
+                self.n_bytes += len(data)
+            self.instances[sop_uid] = (series_uid, data)
+        return 0x0000
+
+    def series(self):
+        '''
+        Returns:
+            dict: SeriesInstanceUID -> encoded datasets in the order of the files in the temp directory
+        '''
+        series = {}
+        with self._lock:
+            for sop_uid in sorted(self.instances.keys()):
+                series_uid, data = self.instances[sop_uid]
+                series.setdefault(series_uid, []).append(data)
+        return series
+
+
+def anonymize_study_memory(series, filenames):
+    '''
+    Anonymize each series of a study staged in memory.
+    Runs in a worker process of the anonymization pool, so the arguments and the returned value need to be picklable.
+
+    Args:
+        series (dict): SeriesInstanceUID -> encoded datasets (e.g. MemoryStage.series())
+        filenames (dict): SeriesInstanceUID -> output filename
+    Returns:
+        list: Written output filenames
+    '''
+    written = []
+    for series_uid, filename in filenames.items():
+        if series_uid not in series:
+            continue
+        anonymize_dcm_bytes(series[series_uid], str(filename))
+        written.append(str(filename))
+    return written
+
+
+class _StreamSeries():
+    def __init__(self, filename, plan, n_instances):
+        self.sink = open_sink(filename)
+        self.plan = plan
+        self.name_format = member_name_format(n_instances)
+        self.count = 0
+        self.lock = Lock()
+
+    def write(self, content):
+        with self.lock:
+            self.sink.write(self.name_format.format(self.count), content)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.sink.close()
+
+    def abort(self):
+        with self.lock:
+            self.sink.abort()
+
+
+class StreamWriter():
+    '''
+    Anonymize instances of a study as they are received and append them to the output of each series.
+    Anonymized SOPInstanceUIDs are derived from the SeriesInstanceUID because the first instance to arrive is not fixed.
 
-    return new_pid
+    Args:
+        filenames (dict): SeriesInstanceUID -> output filename
+        n_instances (dict): SeriesInstanceUID -> expected num of instances. Member names are the same as those of the temp directory path if the expected num is right. Series not in it are named with UNKNOWN_COUNT_WIDTH digits.
+    '''
+    def __init__(self, filenames, n_instances=None):
+        self.filenames = filenames
+        self.n_instances = n_instances or {}
+        self.received = set()  # original SOPInstanceUIDs
+        self._series = {}  # SeriesInstanceUID -> _StreamSeries
+        self._lock = Lock()
+
+    def _get_series(self, dcm):
+        series_uid = dcm.SeriesInstanceUID
+        with self._lock:
+            if series_uid not in self._series:
+                self._series[series_uid] = _StreamSeries(
+                    self.filenames[series_uid],
+                    dcm_utils.AnonymizationPlan(
+                        series_replace_rules(dcm, series_uid), remove_rules),
+                    self.n_instances.get(series_uid, None))
+            return self._series[series_uid]
+
+    def write(self, dcm, data=None):
+        '''
+        Anonymize dcm and append it to the output of its series.
+
+        Args:
+            data (bytes): Encoded dcm with file meta. Rewritten by dcm_utils.rewrite_bytes if given.
+        '''
+        sop_uid = dcm.SOPInstanceUID
+        with self._lock:
+            # resent by a retry, possibly while the first one is being written
+            if sop_uid in self.received:
+                return
+            self.received.add(sop_uid)
+        try:
+            series = self._get_series(dcm)
+            if data is None:
+                data = dcm_utils.dcm2bytes(series.plan.apply(dcm))
+            else:
+                data = dcm_utils.anonymized_bytes(data, series.plan)
+            series.write(data)
+        except Exception:
+            with self._lock:
+                self.received.discard(sop_uid)
+            raise
+
+    def handle_store(self, event):
+        '''
+        C-STORE handler for storage_scp.StorageRouter
+        '''
+        self.write(event.dataset, event.encoded_dataset())
+        return 0x0000
+
+    def close(self):
+        '''
+        Returns:
+            list: Written output filenames
+        '''
+        with self._lock:
+            for series in self._series.values():
+                series.close()
+            return [self.filenames[uid] for uid in self._series.keys()]
+
+    def abort(self):
+        '''
+        Close and remove outputs
+        '''
+        with self._lock:
+            for series in self._series.values():
+                series.abort()
+
+
+def anonymize_study_dir(indir, filenames):
+    '''
+    Group DICOM files in indir by series and anonymize each series into the output of OUTPUT_FORMAT.
+    The files are indexed by their headers and not moved. indir is removed at the end.
+    Runs in a worker process of the anonymization pool, so the arguments and the returned value need to be picklable.
+
+    Args:
+        filenames (dict): SeriesInstanceUID -> output filename
+    Returns:
+        list: Written output filenames
+    '''
+    index = dcm_utils.index_series(indir)
+    written = []
+    for series_uid, filename in filenames.items():
+        if series_uid not in index:
+            continue
+        anonymize_dcm_files(index[series_uid], str(filename))
+        written.append(str(filename))
+    shutil.rmtree(indir)
+    return written
 
 
 def get_available_filename(left, right):
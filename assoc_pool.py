@@ -0,0 +1,208 @@
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from pynetdicom import AE
+from pynetdicom.presentation import PresentationContext
+from pynetdicom.sop_class import Verification
+from logzero import logger as default_logger
+
+
+class AssociationError(RuntimeError):
+    pass
+
+
+class AssociationPool():
+    def __init__(self,
+                 contexts,
+                 max_per_server=4,
+                 idle_timeout=60,
+                 echo_after=30,
+                 ext_neg=None,
+                 evt_handlers=None,
+                 logger=None):
+        '''
+        Pool of reusable associations keyed by ConnectionInformation.
+
+        Args:
+            contexts (list): Abstract syntaxes to request with the default transfer syntaxes, or presentation contexts (e.g. by pynetdicom.build_context) to request with their transfer syntaxes.
+            max_per_server (int): Maximum number of associations per server. 0 for no limit.
+            idle_timeout (float): Idle associations are released after this many seconds, by the next checkout or checkin or by a reaper thread if the pool is not used.
+            echo_after (float): Associations idle for more than this many seconds are checked with C-ECHO before reuse.
+            ext_neg (list): Extended negotiation items for each association.
+            evt_handlers (list): Event handlers bound to each association.
+        '''
+        self.contexts = list(contexts)
+        self.max_per_server = max_per_server
+        self.idle_timeout = idle_timeout
+        self.echo_after = echo_after
+        self.ext_neg = ext_neg
+        self.evt_handlers = evt_handlers
+        self.logger = logger or default_logger
+        self._aes = {}
+        self._idle = defaultdict(list)  # key -> [(assoc, last_used)]
+        self._count = defaultdict(int)  # key -> num of open associations
+        self._cond = threading.Condition()
+        self._reaper = None
+
+    @staticmethod
+    def _key(conn_info):
+        return (conn_info.server, conn_info.port, conn_info.aec, conn_info.aet)
+
+    def _ae(self, aet):
+        if aet not in self._aes:
+            ae = AE(ae_title=aet)
+            for context in self.contexts:
+                if isinstance(context, PresentationContext):
+                    ae.add_requested_context(context.abstract_syntax,
+                                             context.transfer_syntax)
+                else:
+                    ae.add_requested_context(context)
+            if Verification not in self.contexts:
+                ae.add_requested_context(Verification)
+            self._aes[aet] = ae
+        return self._aes[aet]
+
+    def _associate(self, conn_info):
+        with self._cond:
+            ae = self._ae(conn_info.aet)
+        assoc = ae.associate(conn_info.server,
+                             conn_info.port,
+                             ae_title=conn_info.aec,
+                             ext_neg=self.ext_neg,
+                             evt_handlers=self.evt_handlers)
+        if not assoc.is_established:
+            raise AssociationError(
+                'Association rejected, aborted or never connected')
+        self.logger.debug('New association to %s:%s (%s)', conn_info.server,
+                          conn_info.port, conn_info.aec)
+        return assoc
+
+    def _is_alive(self, assoc, last_used):
+        if not assoc.is_established:
+            return False
+        if time.monotonic() - last_used < self.echo_after:
+            return True
+        try:
+            status = assoc.send_c_echo()
+        except Exception:
+            return False
+        return bool(status) and status.Status == 0x0000
+
+    def _pop_expired(self):
+        '''
+        Remove expired idle associations. Call with the lock held.
+        '''
+        now = time.monotonic()
+        expired = []
+        for key, entries in self._idle.items():
+            alive = []
+            for assoc, last_used in entries:
+                if now - last_used > self.idle_timeout:
+                    expired.append(assoc)
+                    self._count[key] -= 1
+                else:
+                    alive.append((assoc, last_used))
+            entries[:] = alive
+        if expired:
+            self._cond.notify_all()
+        return expired
+
+    @staticmethod
+    def _release(assocs):
+        for assoc in assocs:
+            if assoc.is_established:
+                assoc.release()
+
+    def _checkout(self, key):
+        '''
+        Return an idle (assoc, last_used) or (None, None) if a new association may be opened.
+        '''
+        with self._cond:
+            while True:
+                expired = self._pop_expired()
+                if self._idle[key]:
+                    entry = self._idle[key].pop()
+                    break
+                if not self.max_per_server or self._count[
+                        key] < self.max_per_server:
+                    self._count[key] += 1
+                    entry = (None, None)
+                    break
+                self._cond.wait()
+        self._release(expired)
+        return entry
+
+    def _checkin(self, key, assoc):
+        if not assoc.is_established:
+            self._discard(key, None)
+            return
+        with self._cond:
+            expired = self._pop_expired()
+            self._idle[key].append((assoc, time.monotonic()))
+            self._cond.notify()
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap,
+                                                daemon=True)
+                self._reaper.start()
+        self._release(expired)
+
+    def _reap(self):
+        '''
+        Release expired idle associations while the pool is not used.
+        '''
+        while True:
+            time.sleep(max(self.idle_timeout / 2, 0.1))
+            with self._cond:
+                expired = self._pop_expired()
+            self._release(expired)
+
+    def _discard(self, key, assoc):
+        if assoc is not None and assoc.is_established:
+            assoc.abort()
+        with self._cond:
+            self._count[key] -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def acquire(self, conn_info):
+        '''
+        Borrow an association for conn_info.
+        The association is aborted instead of being returned to the pool if an exception is raised.
+        '''
+        key = self._key(conn_info)
+        while True:
+            assoc, last_used = self._checkout(key)
+            if assoc is None:
+                try:
+                    assoc = self._associate(conn_info)
+                except BaseException:
+                    self._discard(key, None)
+                    raise
+                break
+            if self._is_alive(assoc, last_used):
+                break
+            self.logger.debug('Drop dead association to %s:%s',
+                              conn_info.server, conn_info.port)
+            self._discard(key, assoc)
+
+        try:
+            yield assoc
+        except BaseException:
+            self._discard(key, assoc)
+            raise
+        self._checkin(key, assoc)
+
+    def close_all(self):
+        '''
+        Release all idle associations.
+        '''
+        with self._cond:
+            assocs = []
+            for key, entries in self._idle.items():
+                assocs.extend(assoc for assoc, _ in entries)
+                self._count[key] -= len(entries)
+                entries.clear()
+            self._cond.notify_all()
+        self._release(assocs)
@@ -1,6 +1,8 @@
 import datetime
+import os
+from functools import partial
 import logging
-from queue import Queue
+from queue import Queue, Empty
 import time
 import threading
 from threading import Thread, Event
@@ -10,11 +12,18 @@ from logzero import logger as default_logger
 import pandas as pd
 
 from scheduled_event import ScheduledEvent
+from governor import DiskGovernor
+import journal
+from dispatcher import Dispatcher
+from assoc_pool import AssociationError
 import qr
+import anonymize
+import sink
 import utils
 from config import settings
 
 MSG_DURATION = 2000
+JOURNAL_FILENAME = 'autoqr_journal.sqlite'
 default_logger.setLevel(logging.DEBUG)
 
 
@@ -24,12 +33,21 @@ class AutoQR():
         self.sched_event = ScheduledEvent(settings.PERIODS, logger=self.logger)
         self.done_count = 0  # num of successes
         self.error_count = 0  # num of errors
+        self.anonymized_count = 0  # num of anonymized studies
         self.rate = 0
         self.locker = utils.Locker()
         self.t_deltas = []
         self.job_done_handlers = [self._on_job_done]
         self.error_handlers = [self._on_error]
         self.outdir = Path(outdir)
+        self.governor = DiskGovernor([qr.partial_root(), self.outdir],
+                                     settings.DISK_RESERVE_MB * 2**20,
+                                     logger=self.logger)
+        self.sched_event.add_condition(self.governor.is_ok)
+        self.journal = None
+        if settings.JOURNAL:
+            self.outdir.mkdir(parents=True, exist_ok=True)
+            self.journal = journal.Journal(self.outdir / JOURNAL_FILENAME)
         header = [
             'StudyDate', 'OriginalPatientID', 'AnonymizedPatientID',
             'OriginalAccessionNumber', 'AnonymizedAccessionNumber',
@@ -48,20 +66,40 @@ class AutoQR():
         self.logger.info('Error log filename:%s', str(self.error_filename))
         self.threads = []
         self.task_queue = Queue()
+        # jobs whose series are queried, waiting for a worker
+        self.ready_queue = Queue(maxsize=max(settings.PREFETCH, 1))
+        self.resolve_queue = Queue()
+        self.resolved = {}  # StudyInstanceUID -> series identifiers
+        self.taken = set()  # studies started before the pre-resolution
+        self.resolve_cond = threading.Condition()
+        self.dispatcher = Dispatcher(zip(settings.DICOM_SERVERS, settings.AECS,
+                                         settings.PORTS),
+                                     cooldown=settings.DISPATCH_COOLDOWN,
+                                     logger=self.logger)
+        if settings.PRE_RESOLVE_BATCH_SIZE > 0:
+            t = Thread(target=self._resolver, args=(self.sched_event.event, ))
+            t.setDaemon(True)
+            t.start()
+        if settings.PREFETCH > 0:
+            t = Thread(target=self._prefetcher,
+                       args=(self.task_queue, self.sched_event.event))
+            t.setDaemon(True)
+            t.start()
+            job_queue = self.ready_queue
+        else:
+            job_queue = self.task_queue
         self.tid2conn_info = {}
         for i in range(settings.N_THREADS):
             t = Thread(target=self._worker,
-                       args=(self._job, self.task_queue,
-                             self.sched_event.event))
+                       args=(self._job, job_queue, self.sched_event.event))
             t.setDaemon(True)
             self.threads.append(t)
             t.start()
-            server = settings.DICOM_SERVERS[i % len(settings.AECS)]
-            receive_port = settings.RECEIVE_PORTS[i]
-            aet = settings.AETS[i]
-            port = settings.PORTS[i % len(settings.PORTS)]
-            aec = settings.AECS[i % len(settings.AECS)]
-            info = qr.ConnectionInformation(server, aec, port, aet,
+            # server, aec and port are chosen by the dispatcher for each job
+            receive_port = settings.RECEIVE_PORTS[i %
+                                                  len(settings.RECEIVE_PORTS)]
+            aet = settings.AETS[i % len(settings.AETS)]
+            info = qr.ConnectionInformation(None, None, None, aet,
                                             receive_port)
             self.tid2conn_info[t.ident] = info
 
@@ -72,21 +110,138 @@ class AutoQR():
             f(*args)
             q.task_done()
 
-    def _job(self, args: Tuple[str, str, str]):
+    def _prefetcher(self, q: Queue, e: Event):
+        '''
+        Query series of the next jobs while the workers are retrieving.
+        At most settings.PREFETCH queried jobs wait for a worker.
+        '''
+        while True:
+            e.wait()
+            args = q.get()
+            PatientID, _, StudyInstanceUID = args[0]
+            series = self._take_resolved(StudyInstanceUID)
+            if series is None:
+                series = self._query_series(PatientID, StudyInstanceUID)
+            self.ready_queue.put(args + [series])
+            q.task_done()
+
+    def _query_series(self, PatientID, StudyInstanceUID):
+        '''
+        Return series of the study, the exception raised by the query,
+        or None to let the worker query with fail over.
+        '''
+        index = self.dispatcher.acquire()
+        server, aec, port = self.dispatcher.server(index)
+        conn_info = qr.ConnectionInformation(server, aec, port,
+                                             settings.AETS[0],
+                                             settings.RECEIVE_PORTS[0])
+        try:
+            series = qr.query_series(PatientID,
+                                     StudyInstanceUID,
+                                     conn_info,
+                                     predicate=qr.is_original_image,
+                                     logger=self.logger)
+        except AssociationError:
+            self.dispatcher.release(index, error=True, refused=True)
+            return None
+        except Exception as ex:
+            self.dispatcher.release(index, error=True)
+            return ex
+        self.dispatcher.release(index)
+        return series
+
+    def _resolver(self, e: Event):
+        '''
+        Resolve series of queued studies in batches ahead of the workers.
+        '''
+        batch_size = settings.PRE_RESOLVE_BATCH_SIZE
+        while True:
+            batch = [self.resolve_queue.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(self.resolve_queue.get_nowait())
+                except Empty:
+                    break
+            with self.resolve_cond:
+                batch = [(pid, suid) for pid, suid in batch
+                         if not self._discard_taken(suid)]
+                # stay at most two batches ahead of the workers
+                while len(self.resolved) >= 2 * batch_size:
+                    self.resolve_cond.wait()
+            if len(batch) == 0:
+                continue
+            e.wait()
+            index = self.dispatcher.acquire()
+            server, aec, port = self.dispatcher.server(index)
+            conn_info = qr.ConnectionInformation(server, aec, port,
+                                                 settings.AETS[0],
+                                                 settings.RECEIVE_PORTS[0])
+            try:
+                study2series = qr.resolve_series(
+                    batch,
+                    conn_info,
+                    predicate=qr.is_original_image,
+                    logger=self.logger)
+            except Exception as ex:
+                self.dispatcher.release(index,
+                                        error=True,
+                                        refused=isinstance(
+                                            ex, AssociationError))
+                self.logger.warning('Pre-resolution failed: %s', ex)
+                continue
+            self.dispatcher.release(index)
+            with self.resolve_cond:
+                for _, suid in batch:
+                    if suid in study2series and not self._discard_taken(suid):
+                        self.resolved[suid] = study2series[suid]
+            self.logger.debug('Pre-resolved %d of %d studies',
+                              len(study2series), len(batch))
+
+    def _discard_taken(self, study_uid):
+        '''
+        Return True if a worker already started the study. Call with resolve_cond held.
+        '''
+        if study_uid in self.taken:
+            self.taken.discard(study_uid)
+            return True
+        return False
+
+    def _take_resolved(self, study_uid):
+        '''
+        Return pre-resolved series of the study or None if not available.
+        '''
+        with self.resolve_cond:
+            series = self.resolved.pop(study_uid, None)
+            if series is None and settings.PRE_RESOLVE_BATCH_SIZE > 0:
+                self.taken.add(study_uid)
+            self.resolve_cond.notify()
+        return series
+
+    def _job(self, args: Tuple[str, str, str], series=None):
+        '''
+        Args:
+            series: Series identifiers or exception from the prefetcher.
+        '''
         start = datetime.datetime.now()
         PatientID, AccessionNumber, StudyInstanceUID = args
         self.logger.info('start retrieve and anonymize %s %s', PatientID,
                          StudyInstanceUID)
+        reserved = 0
         try:
-            ret = qr.qr_anonymize_save(
-                PatientID,
-                AccessionNumber,
-                StudyInstanceUID,
-                str(self.outdir),
-                self.tid2conn_info[threading.get_ident()],
-                predicate=qr.is_original_image,
-                logger=self.logger)
+            if isinstance(series, Exception):
+                raise series
+            if series is None:
+                series = self._take_resolved(StudyInstanceUID)
+            if series is not None:
+                self._journal(StudyInstanceUID, journal.QUERIED)
+            # released when the anonymization is over
+            reserved = self.governor.estimate(None if series is None else sum(
+                qr.n_instances(ds) for ds in series))
+            self.governor.acquire(reserved)
+            ret = self._dispatch(args, series, reserved)
         except Exception as e:
+            self.governor.release(reserved)
+            self._journal(StudyInstanceUID, journal.FAILED, e)
             self.logger.error('(%s,%s):%s', PatientID, StudyInstanceUID, e)
             self._handle_error(args, e)
             for handler in self.error_handlers:
@@ -99,6 +254,61 @@ class AutoQR():
             handler()
         time.sleep(settings.INTERVAL)
 
+    def _dispatch(self, args: Tuple[str, str, str], series, reserved=0):
+        '''
+        Run qr_anonymize_save on the server chosen by the dispatcher.
+        The job fails over to another server if the association is refused.
+        '''
+        PatientID, AccessionNumber, StudyInstanceUID = args
+        conn_info = self.tid2conn_info[threading.get_ident()]
+        refused = []
+        while True:
+            index = self.dispatcher.acquire(exclude=refused)
+            server, aec, port = self.dispatcher.server(index)
+            stats = {}
+            start = time.monotonic()
+            try:
+                ret = qr.qr_anonymize_save(PatientID,
+                                           AccessionNumber,
+                                           StudyInstanceUID,
+                                           str(self.outdir),
+                                           conn_info._replace(server=server,
+                                                              aec=aec,
+                                                              port=port),
+                                           predicate=qr.is_original_image,
+                                           logger=self.logger,
+                                           series=series,
+                                           stats=stats,
+                                           on_anonymized=partial(
+                                               self._on_anonymized, args,
+                                               reserved),
+                                           expected_bytes=reserved
+                                           if series is not None else None,
+                                           on_retrieved=partial(
+                                               self._journal,
+                                               StudyInstanceUID,
+                                               journal.RETRIEVED),
+                                           replace_outputs=self.journal
+                                           is not None)
+            except AssociationError:
+                self.dispatcher.release(index, refused=True)
+                refused.append(index)
+                if len(refused) < len(settings.AECS):
+                    self.logger.warning('Fail over %s from %s:%s',
+                                        StudyInstanceUID, server, port)
+                    continue
+                raise
+            except Exception:
+                self.dispatcher.release(index, error=True)
+                raise
+            self.dispatcher.release(index,
+                                    seconds=time.monotonic() - start,
+                                    n_instances=stats.get('n_instances'),
+                                    latency=stats.get('latency'))
+            if 'n_bytes' in stats:
+                self.governor.observe(stats['n_bytes'], stats['n_instances'])
+            return ret
+
     def _handle_result(self, args: Tuple[str, str, str],
                        ret: Tuple[str, str, str, str], t_delta):
         original_pid, original_an, original_suid = args
@@ -130,6 +340,25 @@ class AutoQR():
             with open(self.error_filename, 'a') as f:
                 f.write('{},{},{}\n'.format(PatientID, StudyInstanceUID, e))
 
+    def _on_anonymized(self, args: Tuple[str, str, str], reserved, future):
+        self.governor.release(reserved)
+        PatientID, _, StudyInstanceUID = args
+        if future.exception() is not None:
+            self._journal(StudyInstanceUID, journal.FAILED,
+                          'Anonymization failed: {}'.format(future.exception()))
+            with self.locker.lock():
+                with open(self.error_filename, 'a') as f:
+                    f.write('{},{},Anonymization failed: {}\n'.format(
+                        PatientID, StudyInstanceUID, future.exception()))
+            return
+        self._journal(StudyInstanceUID, journal.ANONYMIZED)
+        with self.locker.lock():
+            self.anonymized_count += 1
+
+    def _journal(self, study_uid, state, reason=''):
+        if self.journal is not None:
+            self.journal.update(study_uid, state, reason)
+
     def _on_job_done(self):
         if self.done_count + self.error_count == len(self.df):
             self.sched_event.stop()
@@ -140,6 +369,8 @@ class AutoQR():
 
     def finalize(self):
         qr.shutdown()
+        if self.journal is not None:
+            self.journal.close()
 
     def add_job_done_handler(self, handler):
         self.job_done_handlers.append(handler)
@@ -148,15 +379,62 @@ class AutoQR():
         self.error_handlers.append(handler)
 
     def set_df(self, df):
+        '''
+        Queue jobs of df. Duplicated studies are dropped.
+        Studies anonymized according to the journal are skipped,
+        and so are failed ones unless RETRY_FAILED.
+
+        Returns:
+            pd.DataFrame: Queued rows
+        '''
+        n_rows = len(df)
+        df = df.drop_duplicates(subset=settings.COL_STUDY_INSTANCE_UID)
+        if len(df) < n_rows:
+            # jobs of the same study would share the partial directory
+            self.logger.warning('%d duplicated studies are dropped',
+                                n_rows - len(df))
+        if self.journal is not None:
+            df = self._skip_journaled(df)
         self.df = df
         self.logger.info('Initialize task queue. (%d)', len(df))
         self.done_count = 0
+        self.anonymized_count = 0
         self.t_deltas = []
         self.task_queue.queue.clear()
+        with self.ready_queue.not_full:
+            self.ready_queue.queue.clear()
+            self.ready_queue.not_full.notify_all()
+        self.resolve_queue.queue.clear()
+        with self.resolve_cond:
+            self.resolved.clear()
+            self.taken.clear()
+            self.resolve_cond.notify()
         for pid, oid, suid in zip(self.df[settings.COL_PATIENT_ID],
                                   self.df[settings.COL_ACCESSION_NUMBER],
                                   self.df[settings.COL_STUDY_INSTANCE_UID]):
             self.task_queue.put([(pid, oid, suid)])
+            if settings.PRE_RESOLVE_BATCH_SIZE > 0:
+                self.resolve_queue.put((pid, suid))
+        return df
+
+    def _skip_journaled(self, df):
+        states = self.journal.states(df[settings.COL_STUDY_INSTANCE_UID])
+        skipped_states = [journal.ANONYMIZED]
+        if not settings.RETRY_FAILED:
+            skipped_states.append(journal.FAILED)
+        keep = [
+            states.get(suid, ('', ))[0] not in skipped_states
+            for suid in df[settings.COL_STUDY_INSTANCE_UID]
+        ]
+        n_failed = sum(state == journal.FAILED for state, _ in states.values())
+        self.logger.info('Journal: %d of %d studies are skipped (%d failed%s)',
+                         len(keep) - sum(keep), len(df), n_failed,
+                         ', retried' if settings.RETRY_FAILED else '')
+        df = df[keep]
+        self.journal.queue(
+            zip(df[settings.COL_PATIENT_ID], df[settings.COL_ACCESSION_NUMBER],
+                df[settings.COL_STUDY_INSTANCE_UID]))
+        return df
 
 
 def open_csv(filename):
@@ -171,10 +449,30 @@ def open_csv(filename):
     return df
 
 
-def study_exists(basedir, year, date, pid, study_uid):
-    outdir = qr.get_output_directory(basedir, year, date, pid, study_uid)
-    files = list(outdir.glob('*.zip'))
-    return len(files) > 0
+def _subdirectories(dirname):
+    try:
+        with os.scandir(dirname) as it:
+            return [entry for entry in it if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+def existing_studies(basedir: Path, dates):
+    '''
+    Walk basedir/YYYY/MMDD/<pid>/<study> of the dates once.
+
+    Args:
+        dates (iterable): 'YYYY/MMDD' strings
+    Returns:
+        set: 'YYYY/MMDD/<pid>/<study>' of studies with output
+    '''
+    studies = set()
+    for date in set(dates):
+        for pid in _subdirectories(os.path.join(basedir, date)):
+            for study in _subdirectories(pid.path):
+                if sink.output_exists(study.path):
+                    studies.add('/'.join([date, pid.name, study.name]))
+    return studies
 
 
 def remove_existing(df: pd.DataFrame, basedir: Path):
@@ -182,14 +480,32 @@ def remove_existing(df: pd.DataFrame, basedir: Path):
     Args:
         df: Dataframe with "datetime" column.
     '''
-    exists = df.apply(lambda row: study_exists(
-        basedir, row.datetime.strftime('%Y'), row.datetime.strftime(
-            '%m%d'), row.PatientID, row.StudyInstanceUID),
-                      axis=1,
-                      raw=False)
+    dates = pd.to_datetime(df['datetime']).dt.strftime('%Y/%m%d')
+    new_pids = {
+        pid: anonymize.pseudonymize_id('PatientID', pid)
+        for pid in df[settings.COL_PATIENT_ID].unique()
+    }
+    new_pid = df[settings.COL_PATIENT_ID].map(new_pids)
+    new_study_uid = [
+        anonymize.pseudonymize_study_uid(pid, suid)
+        for pid, suid in zip(new_pid, df[settings.COL_STUDY_INSTANCE_UID])
+    ]
+    keys = dates + '/' + new_pid + '/' + pd.Series(new_study_uid,
+                                                   index=df.index,
+                                                   dtype=str)
+    exists = keys.isin(existing_studies(basedir, dates))
     return df[~exists]
 
 
+def precompute_pseudonyms(df: pd.DataFrame):
+    '''
+    Register pseudonyms of all rows so that the skip check and the jobs need no hashing.
+    '''
+    return anonymize.precompute_pseudonyms(
+        df[settings.COL_PATIENT_ID], df[settings.COL_ACCESSION_NUMBER],
+        df[settings.COL_STUDY_INSTANCE_UID])
+
+
 def add_datetime(df: pd.DataFrame):
     '''
     Add datetime column.
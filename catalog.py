@@ -0,0 +1,352 @@
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
+
+from pydicom.dataset import Dataset
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+
+# unique key of each query retrieve level
+LEVEL_KEYS = {
+    'PATIENT': 'PatientID',
+    'STUDY': 'StudyInstanceUID',
+    'SERIES': 'SeriesInstanceUID',
+    'IMAGE': 'SOPInstanceUID',
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS identifiers (
+    level TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    study_uid TEXT,
+    study_date TEXT,
+    dataset TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (level, uid)
+);
+CREATE INDEX IF NOT EXISTS identifiers_study_date ON identifiers (level, study_date);
+CREATE INDEX IF NOT EXISTS identifiers_study_uid ON identifiers (level, study_uid);
+CREATE TABLE IF NOT EXISTS coverage (
+    level TEXT NOT NULL,
+    signature TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (level, signature, unit)
+);
+'''
+
+
+def _is_range_vr(keyword):
+    tag = tag_for_keyword(keyword)
+    return tag is not None and dictionary_VR(tag) in ('DA', 'TM', 'DT')
+
+
+def match_value(keyword, value, pattern):
+    '''
+    C-FIND style matching of a single attribute.
+    Supports universal, list, range (DA/TM/DT) and wildcard matching.
+    '''
+    if pattern is None or str(pattern) == '':
+        return True
+    if value is None:
+        return False
+    pattern = str(pattern)
+    if '\\' in pattern:
+        return any(match_value(keyword, value, p) for p in pattern.split('\\'))
+    values = value if isinstance(value, list) else [value]
+    if '-' in pattern and _is_range_vr(keyword):
+        lo, hi = pattern.split('-', 1)
+        return any(
+            (lo == '' or str(v) >= lo) and (hi == '' or str(v)[:len(hi)] <= hi)
+            for v in values)
+    if '*' in pattern or '?' in pattern:
+        return any(fnmatchcase(str(v), pattern) for v in values)
+    return any(str(v) == pattern for v in values)
+
+
+def match(identifier: Dataset, ds: Dataset):
+    '''
+    Return True if the identifier satisfies all matching keys of the query ds.
+    '''
+    for elem in ds:
+        if elem.keyword in ('QueryRetrieveLevel', '') or elem.VR == 'SQ':
+            continue
+        pattern = elem.value
+        if not isinstance(pattern, str):
+            pattern = '\\'.join(str(v) for v in pattern) if hasattr(
+                pattern, '__iter__') else str(pattern)
+        if pattern == '':
+            continue
+        if elem.keyword not in identifier:
+            return False
+        value = identifier[elem.keyword].value
+        if hasattr(value, '__iter__') and not isinstance(value, str):
+            value = [str(v) for v in value]
+        if not match_value(elem.keyword, value, pattern):
+            return False
+    return True
+
+
+def _days(start: str, end: str):
+    day = datetime.strptime(start, '%Y%m%d')
+    end_day = datetime.strptime(end, '%Y%m%d')
+    while day <= end_day:
+        yield day.strftime('%Y%m%d')
+        day += timedelta(days=1)
+
+
+def _str_value(ds, keyword):
+    value = ds.get(keyword, '')
+    if value is None:
+        return ''
+    if hasattr(value, '__iter__') and not isinstance(value, str):
+        return '\\'.join(str(v) for v in value)
+    return str(value)
+
+
+class Catalog():
+    def __init__(self, filename, max_age=24 * 3600, recent_days=2, limit=0):
+        '''
+        On-disk catalog of C-FIND identifiers.
+
+        Args:
+            filename: SQLite filename
+            max_age (float): Cached results older than this many seconds are fetched again.
+            recent_days (int): Results for StudyDate within this many days from today are always fetched. Results for a StudyInstanceUID are dated by the StudyDate in the catalog, and always fetched if it is unknown.
+            limit (int): Server's maximum number of results. Results of a query reaching the limit are not treated as complete.
+        '''
+        self.filename = str(filename)
+        self.max_age = max_age
+        self.recent_days = recent_days
+        self.limit = limit
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _plan(ds: Dataset):
+        '''
+        Return (unit keyword, list of units) if results of ds can be cached per unit, otherwise None.
+        Units are days of StudyDate or StudyInstanceUIDs.
+        '''
+        level = ds.get('QueryRetrieveLevel', '')
+        if level not in ('STUDY', 'SERIES', 'IMAGE'):
+            return None
+        if _str_value(ds, 'StudyTime') != '':
+            return None
+        study_date = _str_value(ds, 'StudyDate')
+        if study_date != '':
+            parts = study_date.split('-')
+            if len(parts) == 1 and len(parts[0]) == 8:
+                return 'StudyDate', [parts[0]]
+            if len(parts) == 2 and len(parts[0]) == len(parts[1]) == 8:
+                return 'StudyDate', list(_days(*parts))
+            return None
+        study_uid = _str_value(ds, 'StudyInstanceUID')
+        if level != 'STUDY' and study_uid != '' and '*' not in study_uid and '?' not in study_uid:
+            return 'StudyInstanceUID', study_uid.split('\\')
+        return None
+
+    @staticmethod
+    def _signature(ds: Dataset, unit_keyword):
+        items = []
+        for elem in ds:
+            if elem.keyword == unit_keyword:
+                continue
+            items.append((elem.keyword, _str_value(ds, elem.keyword)))
+        return json.dumps(sorted(items))
+
+    def _is_fresh(self, fetched_at, study_date, now):
+        if fetched_at is None or now - fetched_at > self.max_age:
+            return False
+        if study_date is None:
+            return False
+        recent = (datetime.today() -
+                  timedelta(days=self.recent_days)).strftime('%Y%m%d')
+        return study_date < recent
+
+    def _study_dates(self, study_uids):
+        '''
+        Return dict of StudyInstanceUID -> StudyDate known to the catalog
+        '''
+        conn = self._conn()
+        study_dates = {}
+        for i in range(0, len(study_uids), 500):
+            chunk = study_uids[i:i + 500]
+            rows = conn.execute(
+                "SELECT study_uid, MAX(study_date) FROM identifiers WHERE study_uid IN ({}) AND study_date != '' GROUP BY study_uid"
+                .format(','.join('?' * len(chunk))), chunk)
+            study_dates.update(rows)
+        return study_dates
+
+    def _fetched_at(self, level, signature, units):
+        conn = self._conn()
+        fetched_at = {}
+        for i in range(0, len(units), 500):
+            chunk = units[i:i + 500]
+            rows = conn.execute(
+                'SELECT unit, fetched_at FROM coverage WHERE level = ? AND signature = ? AND unit IN ({})'
+                .format(','.join('?' * len(chunk))),
+                [level, signature] + chunk)
+            fetched_at.update(rows)
+        return fetched_at
+
+    def _lookup(self, level, unit_keyword, units, ds):
+        conn = self._conn()
+        if unit_keyword == 'StudyDate':
+            rows = conn.execute(
+                'SELECT dataset FROM identifiers WHERE level = ? AND study_date BETWEEN ? AND ? ORDER BY study_date, uid',
+                (level, units[0], units[-1]))
+            rows = list(rows)
+        else:
+            rows = []
+            for i in range(0, len(units), 500):
+                chunk = units[i:i + 500]
+                rows.extend(
+                    conn.execute(
+                        'SELECT dataset FROM identifiers WHERE level = ? AND study_uid IN ({}) ORDER BY uid'
+                        .format(','.join('?' * len(chunk))), [level] + chunk))
+        for (dataset, ) in rows:
+            identifier = Dataset.from_json(dataset)
+            if match(identifier, ds):
+                yield identifier
+
+    def add(self, level, identifiers, signature=None, units=()):
+        '''
+        Store identifiers. Attributes of already stored identifiers are merged.
+        Units are marked as fetched for the signature.
+        '''
+        key = LEVEL_KEYS[level]
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            for identifier in identifiers:
+                uid = _str_value(identifier, key)
+                if uid == '':
+                    continue
+                new_json = identifier.to_json_dict()
+                row = conn.execute(
+                    'SELECT dataset FROM identifiers WHERE level = ? AND uid = ?',
+                    (level, uid)).fetchone()
+                if row is not None:
+                    merged = json.loads(row[0])
+                    merged.update(new_json)
+                    new_json = merged
+                conn.execute(
+                    'INSERT OR REPLACE INTO identifiers VALUES (?, ?, ?, ?, ?, ?)',
+                    (level, uid, _str_value(identifier, 'StudyInstanceUID'),
+                     _str_value(identifier,
+                                'StudyDate'), json.dumps(new_json), now))
+            conn.executemany(
+                'INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?)',
+                [(level, signature, unit, now) for unit in units])
+
+    def _fetch(self, ds, fetch, level, unit_keyword, signature, units):
+        if unit_keyword == 'StudyDate':
+            query_value = units[0] if len(units) == 1 else '{}-{}'.format(
+                units[0], units[-1])
+        else:
+            query_value = '\\'.join(units)
+        query_ds = Dataset()
+        query_ds.update(ds)
+        setattr(query_ds, unit_keyword, query_value)
+
+        results = []
+        for identifier in fetch(query_ds):
+            results.append(identifier)
+            yield identifier
+        key = LEVEL_KEYS[level]
+        complete = (self.limit <= 0 or len(results) < self.limit) and all(
+            _str_value(r, key) != '' for r in results)
+        self.add(level, results, signature, units if complete else ())
+
+    def iter_query(self, ds: Dataset, fetch, offline=False, refresh=False):
+        '''
+        Answer C-FIND from the catalog if the results are fresh and fetch the rest.
+
+        Args:
+            fetch (callable): Function that takes a query Dataset and yields identifiers from the server.
+            offline (bool): Answer only from the catalog regardless of freshness.
+            refresh (bool): Fetch all results regardless of freshness. The results are stored in the catalog.
+        '''
+        level = ds.get('QueryRetrieveLevel', '')
+        plan = self._plan(ds)
+        if offline:
+            yield from self.search(ds)
+            return
+        if plan is None:
+            results = []
+            for identifier in fetch(ds):
+                results.append(identifier)
+                yield identifier
+            if level in LEVEL_KEYS:
+                self.add(level, results)
+            return
+
+        unit_keyword, units = plan
+        signature = self._signature(ds, unit_keyword)
+        if refresh:
+            fetched_at = {}
+            study_dates = {}
+        else:
+            fetched_at = self._fetched_at(level, signature, units)
+            if unit_keyword == 'StudyDate':
+                study_dates = {unit: unit for unit in units}
+            else:
+                study_dates = self._study_dates(units)
+        now = time.time()
+        fresh = [
+            self._is_fresh(fetched_at.get(unit), study_dates.get(unit), now)
+            for unit in units
+        ]
+        if unit_keyword == 'StudyDate':
+            # contiguous runs of days in date order
+            groups = []
+            for unit, is_fresh in zip(units, fresh):
+                if groups and groups[-1][0] == is_fresh:
+                    groups[-1][1].append(unit)
+                else:
+                    groups.append((is_fresh, [unit]))
+        else:
+            groups = [(True, [u for u, f in zip(units, fresh) if f]),
+                      (False, [u for u, f in zip(units, fresh) if not f])]
+        for is_fresh, group in groups:
+            if len(group) == 0:
+                continue
+            if is_fresh:
+                yield from self._lookup(level, unit_keyword, group, ds)
+            else:
+                yield from self._fetch(ds, fetch, level, unit_keyword,
+                                       signature, group)
+
+    def search(self, ds: Dataset):
+        '''
+        Query the catalog only.
+        '''
+        level = ds.get('QueryRetrieveLevel', '')
+        plan = self._plan(ds)
+        if plan is not None:
+            yield from self._lookup(level, plan[0], plan[1], ds)
+            return
+        rows = self._conn().execute(
+            'SELECT dataset FROM identifiers WHERE level = ? ORDER BY study_date, uid',
+            (level, ))
+        for (dataset, ) in list(rows):
+            identifier = Dataset.from_json(dataset)
+            if match(identifier, ds):
+                yield identifier
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
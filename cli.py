@@ -8,7 +8,7 @@ from threading import Lock
 import logzero
 from logzero import logger
 
-from autoqr import AutoQR, open_csv, remove_existing, add_datetime
+from autoqr import AutoQR, open_csv, remove_existing, add_datetime, precompute_pseudonyms
 
 from config import settings
 
@@ -36,13 +36,14 @@ def main():
 
     args = parser.parse_args()
 
-    try:
-        subprocess.check_call(
-            [str(Path(settings.DCMTK_BINDIR) / 'movescu'), '-h'],
-            stdout=subprocess.DEVNULL)
-    except Exception as e:
-        logger.error(e)
-        return 1
+    if settings.RETRIEVE_METHOD == 'dcmtk':
+        try:
+            subprocess.check_call(
+                [str(Path(settings.DCMTK_BINDIR) / 'movescu'), '-h'],
+                stdout=subprocess.DEVNULL)
+        except Exception as e:
+            logger.error(e)
+            return 1
 
     if args.logfile and args.logfile != '-':
         logzero.logfile(args.logfile, maxBytes=1e7, backupCount=256)
@@ -61,6 +62,18 @@ def main():
         print('Server config error')
         return 1
 
+    if not settings.validate_retrieve_method():
+        print('Invalid RETRIEVE_METHOD')
+        return 1
+
+    if not settings.validate_anonymize_backend():
+        print('Invalid ANONYMIZE_BACKEND')
+        return 1
+
+    if not settings.validate_output_format():
+        print('Invalid OUTPUT_FORMAT')
+        return 1
+
     if len(settings.RECEIVE_PORTS) > settings.N_THREADS:
         logger.warning('N_THREADS < available ports (%s and %s)',
                        len(settings.RECEIVE_PORTS), settings.N_THREADS)
@@ -69,15 +82,17 @@ def main():
     autoqr = AutoQR(args.outdir, logger)
     df = open_csv(args.csv_filename)
     add_datetime(df)
-    if settings.SKIP_EXISTING_STUDY:
+    logger.info('Precomputed %d pseudonyms', precompute_pseudonyms(df))
+    # the journal tells finished studies from partial outputs of a crash
+    if settings.SKIP_EXISTING_STUDY and not settings.JOURNAL:
         logger.info('Skip existing')
         original_count = len(df)
         df = remove_existing(df, outdir)
         logger.info('Skipping result:%d -> %d', original_count, len(df))
+    df = autoqr.set_df(df)
     if len(df) == 0:
         print('No studies for Q/R')
         return 0
-    autoqr.set_df(df)
     lock = Lock()  # lock to wait for the autoqr to finish
     lock.acquire()
 
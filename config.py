@@ -1,8 +1,13 @@
 import sys
+import importlib.util
 from pathlib import Path
 import toml
 from logzero import logger as default_logger
 
+RETRIEVE_METHODS = ['dcmtk', 'move', 'get']
+ANONYMIZE_BACKENDS = ['thread', 'process']
+OUTPUT_FORMATS = ['zip', 'zip_stored', 'tar', 'tar_zst', 'directory']
+
 
 class Defaults():
     def __init__(self):
@@ -13,7 +18,19 @@ class Defaults():
         self.AETS = ['AUTOQR']  # Client's application Entity Title
         self.__PERIODS = [('1800', '0700')]
         self.DCMTK_BINDIR = ''
+        self.RETRIEVE_METHOD = 'dcmtk'  # One of RETRIEVE_METHODS
         self.__N_THREADS = 1
+        self.ANONYMIZE_BACKEND = 'thread'  # One of ANONYMIZE_BACKENDS
+        self.__ANONYMIZE_WORKERS = 0  # 0 for num of cores (process) or N_THREADS (thread)
+        self.__ZIP_WORKERS = 4
+        self.__MAX_PENDING_STUDIES = 0  # 0 for 2 * N_THREADS
+        self.__MAX_PENDING_MB = 0  # 0 for no limit
+        self.__DISK_RESERVE_MB = 1024
+        self.SCRATCH_DIR = ''  # Directory to retrieve studies into. Empty for the system temp directory
+        self.__MEMORY_STAGING_MB = 256
+        self.JOURNAL = True  # Record the state of each study in the output directory
+        self.RETRY_FAILED = True  # Retry studies failed in the journal
+        self.OUTPUT_FORMAT = 'zip'  # One of OUTPUT_FORMATS
         self.__RECEIVE_PORTS = [104]
         self.COL_ACCESSION_NUMBER = 'AccessionNumber'
         self.COL_STUDY_INSTANCE_UID = 'StudyInstanceUID'
@@ -22,6 +39,20 @@ class Defaults():
         self.DATETIME_FORMAT = '%Y%m%d'
         self.SKIP_EXISTING_STUDY = True
         self.__INTERVAL = 5
+        self.__MAX_ASSOCIATIONS = 4
+        self.__ASSOCIATION_IDLE_TIMEOUT = 60
+        self.__PRE_RESOLVE_BATCH_SIZE = 50  # 0 to disable
+        self.__PREFETCH = 2  # num of jobs queried ahead of the workers. 0 to disable
+        self.STREAM_ANONYMIZE = False  # anonymize instances as they are received (move and get only)
+        self.__RETRIEVE_RETRIES = 1  # num of resumes after a failed retrieval
+        self.__SERIES_SPLIT = 1  # max num of concurrent retrievals per study
+        self.__DISPATCH_COOLDOWN = 60  # seconds to skip a server refusing associations
+        self.__QUERY_LIMIT = 0  # Max num of C-FIND results the server returns. 0 if unknown
+        self.CATALOG = ''  # SQLite filename of the query catalog. Empty to disable
+        self.__CATALOG_MAX_AGE = 24  # hours
+        self.__CATALOG_RECENT_DAYS = 2
+        self.PSEUDONYM_REGISTRY = ''  # SQLite filename of the pseudonym registry. Empty for memory only
+        self.__PSEUDONYM_CACHE_SIZE = 1000000
 
     @property
     def N_THREADS(self):
@@ -31,6 +62,54 @@ class Defaults():
     def N_THREADS(self, n_str: str):
         self.__N_THREADS = int(n_str)
 
+    @property
+    def ANONYMIZE_WORKERS(self):
+        return self.__ANONYMIZE_WORKERS
+
+    @ANONYMIZE_WORKERS.setter
+    def ANONYMIZE_WORKERS(self, n_str: str):
+        self.__ANONYMIZE_WORKERS = int(n_str)
+
+    @property
+    def ZIP_WORKERS(self):
+        return self.__ZIP_WORKERS
+
+    @ZIP_WORKERS.setter
+    def ZIP_WORKERS(self, n_str: str):
+        self.__ZIP_WORKERS = int(n_str)
+
+    @property
+    def MAX_PENDING_STUDIES(self):
+        return self.__MAX_PENDING_STUDIES
+
+    @MAX_PENDING_STUDIES.setter
+    def MAX_PENDING_STUDIES(self, n_str: str):
+        self.__MAX_PENDING_STUDIES = int(n_str)
+
+    @property
+    def MAX_PENDING_MB(self):
+        return self.__MAX_PENDING_MB
+
+    @MAX_PENDING_MB.setter
+    def MAX_PENDING_MB(self, n_str: str):
+        self.__MAX_PENDING_MB = int(n_str)
+
+    @property
+    def DISK_RESERVE_MB(self):
+        return self.__DISK_RESERVE_MB
+
+    @DISK_RESERVE_MB.setter
+    def DISK_RESERVE_MB(self, n_str: str):
+        self.__DISK_RESERVE_MB = int(n_str)
+
+    @property
+    def MEMORY_STAGING_MB(self):
+        return self.__MEMORY_STAGING_MB
+
+    @MEMORY_STAGING_MB.setter
+    def MEMORY_STAGING_MB(self, n_str: str):
+        self.__MEMORY_STAGING_MB = int(n_str)
+
     @property
     def INTERVAL(self):
         return self.__INTERVAL
@@ -39,6 +118,94 @@ class Defaults():
     def INTERVAL(self, int_str: str):
         self.__INTERVAL = int(int_str)
 
+    @property
+    def MAX_ASSOCIATIONS(self):
+        return self.__MAX_ASSOCIATIONS
+
+    @MAX_ASSOCIATIONS.setter
+    def MAX_ASSOCIATIONS(self, n_str: str):
+        self.__MAX_ASSOCIATIONS = int(n_str)
+
+    @property
+    def ASSOCIATION_IDLE_TIMEOUT(self):
+        return self.__ASSOCIATION_IDLE_TIMEOUT
+
+    @ASSOCIATION_IDLE_TIMEOUT.setter
+    def ASSOCIATION_IDLE_TIMEOUT(self, int_str: str):
+        self.__ASSOCIATION_IDLE_TIMEOUT = int(int_str)
+
+    @property
+    def QUERY_LIMIT(self):
+        return self.__QUERY_LIMIT
+
+    @QUERY_LIMIT.setter
+    def QUERY_LIMIT(self, n_str: str):
+        self.__QUERY_LIMIT = int(n_str)
+
+    @property
+    def CATALOG_MAX_AGE(self):
+        return self.__CATALOG_MAX_AGE
+
+    @CATALOG_MAX_AGE.setter
+    def CATALOG_MAX_AGE(self, int_str: str):
+        self.__CATALOG_MAX_AGE = int(int_str)
+
+    @property
+    def CATALOG_RECENT_DAYS(self):
+        return self.__CATALOG_RECENT_DAYS
+
+    @CATALOG_RECENT_DAYS.setter
+    def CATALOG_RECENT_DAYS(self, int_str: str):
+        self.__CATALOG_RECENT_DAYS = int(int_str)
+
+    @property
+    def PREFETCH(self):
+        return self.__PREFETCH
+
+    @PREFETCH.setter
+    def PREFETCH(self, n_str: str):
+        self.__PREFETCH = int(n_str)
+
+    @property
+    def RETRIEVE_RETRIES(self):
+        return self.__RETRIEVE_RETRIES
+
+    @RETRIEVE_RETRIES.setter
+    def RETRIEVE_RETRIES(self, n_str: str):
+        self.__RETRIEVE_RETRIES = int(n_str)
+
+    @property
+    def PSEUDONYM_CACHE_SIZE(self):
+        return self.__PSEUDONYM_CACHE_SIZE
+
+    @PSEUDONYM_CACHE_SIZE.setter
+    def PSEUDONYM_CACHE_SIZE(self, n_str: str):
+        self.__PSEUDONYM_CACHE_SIZE = int(n_str)
+
+    @property
+    def SERIES_SPLIT(self):
+        return self.__SERIES_SPLIT
+
+    @SERIES_SPLIT.setter
+    def SERIES_SPLIT(self, n_str: str):
+        self.__SERIES_SPLIT = int(n_str)
+
+    @property
+    def DISPATCH_COOLDOWN(self):
+        return self.__DISPATCH_COOLDOWN
+
+    @DISPATCH_COOLDOWN.setter
+    def DISPATCH_COOLDOWN(self, int_str: str):
+        self.__DISPATCH_COOLDOWN = int(int_str)
+
+    @property
+    def PRE_RESOLVE_BATCH_SIZE(self):
+        return self.__PRE_RESOLVE_BATCH_SIZE
+
+    @PRE_RESOLVE_BATCH_SIZE.setter
+    def PRE_RESOLVE_BATCH_SIZE(self, n_str: str):
+        self.__PRE_RESOLVE_BATCH_SIZE = int(n_str)
+
     @property
     def PORTS(self):
         return self.__PORTS
@@ -82,6 +249,9 @@ class Defaults():
                 logger.warning('%s is invalid config key', key)
 
     def validate_n_threads(self):
+        if self.RETRIEVE_METHOD == 'get':
+            return True  # C-GET needs neither receive ports nor AETs per thread
+
         if len(self.RECEIVE_PORTS) < self.N_THREADS:
             default_logger.error(
                 'Invalid config. len(RECEIVE_PORTS) < N_THREADS (%d and %d)',
@@ -96,6 +266,41 @@ class Defaults():
 
         return True
 
+    def validate_retrieve_method(self):
+        if self.RETRIEVE_METHOD not in RETRIEVE_METHODS:
+            default_logger.error(
+                'Invalid RETRIEVE_METHOD config. %s is not one of %s',
+                self.RETRIEVE_METHOD, RETRIEVE_METHODS)
+            return False
+        if self.STREAM_ANONYMIZE and self.RETRIEVE_METHOD == 'dcmtk':
+            default_logger.error(
+                'Invalid RETRIEVE_METHOD config. STREAM_ANONYMIZE requires move or get'
+            )
+            return False
+        return True
+
+    def validate_anonymize_backend(self):
+        if self.ANONYMIZE_BACKEND in ANONYMIZE_BACKENDS:
+            return True
+        default_logger.error(
+            'Invalid ANONYMIZE_BACKEND config. %s is not one of %s',
+            self.ANONYMIZE_BACKEND, ANONYMIZE_BACKENDS)
+        return False
+
+    def validate_output_format(self):
+        if self.OUTPUT_FORMAT not in OUTPUT_FORMATS:
+            default_logger.error(
+                'Invalid OUTPUT_FORMAT config. %s is not one of %s',
+                self.OUTPUT_FORMAT, OUTPUT_FORMATS)
+            return False
+        if self.OUTPUT_FORMAT == 'tar_zst' and importlib.util.find_spec(
+                'zstandard') is None:
+            default_logger.error(
+                'Invalid OUTPUT_FORMAT config. tar_zst requires zstandard package'
+            )
+            return False
+        return True
+
     def validate_server_config(self):
         if len(self.AECS) == len(self.DICOM_SERVERS) == len(self.PORTS):
             return True
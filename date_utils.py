@@ -1,6 +1,9 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time
 import math
 
+# StudyTime that matches studies without StudyTime (empty value matching)
+EMPTY_TIME = '""'
+
 
 def parse_date(date_str: str):
     return datetime.strptime(date_str, '%Y%m%d')
@@ -23,3 +26,80 @@ def split(start: datetime, end: datetime, step: int):
 def split_size(start: datetime, end: datetime, step: int):
     days = (end - start).days + 1
     return math.ceil(days / step)
+
+
+def _split_time(part_start: datetime, part_end: datetime, query, limit: int,
+                min_seconds: int):
+    '''
+    Bisect [part_start, part_end] (within a day, inclusive to the second).
+    '''
+    seconds = int((part_end - part_start).total_seconds()) + 1
+    mid = part_start + timedelta(seconds=seconds // 2)
+    for sub_start, sub_end in [(part_start, mid - timedelta(seconds=1)),
+                               (mid, part_end)]:
+        results = query(sub_start, sub_end)
+        sub_seconds = int((sub_end - sub_start).total_seconds()) + 1
+        if len(results) >= limit and sub_seconds >= 2 * min_seconds:
+            yield from _split_time(sub_start, sub_end, query, limit,
+                                   min_seconds)
+        else:
+            yield (sub_start, sub_end, results)
+
+
+def adaptive_split(start: datetime,
+                   end: datetime,
+                   step: int,
+                   query,
+                   limit: int,
+                   max_step: int = None,
+                   min_seconds: int = 60):
+    '''
+    Split the range while querying so that no part reaches the server's result limit.
+    A part is bisected when the query returns limit or more results, down to a single day and then to time-of-day ranges.
+    A day split into time-of-day ranges is also queried for studies without StudyTime (part_end is None).
+    The step doubles while the results are sparse (less than a quarter of limit).
+
+    Args:
+        step (int): Initial step size in days.
+        query (callable): Function that takes (part_start, part_end) and returns a list of results. part_end is None for studies of the day without StudyTime. Use part2query to build the query.
+        limit (int): Maximum number of results the server returns for a query.
+        max_step (int): Maximum step size in days. Default: no limit.
+        min_seconds (int): Minimum length of time-of-day ranges.
+    Yields:
+        (part_start, part_end, results). Results may still be truncated if len(results) >= limit.
+    '''
+    part_start = start
+    while part_start <= end:
+        part_end = min(part_start + timedelta(days=step - 1), end)
+        results = query(part_start, part_end)
+        if len(results) >= limit:
+            if part_end > part_start:
+                step = max(1, ((part_end - part_start).days + 1) // 2)
+                continue
+            # studies without StudyTime are not matched by time ranges
+            yield (part_start, None, query(part_start, None))
+            yield from _split_time(
+                part_start,
+                part_start + timedelta(days=1) - timedelta(seconds=1), query,
+                limit, min_seconds)
+        else:
+            yield (part_start, part_end, results)
+            if len(results) < limit / 4:
+                step = step * 2
+                if max_step is not None:
+                    step = min(step, max_step)
+        part_start = part_end + timedelta(days=1)
+
+
+def part2query(part_start: datetime, part_end: datetime):
+    '''
+    Return (StudyDate, StudyTime) for a part from split or adaptive_split.
+    StudyTime is '' for parts consisting of whole days and EMPTY_TIME if part_end is None.
+    Time ranges end at the last fraction of the second so that StudyTime with fractional seconds is matched.
+    '''
+    if part_end is None:
+        return date2str(part_start), EMPTY_TIME
+    if part_end.time() == time(0):  # whole days
+        return '{}-{}'.format(date2str(part_start), date2str(part_end)), ''
+    return date2str(part_start), '{}-{}.999999'.format(
+        part_start.strftime('%H%M%S'), part_end.strftime('%H%M%S'))
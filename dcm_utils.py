@@ -1,23 +1,167 @@
 import io
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 import zipfile
 import pydicom
-from pydicom.datadict import keyword_for_tag
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.dataelem import DataElement, RawDataElement
+from pydicom.datadict import keyword_for_tag, dictionary_VR
+from pydicom.tag import Tag
+from pydicom.uid import UID
 
 
-def save_as_zip(contents, compresslevel, zip_filename=None):
+ZIP_TRIAL_SIZE = 65536  # bytes at the end of a member compressed to estimate the ratio
+ZIP_STORE_RATIO = 0.9  # members that do not shrink below this ratio are stored
+
+
+def _transfer_syntax(data):
+    '''
+    Return TransferSyntaxUID in the file meta of an encoded DICOM file or None.
+    '''
+    buf = memoryview(data)
+    if len(buf) < PREAMBLE_LENGTH or bytes(buf[128:132]) != b'DICM':
+        return None
+    try:
+        for tag, _, _, value, end in _iter_elements(buf, PREAMBLE_LENGTH,
+                                                    len(buf), False):
+            if tag == TRANSFER_SYNTAX_TAG:
+                return UID(
+                    bytes(buf[value:end]).rstrip(b'\0 ').decode('ascii'))
+            if tag >> 16 != 0x0002:
+                return None
+    except (UnsupportedDicom, struct.error, UnicodeDecodeError):
+        pass
+    return None
+
+
+def zip_compression(content, compresslevel):
+    '''
+    Choose ZIP_STORED or ZIP_DEFLATED for a member.
+    Files with compressed pixel data and contents that do not shrink in a trial compression are stored.
+    '''
+    if compresslevel < 0:
+        return zipfile.ZIP_STORED
+    transfer_syntax = _transfer_syntax(content)
+    if transfer_syntax is not None and transfer_syntax.is_compressed:
+        return zipfile.ZIP_STORED
+    sample = content[-ZIP_TRIAL_SIZE:]
+    if len(zlib.compress(sample, 1)) > len(sample) * ZIP_STORE_RATIO:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _compress_member(filename, content, compresslevel):
+    compress_type = zip_compression(content, compresslevel)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        data = compressor.compress(content) + compressor.flush()
+    else:
+        data = content
+    return filename, compress_type, zlib.crc32(content), len(content), data
+
+
+class _ZipAssembler():
+    '''
+    Write a zip file from members that are already compressed.
+    Zip64 records are added when offsets or the num of members exceed the limits of zip.
+    '''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.central_directory = []
+        now = time.localtime()
+        self.dos_time = now.tm_hour << 11 | now.tm_min << 5 | now.tm_sec // 2
+        self.dos_date = (now.tm_year - 1980) << 9 | now.tm_mon << 5 | now.tm_mday
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def add(self, filename, compress_type, crc, size, data):
+        if size >= 0xFFFFFFFF:
+            raise ValueError('Member {} is too large'.format(filename))
+        try:
+            name = filename.encode('ascii')
+            flags = 0
+        except UnicodeEncodeError:
+            name = filename.encode('utf-8')
+            flags = 0x800
+        version = 20 if compress_type == zipfile.ZIP_DEFLATED else 10
+        fields = (version, flags, compress_type, self.dos_time, self.dos_date,
+                  crc, len(data), size, len(name))
+        header_offset = self.offset
+        self._write(struct.pack('<4s5HL2L2H', b'PK\x03\x04', *fields, 0))
+        self._write(name)
+        self._write(data)
+
+        extra = b''
+        if header_offset >= 0xFFFFFFFF:
+            extra = struct.pack('<2HQ', 1, 8, header_offset)
+            header_offset = 0xFFFFFFFF
+            fields = (45, ) + fields[1:]
+        self.central_directory.append(
+            struct.pack('<4s6HL2L5HLL', b'PK\x01\x02', 3 << 8 | 20, *fields,
+                        len(extra), 0, 0, 0, 0o600 << 16, header_offset) +
+            name + extra)
+
+    def close(self):
+        cd_offset = self.offset
+        for record in self.central_directory:
+            self._write(record)
+        cd_size = self.offset - cd_offset
+        n = len(self.central_directory)
+        if n >= 0xFFFF or cd_offset >= 0xFFFFFFFF:
+            zip64_offset = self.offset
+            self._write(
+                struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, n,
+                            n, cd_size, cd_offset))
+            self._write(struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_offset,
+                                    1))
+            n, cd_size, cd_offset = min(n, 0xFFFF), min(
+                cd_size, 0xFFFFFFFF), min(cd_offset, 0xFFFFFFFF)
+        self._write(
+            struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, n, n, cd_size,
+                        cd_offset, 0))
+
+
+def save_as_zip(contents, compresslevel, zip_filename=None, workers=1):
     '''
+    Members are compressed in worker threads and written in order. Each member is stored or deflated according to zip_compression.
+
     Args:
         contents (iterable): Iterable object that returns (filename, content(bytes))
         compresslevel (int): Compression level for zipping. Specify -1 for no compression.
         zip_filename (str): Filename for zipped contents. If None, bytes is returned.
+        workers (int): Num of threads to compress members.
     '''
-    compression = zipfile.ZIP_STORED if compresslevel < 0 else zipfile.ZIP_DEFLATED
-    with zipfile.ZipFile(zip_filename,
-                         'w',
-                         compression,
-                         compresslevel=compresslevel) as zf:
-        for filename, content in contents:
-            zf.writestr(filename, content)
+    with (io.BytesIO() if zip_filename is None else open(zip_filename,
+                                                         'wb')) as f:
+        assembler = _ZipAssembler(f)
+        if workers <= 1:
+            for filename, content in contents:
+                assembler.add(
+                    *_compress_member(filename, content, compresslevel))
+        else:
+            with ThreadPoolExecutor(workers) as pool:
+                # keep the num of members in memory bounded
+                pending = deque()
+                for filename, content in contents:
+                    pending.append(
+                        pool.submit(_compress_member, filename, content,
+                                    compresslevel))
+                    if len(pending) > 2 * workers:
+                        assembler.add(*pending.popleft().result())
+                while len(pending) > 0:
+                    assembler.add(*pending.popleft().result())
+        assembler.close()
+        if zip_filename is None:
+            return f.getvalue()
 
 
 def dcm2bytes(dcm):
@@ -26,14 +170,15 @@ def dcm2bytes(dcm):
         return bio.getvalue()
 
 
-def dcms2zip(filenames, dcms, compresslevel, zip_filename):
+def dcms2zip(filenames, dcms, compresslevel, zip_filename, workers=1):
     '''
     Args:
         compresslevel (int): Compression level for zipping. Specify -1 for no compression.
         zip_filename (str): Filename for zipped contents. If None, bytes is returned.
+        workers (int): Num of threads to compress members.
     '''
     generator = zip(filenames, (dcm2bytes(dcm) for dcm in dcms))
-    return save_as_zip(generator, compresslevel, zip_filename)
+    return save_as_zip(generator, compresslevel, zip_filename, workers)
 
 
 def tag2int(tag_str):
@@ -57,6 +202,87 @@ def tag2str(tag):
     return '({:04X},{:04X})'.format(*tag)
 
 
+class _Step():
+    '''
+    Replace rule resolved at compile time
+    '''
+    __slots__ = ('tag', 'value', 'is_callable', 'is_meta', 'keyword', 'VR',
+                 'element')
+
+    def __init__(self, tag, value):
+        self.tag = Tag(tag)
+        self.value = value
+        self.is_callable = callable(value)
+        self.is_meta = self.tag.group == 0x0002
+        self.keyword = keyword_for_tag(self.tag)
+        try:
+            self.VR = dictionary_VR(self.tag)
+        except KeyError:
+            self.VR = 'UN'
+        # static value is converted and validated once
+        self.element = None if self.is_callable else DataElement(
+            self.tag, self.VR, value)
+
+
+class AnonymizationPlan():
+    '''
+    Replace and remove rules compiled once per series.
+    Callables are bound, keywords and VRs of tags are resolved and remove rules are split into file meta and dataset.
+
+    Args:
+        replace_rules (list): list of tuples of (tag, new_value). new_value is either a str or a generator function.
+        remove_rules (list): list of tags to remove
+    '''
+    __slots__ = ('steps', 'meta_remove', 'remove', 'remove_set', 'encoded')
+
+    def __init__(self, replace_rules, remove_rules):
+        self.steps = tuple(_Step(tag, value) for tag, value in replace_rules)
+        remove = [Tag(tag) for tag in remove_rules]
+        self.meta_remove = tuple(tag for tag in remove if tag.group == 0x0002)
+        self.remove = tuple(tag for tag in remove if tag.group != 0x0002)
+        self.remove_set = frozenset(remove)
+        self.encoded = {}  # (tag, VR, implicit) -> encoded static element. Used by rewrite_bytes
+
+    def apply(self, dcm):
+        '''
+        Replace and remove elements of dcm (including file meta) in place.
+        '''
+        for step in self.steps:
+            if not step.is_callable:
+                if step.is_meta:
+                    dcm.file_meta[step.tag] = copy(step.element)
+                else:
+                    dcm[step.tag] = copy(step.element)
+            elif step.is_meta:
+                dcm.file_meta[step.tag].value = step.value(dcm)
+            elif step.tag in dcm:
+                dcm[step.tag].value = step.value(dcm)
+            else:
+                setattr(dcm, step.keyword, step.value(dcm))
+
+        if self.meta_remove:
+            file_meta = dcm.file_meta
+            for tag in self.meta_remove:
+                if tag in file_meta:
+                    del file_meta[tag]
+        for tag in self.remove:
+            if tag in dcm:
+                del dcm[tag]
+        return dcm
+
+
+def apply_rules(dcm, replace_rules, remove_rules):
+    '''
+    Replace and remove elements of dcm (including file meta) in place.
+    Use AnonymizationPlan to apply the same rules to many datasets.
+
+    Args:
+        replace_rules (list): list of tuples of (tag, new_value). new_value is either a str or a generator function.
+        remove_rules (list): list of tags to remove
+    '''
+    return AnonymizationPlan(replace_rules, remove_rules).apply(dcm)
+
+
 class DcmGenerator(object):
     '''
     Args:
@@ -66,8 +292,7 @@ class DcmGenerator(object):
     def __init__(self, dcms, replace_rules, remove_rules):
         self.dcms = dcms
         self.length = len(dcms)
-        self.replace_rules = replace_rules
-        self.remove_rules = remove_rules
+        self.plan = AnonymizationPlan(replace_rules, remove_rules)
         self._i = 0
 
     def __len__(self):
@@ -80,23 +305,7 @@ class DcmGenerator(object):
         if self._i == self.length:
             raise StopIteration()
 
-        dcm = self.dcms[self._i]
-
-        for tag, new_value in self.replace_rules:
-            if hasattr(new_value, '__call__'):
-                new_value = new_value(dcm)
-            if tag[0] == 0x0002:
-                dcm.file_meta[tag].value = new_value
-            else:
-                if tag in dcm:
-                    dcm[tag].value = new_value
-                else:
-                    kw = keyword_for_tag(tag)
-                    setattr(dcm, kw, new_value)
-
-        for tag in self.remove_rules:
-            if tag in dcm:
-                del dcm[tag]
+        dcm = self.plan.apply(self.dcms[self._i])
 
         self._i += 1
         return dcm
@@ -111,8 +320,7 @@ class DcmGeneratorFN(object):
     def __init__(self, fns, replace_rules, remove_rules):
         self.fns = fns
         self.length = len(fns)
-        self.replace_rules = replace_rules
-        self.remove_rules = remove_rules
+        self.plan = AnonymizationPlan(replace_rules, remove_rules)
         self._i = 0
 
     def __len__(self):
@@ -126,25 +334,358 @@ class DcmGeneratorFN(object):
             raise StopIteration()
 
         fn = self.fns[self._i]
-        dcm = pydicom.dcmread(fn)
+        dcm = self.plan.apply(pydicom.dcmread(fn))
+
+        self._i += 1
+        return dcm
+
 
-        for tag, new_value in self.replace_rules:
-            if hasattr(new_value, '__call__'):
-                new_value = new_value(dcm)
-            if tag[0] == 0x0002:
-                dcm.file_meta[tag].value = new_value
+# explicit VRs with 2 reserved bytes and 4 bytes length
+LONG_VRS = {
+    b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR',
+    b'UT', b'UV'
+}
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM_TAG = 0xFFFEE000
+ITEM_DELIMITER_TAG = 0xFFFEE00D
+SEQUENCE_DELIMITER_TAG = 0xFFFEE0DD
+PREAMBLE_LENGTH = 132  # preamble and 'DICM'
+MAX_RAW_LENGTH = 1024  # elements up to this length are available to replace functions
+META_GROUP_LENGTH_TAG = 0x00020000
+TRANSFER_SYNTAX_TAG = 0x00020010
+SERIES_UID_TAG = 0x0020000E
+HEADER_SIZE = 16384  # bytes read to find SeriesInstanceUID
+
+
+class UnsupportedDicom(Exception):
+    pass
+
+
+def _iter_elements(buf, offset, end, implicit):
+    '''
+    Yield (tag, VR, start, value offset, end) of elements in buf[offset:end].
+    VR is None for implicit VR and items. Stops after an item delimiter.
+    '''
+    while offset < end:
+        group, elem = struct.unpack_from('<HH', buf, offset)
+        tag = group << 16 | elem
+        if group == 0xFFFE or implicit:
+            vr = None
+            length, = struct.unpack_from('<L', buf, offset + 4)
+            value = offset + 8
+        else:
+            vr = bytes(buf[offset + 4:offset + 6])
+            if vr in LONG_VRS:
+                length, = struct.unpack_from('<L', buf, offset + 8)
+                value = offset + 12
             else:
-                if tag in dcm:
-                    dcm[tag].value = new_value
-                else:
-                    kw = keyword_for_tag(tag)
-                    setattr(dcm, kw, new_value)
+                length, = struct.unpack_from('<H', buf, offset + 6)
+                value = offset + 8
+        if length == UNDEFINED_LENGTH:
+            # contents of UN with undefined length are implicit VR
+            value_end = _skip_items(buf, value, end, implicit or vr == b'UN')
+        else:
+            value_end = value + length
+        if value_end > end:
+            raise UnsupportedDicom('Element exceeds the end of the data')
+        yield tag, vr, offset, value, value_end
+        if tag == ITEM_DELIMITER_TAG:
+            return
+        offset = value_end
 
-        for tag in self.remove_rules:
-            if tag[0] == 0x0002 and tag in dcm.file_meta:
-                del dcm.file_meta[tag]
-            elif tag in dcm:
-                del dcm[tag]
+
+def _skip_items(buf, offset, end, implicit):
+    '''
+    Return the offset after the sequence delimiter of an undefined length value.
+    '''
+    while offset < end:
+        group, elem, length = struct.unpack_from('<HHL', buf, offset)
+        tag = group << 16 | elem
+        offset += 8
+        if tag == SEQUENCE_DELIMITER_TAG:
+            return offset
+        if tag != ITEM_TAG:
+            raise UnsupportedDicom('Unexpected tag in sequence')
+        if length == UNDEFINED_LENGTH:
+            for element in _iter_elements(buf, offset, end, implicit):
+                offset = element[4]
+        else:
+            offset += length
+    raise UnsupportedDicom('Sequence delimiter is not found')
+
+
+def _encode_element(tag, vr, value, implicit):
+    if not isinstance(value, str):
+        raise UnsupportedDicom('Only str values are supported')
+    try:
+        value = value.encode('ascii')
+    except UnicodeEncodeError:
+        # the encoding depends on SpecificCharacterSet
+        raise UnsupportedDicom('Only ASCII values are supported')
+    if len(value) % 2 == 1:
+        value += b'\0' if vr == 'UI' else b' '
+    if implicit:
+        return struct.pack('<HHL', tag >> 16, tag & 0xFFFF, len(value)) + value
+    vr = vr.encode('ascii')
+    if vr in LONG_VRS:
+        return struct.pack('<HH2sHL', tag >> 16, tag & 0xFFFF, vr, 0,
+                           len(value)) + value
+    if len(value) > 0xFFFF:
+        raise UnsupportedDicom('Value is too long')
+    return struct.pack('<HH2sH', tag >> 16, tag & 0xFFFF, vr,
+                       len(value)) + value
+
+
+def _raw_elements(buf, elements, implicit):
+    '''
+    Return {tag: RawDataElement} of short elements, decoded lazily by pydicom.
+    '''
+    raw = {}
+    for tag, vr, _, value, value_end in elements:
+        if value_end - value > MAX_RAW_LENGTH or vr == b'SQ':
+            continue
+        raw[Tag(tag)] = RawDataElement(Tag(tag),
+                                       vr.decode('ascii') if vr else None,
+                                       value_end - value,
+                                       bytes(buf[value:value_end]), value,
+                                       implicit, True)
+    return raw
+
+
+def _rewrite_group(buf, elements, new_elements, remove_rules, implicit):
+    '''
+    Return chunks of elements with new_elements ({tag: encoded element}) inserted or replaced and remove_rules removed.
+    '''
+    chunks = []
+    pending = sorted(new_elements.keys())
+    for tag, _, start, _, value_end in elements:
+        while pending and pending[0] < tag:
+            chunks.append(new_elements[pending.pop(0)])
+        if pending and pending[0] == tag:
+            chunks.append(new_elements[pending.pop(0)])
+        elif tag not in remove_rules:
+            chunks.append(buf[start:value_end])
+    chunks += [new_elements[tag] for tag in pending]
+    return chunks
+
+
+def rewrite_bytes(data, plan: AnonymizationPlan):
+    '''
+    Apply the rules to an encoded DICOM file without decoding the whole dataset.
+    Only the replaced and removed top level elements are touched and the others (including Pixel Data) are copied as raw bytes.
+
+    Args:
+        data (bytes): DICOM file with preamble and file meta.
+        plan (AnonymizationPlan): Rules to apply. Functions are called with a dataset that contains short elements only.
+    Returns:
+        bytes: Rewritten DICOM file.
+    Raises:
+        UnsupportedDicom: If data is not little endian (explicit or implicit VR) or has unexpected structure.
+    '''
+    buf = memoryview(data)
+    if len(buf) < PREAMBLE_LENGTH or bytes(buf[128:132]) != b'DICM':
+        raise UnsupportedDicom('No DICM prefix')
+    try:
+        meta, elements = [], []
+        for element in _iter_elements(buf, PREAMBLE_LENGTH, len(buf), False):
+            if element[0] >> 16 != 0x0002:
+                break
+            meta.append(element)
+        dataset_offset = meta[-1][4] if meta else PREAMBLE_LENGTH
+
+        file_meta = FileMetaDataset(_raw_elements(buf, meta, False))
+        transfer_syntax = UID(file_meta.get('TransferSyntaxUID', ''))
+        if not (transfer_syntax.is_transfer_syntax
+                and transfer_syntax.is_little_endian
+                and not transfer_syntax.is_deflated):
+            raise UnsupportedDicom(
+                'Unsupported transfer syntax {}'.format(transfer_syntax))
+        implicit = transfer_syntax.is_implicit_VR
+        elements = list(
+            _iter_elements(buf, dataset_offset, len(buf), implicit))
+    except struct.error:
+        raise UnsupportedDicom('Truncated data')
+
+    dcm = Dataset(_raw_elements(buf, elements, implicit))
+    dcm.file_meta = file_meta
+    vrs = {tag: vr for tag, vr, _, _, _ in meta + elements}
+
+    remove = plan.remove_set
+    new_meta, new_elements = {}, {}
+    for step in plan.steps:
+        tag = step.tag
+        if tag in remove:
+            continue
+        vr = vrs.get(tag, None)
+        vr = vr.decode('ascii') if vr else step.VR
+        if step.is_callable:
+            encoded = _encode_element(tag, vr, step.value(dcm), implicit
+                                      and not step.is_meta)
+        else:
+            key = (tag, vr, implicit)
+            encoded = plan.encoded.get(key, None)
+            if encoded is None:
+                encoded = _encode_element(tag, vr, step.value, implicit
+                                          and not step.is_meta)
+                plan.encoded[key] = encoded
+        if step.is_meta:
+            new_meta[tag] = encoded
+        else:
+            new_elements[tag] = encoded
+
+    meta_chunks = _rewrite_group(buf, [e for e in meta if e[0] != 0x00020000],
+                                 new_meta, remove, False)
+    meta_length = sum(len(chunk) for chunk in meta_chunks)
+    chunks = [buf[:PREAMBLE_LENGTH],
+              struct.pack('<HH2sHL', 0x0002, 0x0000, b'UL', 4, meta_length)]
+    chunks += meta_chunks
+    chunks += _rewrite_group(buf, elements, new_elements, remove, implicit)
+    return b''.join(chunks)
+
+
+def anonymized_bytes(data, plan: AnonymizationPlan):
+    '''
+    Return data with the plan applied. Falls back to pydicom if rewrite_bytes does not support data.
+    '''
+    try:
+        return rewrite_bytes(data, plan)
+    except UnsupportedDicom:
+        dcm = pydicom.dcmread(io.BytesIO(data), force=True)
+        return dcm2bytes(plan.apply(dcm))
+
+
+def _dataset_start(buf):
+    '''
+    Return (transfer syntax, offset of the dataset) of a DICOM file,
+    or None if it has no DICM prefix or is not little endian.
+    '''
+    if len(buf) < PREAMBLE_LENGTH or bytes(buf[128:132]) != b'DICM':
+        return None
+    # the dataset may not be explicit VR, so the file meta is bounded by its group length
+    first = next(_iter_elements(buf, PREAMBLE_LENGTH, len(buf), False),
+                 None)
+    if first is None or first[0] != META_GROUP_LENGTH_TAG:
+        return None
+    _, _, _, value, end = first
+    dataset_offset = end + struct.unpack_from('<L', buf, value)[0]
+    transfer_syntax = None
+    for tag, _, _, value, end in _iter_elements(buf, end, dataset_offset,
+                                                False):
+        if tag == TRANSFER_SYNTAX_TAG:
+            transfer_syntax = UID(
+                bytes(buf[value:end]).rstrip(b'\0 ').decode('ascii'))
+    if transfer_syntax is None or not (transfer_syntax.is_transfer_syntax
+                                       and transfer_syntax.is_little_endian
+                                       and not transfer_syntax.is_deflated):
+        return None
+    return transfer_syntax, dataset_offset
+
+
+def _find_series_uid(buf):
+    '''
+    Return SeriesInstanceUID in the head of a DICOM file or None if it is not found.
+    '''
+    start = _dataset_start(buf)
+    if start is None:
+        return None
+    transfer_syntax, dataset_offset = start
+    for tag, _, _, value, end in _iter_elements(
+            buf, dataset_offset, len(buf), transfer_syntax.is_implicit_VR):
+        if tag == SERIES_UID_TAG:
+            return bytes(buf[value:end]).rstrip(b'\0 ').decode('ascii')
+        if tag > SERIES_UID_TAG:
+            return None
+    return None
+
+
+def read_series_uid(filename):
+    '''
+    Read SeriesInstanceUID from the first HEADER_SIZE bytes of a DICOM file.
+    pydicom is used if the element is not found in them.
+    '''
+    with open(filename, 'rb') as f:
+        buf = f.read(HEADER_SIZE)
+    try:
+        series_uid = _find_series_uid(memoryview(buf))
+    except (UnsupportedDicom, struct.error, UnicodeDecodeError):
+        series_uid = None
+    if series_uid is None:
+        dcm = pydicom.dcmread(filename,
+                              specific_tags=['SeriesInstanceUID'],
+                              stop_before_pixels=True)
+        series_uid = dcm.SeriesInstanceUID
+    return series_uid
+
+
+def is_complete(filename):
+    '''
+    Return True if no element of a DICOM file is cut off by the end of the file
+    (e.g. Pixel Data of a partially received instance).
+    Values are skipped without being read. pydicom reads the file if it is not little endian.
+    '''
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < PREAMBLE_LENGTH:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as buf:
+                try:
+                    start = _dataset_start(buf)
+                    if start is not None:
+                        transfer_syntax, dataset_offset = start
+                        for _ in _iter_elements(
+                                buf, dataset_offset, len(buf),
+                                transfer_syntax.is_implicit_VR):
+                            pass
+                        return True
+                except (UnsupportedDicom, struct.error):
+                    return False
+    dcm = pydicom.dcmread(filename, force=True)
+    for elem in dcm.elements():
+        if isinstance(elem, RawDataElement) and elem.length != UNDEFINED_LENGTH \
+                and len(elem.value or b'') < elem.length:
+            return False
+    return True
+
+
+def index_series(dirname, workers=8):
+    '''
+    Group DICOM files in dirname by SeriesInstanceUID without moving them.
+
+    Returns:
+        dict: SeriesInstanceUID -> list of sorted filenames
+    '''
+    with os.scandir(dirname) as it:
+        fns = sorted(entry.path for entry in it if entry.is_file())
+    with ThreadPoolExecutor(workers) as pool:
+        series_uids = list(pool.map(read_series_uid, fns))
+    index = {}
+    for fn, series_uid in zip(fns, series_uids):
+        index.setdefault(series_uid, []).append(fn)
+    return index
+
+
+class DcmBytesGeneratorFN(object):
+    '''
+    Same as DcmGeneratorFN but returns encoded files rewritten by rewrite_bytes.
+    '''
+    def __init__(self, fns, replace_rules, remove_rules):
+        self.fns = fns
+        self.length = len(fns)
+        self.plan = AnonymizationPlan(replace_rules, remove_rules)
+        self._i = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._i == self.length:
+            raise StopIteration()
+
+        with open(self.fns[self._i], 'rb') as f:
+            data = f.read()
 
         self._i += 1
-        return dcm
+        return anonymized_bytes(data, self.plan)
@@ -0,0 +1,141 @@
+import time
+import threading
+
+from logzero import logger as default_logger
+
+
+class ServerStats():
+    def __init__(self, server, aec, port):
+        self.server = server
+        self.aec = aec
+        self.port = port
+        self.in_flight = 0
+        self.n_jobs = 0
+        self.seconds_per_instance = None  # EWMA
+        self.latency = None  # EWMA of seconds before retrieval starts
+        self.error_rate = 0.  # EWMA
+        self.down_until = 0.
+
+    def __repr__(self):
+        return '{}:{}({}) in_flight={} jobs={} s/instance={} latency={} error_rate={:.2f}'.format(
+            self.server, self.port, self.aec, self.in_flight, self.n_jobs,
+            self.seconds_per_instance, self.latency, self.error_rate)
+
+
+def _ewma(old, new, alpha):
+    if old is None:
+        return new
+    return alpha * new + (1 - alpha) * old
+
+
+class Dispatcher():
+    def __init__(self,
+                 servers,
+                 alpha=0.3,
+                 cooldown=60,
+                 clock=time.monotonic,
+                 logger=None):
+        '''
+        Assign jobs to the server expected to finish them first.
+
+        Args:
+            servers (list): (server, aec, port) of each DICOM server.
+            alpha (float): Smoothing factor of the measurements.
+            cooldown (float): Servers that refused an association are skipped for this many seconds.
+            clock (callable): Returns current time in seconds.
+        '''
+        self.stats = [ServerStats(*s) for s in servers]
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self.clock = clock
+        self.logger = logger or default_logger
+        self.instances_per_job = None  # EWMA over all servers
+        self._lock = threading.Lock()
+
+    def _expected_seconds(self, stats):
+        '''
+        Expected seconds to finish one more job on the server.
+        Servers without measurement are assumed to be as fast as the fastest one.
+        '''
+        measured = [
+            s for s in self.stats if s.seconds_per_instance is not None
+        ]
+        if stats.seconds_per_instance is not None:
+            per_instance, latency = stats.seconds_per_instance, stats.latency
+        elif measured:
+            per_instance = min(s.seconds_per_instance for s in measured)
+            latency = min(s.latency for s in measured)
+        else:
+            per_instance, latency = 0., 0.
+        job_seconds = latency + per_instance * (self.instances_per_job or 1)
+        success_rate = max(1 - stats.error_rate, 0.05)
+        return (job_seconds + 1e-3) * (stats.in_flight + 1) / success_rate
+
+    def acquire(self, exclude=()):
+        '''
+        Choose a server for a job and return its index.
+        Servers in cooldown are chosen only when all servers are in cooldown.
+
+        Args:
+            exclude (list): Indices of servers to avoid (e.g. already failed for the job).
+        '''
+        with self._lock:
+            now = self.clock()
+            candidates = [
+                i for i in range(len(self.stats)) if i not in exclude
+            ] or list(range(len(self.stats)))
+            up = [i for i in candidates if self.stats[i].down_until <= now]
+            if up:
+                index = min(
+                    up, key=lambda i: self._expected_seconds(self.stats[i]))
+            else:
+                index = min(candidates, key=lambda i: self.stats[i].down_until)
+            self.stats[index].in_flight += 1
+            return index
+
+    def release(self,
+                index,
+                seconds=None,
+                n_instances=None,
+                latency=None,
+                error=False,
+                refused=False):
+        '''
+        Report the end of a job.
+
+        Args:
+            seconds (float): Total seconds of the job.
+            n_instances (int): Number of retrieved instances.
+            latency (float): Seconds before the retrieval started.
+            error (bool): The job failed.
+            refused (bool): The server did not accept an association. The server is put in cooldown.
+        '''
+        with self._lock:
+            stats = self.stats[index]
+            stats.in_flight -= 1
+            stats.n_jobs += 1
+            stats.error_rate = _ewma(stats.error_rate,
+                                     1. if error or refused else 0.,
+                                     self.alpha)
+            if refused:
+                stats.down_until = self.clock() + self.cooldown
+                self.logger.warning('%s:%s is unavailable for %d seconds',
+                                    stats.server, stats.port, self.cooldown)
+            elif not error:
+                stats.down_until = 0.
+                if latency is not None:
+                    stats.latency = _ewma(stats.latency, latency, self.alpha)
+                if seconds is not None and n_instances:
+                    if stats.latency is None:
+                        stats.latency = 0.
+                    per_instance = max(seconds -
+                                       (latency or 0.), 0.) / n_instances
+                    stats.seconds_per_instance = _ewma(
+                        stats.seconds_per_instance, per_instance, self.alpha)
+                    self.instances_per_job = _ewma(self.instances_per_job,
+                                                   n_instances, self.alpha)
+            self.logger.debug('%s', stats)
+
+    def server(self, index):
+        stats = self.stats[index]
+        return stats.server, stats.aec, stats.port
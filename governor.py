@@ -0,0 +1,102 @@
+import os
+import shutil
+import threading
+from pathlib import Path
+from logzero import logger as default_logger
+
+
+def _existing_parent(path: Path):
+    path = Path(path).absolute()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+class DiskGovernor():
+    '''
+    Tell if a new job may start from the free space of filesystems.
+    Estimated sizes of the running jobs are subtracted from the free space of every watched filesystem,
+    since retrieved instances are written to the temp directory and then to the output directory.
+
+    Args:
+        paths (list): Directories on the watched filesystems. They may not exist yet.
+        reserve (int): Bytes kept free on each filesystem.
+        instance_size (int): Initial estimate of bytes per instance. Updated by observe().
+        study_instances (int): Initial estimate of instances per study whose series are not known in advance. Updated by observe().
+    '''
+    def __init__(self,
+                 paths,
+                 reserve,
+                 instance_size=512 * 1024,
+                 study_instances=100,
+                 logger=None):
+        self.paths = [Path(p) for p in paths]
+        self.reserve = reserve
+        self.instance_size = instance_size
+        self.study_instances = study_instances
+        self.pending = 0  # estimated bytes of running jobs
+        self.logger = logger or default_logger
+        self.lock = threading.Lock()
+        self._ok = True
+
+    def estimate(self, n_instances=None):
+        '''
+        Estimate bytes of a study
+
+        Args:
+            n_instances (int): Num of instances of the study. None if unknown.
+        '''
+        if n_instances is None:
+            n_instances = self.study_instances
+        return int(n_instances * self.instance_size)
+
+    def acquire(self, n_bytes):
+        with self.lock:
+            self.pending += n_bytes
+
+    def release(self, n_bytes):
+        with self.lock:
+            self.pending -= n_bytes
+
+    def observe(self, n_bytes, n_instances):
+        '''
+        Update the estimates with a retrieved study
+        '''
+        if n_instances <= 0:
+            return
+        with self.lock:
+            self.instance_size = 0.8 * self.instance_size + 0.2 * n_bytes / n_instances
+            self.study_instances = 0.8 * self.study_instances + 0.2 * n_instances
+
+    def shortages(self):
+        '''
+        Return (path, free bytes, needed bytes) of filesystems without enough free space
+        '''
+        with self.lock:
+            pending = self.pending
+        filesystems = {}  # st_dev -> [path, free, needed]
+        for path in self.paths:
+            path = _existing_parent(path)
+            fs = filesystems.setdefault(
+                os.stat(path).st_dev,
+                [str(path), shutil.disk_usage(path).free, self.reserve])
+            fs[2] += pending
+        return [tuple(fs) for fs in filesystems.values() if fs[1] < fs[2]]
+
+    def is_ok(self):
+        '''
+        Return True if a new job may start. State changes are logged.
+        '''
+        shortages = self.shortages()
+        ok = len(shortages) == 0
+        with self.lock:
+            changed = ok != self._ok
+            self._ok = ok
+        if changed and not ok:
+            for path, free, needed in shortages:
+                self.logger.warning(
+                    'Low disk space on %s (%.1f GB free, %.1f GB needed). Pause',
+                    path, free / 2**30, needed / 2**30)
+        elif changed:
+            self.logger.info('Disk space recovered. Resume')
+        return ok
@@ -17,9 +17,10 @@ from PyQt5.QtGui import QFont
 from PyQt5.QtCore import Qt, QTimer
 
 from widgets import VLine, ClockLabel, TimeEdit
-from autoqr import AutoQR, open_csv, remove_existing, add_datetime
+from autoqr import AutoQR, open_csv, remove_existing, add_datetime, precompute_pseudonyms
 from scheduled_event import Periods
 import utils
+import qr
 from config import settings
 
 MSG_DURATION = 2000
@@ -111,12 +112,20 @@ class MainWindow(QMainWindow):
             logger.info('Input size:%d', len(self.df))
             original_count = len(self.df)
             add_datetime(self.df)
+            logger.info('Precomputed %d pseudonyms',
+                        precompute_pseudonyms(self.df))
             min_date, max_date = min(self.df['datetime']), max(
                 self.df['datetime'])
-            if settings.SKIP_EXISTING_STUDY:
+            # the journal tells finished studies from partial outputs of a crash
+            if settings.SKIP_EXISTING_STUDY and not settings.JOURNAL:
                 self.df = remove_existing(self.df,
                                           Path(self.output_edit.text()))
                 logger.info('Filtered input size:%s', len(self.df))
+            self.autoqr = AutoQR(self.output_edit.text(), logger)
+            self.autoqr.add_job_done_handler(self._on_job_done)
+            self.autoqr.add_error_handler(self._on_job_done)
+            self.df = self.autoqr.set_df(self.df)
+            if settings.SKIP_EXISTING_STUDY or settings.JOURNAL:
                 self.input_label.setText(
                     'ファイル名：{}\n期間：{} ~ {}\n件数：{}, Skipped：{}'.format(
                         Path(fileName).name,
@@ -128,10 +137,6 @@ class MainWindow(QMainWindow):
                     Path(fileName).name,
                     min_date.date().strftime('%Y/%m/%d'),
                     max_date.date().strftime('%Y/%m/%d'), len(self.df)))
-            self.autoqr = AutoQR(self.output_edit.text(), logger)
-            self.autoqr.add_job_done_handler(self._on_job_done)
-            self.autoqr.add_error_handler(self._on_job_done)
-            self.autoqr.set_df(self.df)
             self.output_button.setEnabled(False)
             self.update_button_state()
 
@@ -222,6 +227,16 @@ class MainWindow(QMainWindow):
         self.periodLabelTimer.timeout.connect(update_period_label)
         self.periodLabelTimer.start(1000)
         self.statusBar().addPermanentWidget(VLine())
+        self.backlogLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.backlogLabel)
+
+        def update_backlog_label():
+            self.backlogLabel.setText('匿名化待ち {}'.format(
+                qr.backlog.status()))
+
+        update_backlog_label()
+        self.periodLabelTimer.timeout.connect(update_backlog_label)
+        self.statusBar().addPermanentWidget(VLine())
         self.statusBar().addPermanentWidget(ClockLabel(self))
 
         self._init_periods()
@@ -274,17 +289,18 @@ def main():
         font.setStyleHint(QFont.Monospace)
         app.setFont(font)
 
-    try:
-        subprocess.check_call(
-            [str(Path(settings.DCMTK_BINDIR) / 'movescu'), '-h'],
-            stdout=subprocess.DEVNULL)
-    except Exception as e:
-        logger.error(e)
-        dialog = QErrorMessage()
-        dialog.setWindowTitle('dcmtk エラー')
-        dialog.showMessage(str(e))
-        app.exec_()
-        return 1
+    if settings.RETRIEVE_METHOD == 'dcmtk':
+        try:
+            subprocess.check_call(
+                [str(Path(settings.DCMTK_BINDIR) / 'movescu'), '-h'],
+                stdout=subprocess.DEVNULL)
+        except Exception as e:
+            logger.error(e)
+            dialog = QErrorMessage()
+            dialog.setWindowTitle('dcmtk エラー')
+            dialog.showMessage(str(e))
+            app.exec_()
+            return 1
 
     if args.logfile and args.logfile != '-':
         logzero.logfile(args.logfile, maxBytes=1e7, backupCount=256)
@@ -304,6 +320,18 @@ def main():
         print('Server config error')
         return 1
 
+    if not settings.validate_retrieve_method():
+        print('Invalid RETRIEVE_METHOD')
+        return 1
+
+    if not settings.validate_anonymize_backend():
+        print('Invalid ANONYMIZE_BACKEND')
+        return 1
+
+    if not settings.validate_output_format():
+        print('Invalid OUTPUT_FORMAT')
+        return 1
+
     if len(settings.RECEIVE_PORTS) > settings.N_THREADS:
         logger.warning('N_THREADS < available ports (%s and %s)',
                        len(settings.RECEIVE_PORTS), settings.N_THREADS)
@@ -313,6 +341,7 @@ def main():
     window = MainWindow()
     window.show()
     app.exec_()
+    qr.shutdown()  # release pooled associations
 
     return 0
 
@@ -0,0 +1,117 @@
+import time
+import sqlite3
+import threading
+
+# states of a job in the order of progress
+QUEUED = 'queued'
+QUERIED = 'queried'
+RETRIEVED = 'retrieved'
+ANONYMIZED = 'anonymized'
+FAILED = 'failed'
+
+# states that may be overwritten by each state. Finished studies are never moved back
+EARLIER_STATES = {
+    QUEUED: (),
+    QUERIED: (QUEUED, ),
+    RETRIEVED: (QUEUED, QUERIED),
+    ANONYMIZED: (QUEUED, QUERIED, RETRIEVED),
+    FAILED: (QUEUED, QUERIED, RETRIEVED),
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    study_uid TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    accession_number TEXT NOT NULL,
+    state TEXT NOT NULL,
+    reason TEXT NOT NULL DEFAULT '',
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+'''
+
+
+class Journal():
+    def __init__(self, filename):
+        '''
+        Durable state of each job (row of the input list) keyed by StudyInstanceUID.
+
+        Args:
+            filename: SQLite filename. Typically in the output directory.
+        '''
+        self.filename = str(filename)
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def states(self, study_uids):
+        '''
+        Returns:
+            dict: StudyInstanceUID -> (state, reason) of the journaled studies
+        '''
+        study_uids = list(study_uids)
+        conn = self._conn()
+        states = {}
+        for i in range(0, len(study_uids), 500):
+            chunk = study_uids[i:i + 500]
+            for study_uid, state, reason in conn.execute(
+                    'SELECT study_uid, state, reason FROM jobs WHERE study_uid IN ({})'
+                    .format(','.join('?' * len(chunk))), chunk):
+                states[study_uid] = (state, reason)
+        return states
+
+    def queue(self, jobs):
+        '''
+        Record jobs as queued. States of journaled jobs are reset.
+
+        Args:
+            jobs (iterable): (PatientID, AccessionNumber, StudyInstanceUID)
+        '''
+        now = time.time()
+        with self._conn() as conn:
+            conn.executemany(
+                'INSERT INTO jobs (study_uid, patient_id, accession_number, state, reason, updated_at) '
+                'VALUES (?, ?, ?, ?, \'\', ?) ON CONFLICT (study_uid) DO UPDATE SET '
+                'state = excluded.state, reason = \'\', updated_at = excluded.updated_at',
+                [(suid, pid, an, QUEUED, now) for pid, an, suid in jobs])
+
+    def update(self, study_uid, state, reason=''):
+        '''
+        Move the study forward to state. Updates to an earlier state
+        (e.g. a late 'retrieved' after 'anonymized') are ignored.
+
+        Returns:
+            bool: True if the state was updated
+        '''
+        earlier = EARLIER_STATES[state]
+        if len(earlier) == 0:
+            return False
+        with self._conn() as conn:
+            cursor = conn.execute(
+                'UPDATE jobs SET state = ?, reason = ?, updated_at = ? '
+                'WHERE study_uid = ? AND state IN ({})'.format(','.join(
+                    '?' * len(earlier))),
+                (state, str(reason), time.time(), study_uid) + earlier)
+        return cursor.rowcount > 0
+
+    def counts(self):
+        '''
+        Returns:
+            dict: state -> num of jobs
+        '''
+        return dict(self._conn().execute(
+            'SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
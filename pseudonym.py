@@ -0,0 +1,139 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pseudonyms (
+    kind TEXT NOT NULL,
+    original TEXT NOT NULL,
+    pseudonym TEXT NOT NULL,
+    PRIMARY KEY (kind, original)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+
+class PseudonymRegistry():
+    def __init__(self, filename='', maxsize=1000000, fingerprint=''):
+        '''
+        Pseudonyms of original values kept in an LRU cache backed by an on-disk store.
+
+        Args:
+            filename: SQLite filename. Empty to keep pseudonyms in memory only.
+            maxsize (int): Maximum num of pseudonyms in the LRU cache.
+            fingerprint (str): Value derived from the salt. The store raises RuntimeError if it was created with another fingerprint.
+        '''
+        self.filename = str(filename)
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if self.filename:
+            conn = self._conn()
+            conn.executescript(SCHEMA)
+            with conn:
+                conn.execute(
+                    'INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)',
+                    ('fingerprint', fingerprint))
+            stored, = conn.execute(
+                'SELECT value FROM meta WHERE key = ?',
+                ('fingerprint', )).fetchone()
+            if stored != fingerprint:
+                raise RuntimeError(
+                    'Pseudonym registry {} was created with another salt'.
+                    format(self.filename))
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _cache_get(self, key):
+        with self._lock:
+            value = self._cache.get(key, None)
+            if value is not None:
+                self._cache.move_to_end(key)
+            return value
+
+    def _cache_put(self, items):
+        with self._lock:
+            for key, value in items:
+                self._cache[key] = value
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def get(self, kind, original, compute):
+        '''
+        Return the pseudonym of original. compute() is called only if it is not registered yet.
+
+        Args:
+            kind (str): Kind of the value (e.g. 'PatientID').
+            compute (callable): Function that returns the pseudonym.
+        '''
+        key = (kind, original)
+        pseudonym = self._cache_get(key)
+        if pseudonym is not None:
+            return pseudonym
+        if self.filename:
+            row = self._conn().execute(
+                'SELECT pseudonym FROM pseudonyms WHERE kind = ? AND original = ?',
+                key).fetchone()
+            if row is not None:
+                self._cache_put([(key, row[0])])
+                return row[0]
+        pseudonym = compute()
+        if self.filename:
+            with self._conn() as conn:
+                conn.execute(
+                    'INSERT OR IGNORE INTO pseudonyms (kind, original, pseudonym) VALUES (?, ?, ?)',
+                    (kind, original, pseudonym))
+        self._cache_put([(key, pseudonym)])
+        return pseudonym
+
+    def precompute(self, kind, originals, compute):
+        '''
+        Register pseudonyms of many values at once and load them into the LRU cache.
+
+        Args:
+            compute (callable): Function that takes an original value and returns the pseudonym.
+        Returns:
+            int: Num of computed pseudonyms.
+        '''
+        originals = list(dict.fromkeys(originals))
+        found = {}
+        if self.filename:
+            conn = self._conn()
+            for i in range(0, len(originals), 500):
+                chunk = originals[i:i + 500]
+                found.update(
+                    conn.execute(
+                        'SELECT original, pseudonym FROM pseudonyms WHERE kind = ? AND original IN ({})'
+                        .format(','.join('?' * len(chunk))), [kind] + chunk))
+        missing = [
+            (original, compute(original)) for original in originals
+            if original not in found
+        ]
+        if self.filename and len(missing) > 0:
+            with conn:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO pseudonyms (kind, original, pseudonym) VALUES (?, ?, ?)',
+                    [(kind, original, pseudonym)
+                     for original, pseudonym in missing])
+        found.update(missing)
+        self._cache_put(((kind, original), found[original])
+                        for original in originals[-self.maxsize:])
+        return len(missing)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
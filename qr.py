@@ -1,39 +1,153 @@
+import os
+import time
 from pathlib import Path
+import shutil
 import subprocess
 import tempfile
 import logging
-import shutil
+import uuid
+from threading import Lock
+from functools import partial
 from collections import namedtuple
+from queue import Queue, Empty
+import multiprocessing
+from concurrent.futures import Future
 from concurrent.futures.thread import ThreadPoolExecutor
+from concurrent.futures.process import ProcessPoolExecutor
 
 import pydicom
 from pydicom.dataset import Dataset
-from pynetdicom import AE
-from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelFind
+from pynetdicom import evt, build_context, build_role, StoragePresentationContexts, ALL_TRANSFER_SYNTAXES
+from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelFind, PatientRootQueryRetrieveInformationModelMove, PatientRootQueryRetrieveInformationModelGet, StudyRootQueryRetrieveInformationModelFind
 from logzero import setup_logger
 
 from config import settings
+from assoc_pool import AssociationPool, AssociationError
+from catalog import Catalog
+import storage_scp
 import anonymize
-import hash_utils
+import dcm_utils
+import sink
+import utils
 
 default_logger = setup_logger()
 default_logger.setLevel(logging.DEBUG)
 
 logging.getLogger('pynetdicom').setLevel(logging.WARNING)
 
-thread_pool = ThreadPoolExecutor(max_workers=settings.N_THREADS)
+
+def _anonymize_pool():
+    '''
+    Executor for anonymization selected by settings.ANONYMIZE_BACKEND
+    '''
+    if settings.ANONYMIZE_BACKEND == 'process':
+        # spawn to avoid forking a process that runs network threads
+        return ProcessPoolExecutor(
+            max_workers=settings.ANONYMIZE_WORKERS or os.cpu_count(),
+            mp_context=multiprocessing.get_context('spawn'))
+    return ThreadPoolExecutor(max_workers=settings.ANONYMIZE_WORKERS
+                              or settings.N_THREADS)
+
+
+anonymize_pool = _anonymize_pool()
+
+# studies retrieved into temp directories and not anonymized yet
+backlog = utils.Backlog(
+    settings.MAX_PENDING_STUDIES or 2 * settings.N_THREADS,
+    settings.MAX_PENDING_MB * 2**20)
+
+# studies staged in memory. Only bytes are limited
+memory_budget = utils.Backlog(max_bytes=settings.MEMORY_STAGING_MB * 2**20)
+
+find_pool = AssociationPool([
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind
+],
+                            max_per_server=settings.MAX_ASSOCIATIONS,
+                            idle_timeout=settings.ASSOCIATION_IDLE_TIMEOUT,
+                            logger=default_logger)
+
+# each worker has at most SERIES_SPLIT moves (or gets) in flight
+move_pool = AssociationPool([PatientRootQueryRetrieveInformationModelMove],
+                            max_per_server=settings.N_THREADS *
+                            max(settings.SERIES_SPLIT, 1),
+                            idle_timeout=settings.ASSOCIATION_IDLE_TIMEOUT,
+                            logger=default_logger)
+
+# C-GET receives instances on the same association.
+# Storage contexts propose all transfer syntaxes so that compressed instances are sent as they are
+get_router = storage_scp.StorageRouter(default_logger)
+get_pool = AssociationPool(
+    [PatientRootQueryRetrieveInformationModelGet] + [
+        build_context(cx.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+        for cx in StoragePresentationContexts
+    ],
+    max_per_server=settings.N_THREADS * max(settings.SERIES_SPLIT, 1),
+    idle_timeout=settings.ASSOCIATION_IDLE_TIMEOUT,
+    ext_neg=[
+        build_role(cx.abstract_syntax, scp_role=True)
+        for cx in StoragePresentationContexts
+    ],
+    evt_handlers=[(evt.EVT_C_STORE, get_router.handle_store)],
+    logger=default_logger)
 
 ConnectionInformation = namedtuple(
     'ConnectionInformation', ['server', 'aec', 'port', 'aet', 'receive_port'])
 
+# (aet, receive_port) pairs not assigned to workers. Used by retrieve_split with dcmtk.
+spare_receivers = Queue()
+for pair in list(zip(settings.AETS,
+                     settings.RECEIVE_PORTS))[settings.N_THREADS:]:
+    spare_receivers.put(pair)
 
-def query(ds: Dataset, conn_info: ConnectionInformation = None, logger=None):
+# on-disk catalog of C-FIND results
+catalog = Catalog(settings.CATALOG,
+                  max_age=settings.CATALOG_MAX_AGE * 3600,
+                  recent_days=settings.CATALOG_RECENT_DAYS,
+                  limit=settings.QUERY_LIMIT) if settings.CATALOG else None
+
+
+def _iter_find(ds: Dataset, conn_info: ConnectionInformation, logger, model):
+    '''
+    Yield identifiers as C-FIND pending responses arrive.
+    The association goes back to the pool when all responses are consumed
+    and is aborted when the generator is closed before that.
+    '''
+    logger.debug('start query')
+    count = 0
+
+    # C-FIND is always requested with the first AET
+    with find_pool.acquire(conn_info._replace(aet=settings.AETS[0])) as assoc:
+        responses = assoc.send_c_find(ds, model)
+        for (status, identifier) in responses:
+            if not status:
+                raise RuntimeError(
+                    'Connection timed out, was aborted or received invalid response'
+                )
+            if status.Status == 0xFF00:
+                count += 1
+                yield identifier
+
+    logger.debug('end query %d', count)
+
+
+def iter_query(ds: Dataset,
+               conn_info: ConnectionInformation = None,
+               logger=None,
+               model=PatientRootQueryRetrieveInformationModelFind,
+               offline=False,
+               refresh=False):
     '''
+    Yield identifiers of C-FIND.
+    Fresh results are answered from the catalog when CATALOG is set.
+
     Args:
         conn_info (ConnectionInformation): Only aec and port are required.
+        model: Query/Retrieve information model for C-FIND.
+        offline (bool): Query the catalog only.
+        refresh (bool): Query the server even if the catalog has fresh results (e.g. to retrieve what the server has now). The results are stored in the catalog.
     '''
     logger = logger or default_logger
-    logger.debug('start query')
     if conn_info is None:
         conn_info = ConnectionInformation(
             server=settings.DICOM_SERVERS[0],
@@ -41,38 +155,46 @@ def query(ds: Dataset, conn_info: ConnectionInformation = None, logger=None):
             port=settings.PORTS[0],
             aet=settings.AETS[0],
             receive_port=settings.RECEIVE_PORTS[0])
-    ae = AE(ae_title=settings.AETS[0])
-    ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
-    ae.associate(conn_info.server, conn_info.port, ae_title=conn_info.aec)
-    if len(ae.active_associations) == 0:
-        raise RuntimeError('No association was established')
-    assoc = ae.active_associations[0]
-    if not assoc.is_established:
-        raise RuntimeError('Association rejected, aborted or never connected')
-
-    datasets = []
-
-    responses = assoc.send_c_find(
-        ds, PatientRootQueryRetrieveInformationModelFind)
-    for (status, identifier) in responses:
-        if not status:
-            raise RuntimeError(
-                'Connection timed out, was aborted or received invalid response'
-            )
-        if status.Status == 0xFF00:
-            datasets.append(identifier)
 
-    assoc.release()
-    logger.debug('end query %d', len(datasets))
-    return datasets
+    def fetch(query_ds):
+        return _iter_find(query_ds, conn_info, logger, model)
+
+    if catalog is None:
+        if offline:
+            raise RuntimeError('Offline query requires CATALOG config')
+        return fetch(ds)
+    return catalog.iter_query(ds, fetch, offline=offline, refresh=refresh)
 
 
-def retrieve_dcmtk(ds, outdir, conn_info: ConnectionInformation, logger=None):
+def query(ds: Dataset,
+          conn_info: ConnectionInformation = None,
+          logger=None,
+          model=PatientRootQueryRetrieveInformationModelFind,
+          offline=False,
+          refresh=False):
+    '''
+    Same as iter_query but return all identifiers as a list.
+    '''
+    return list(iter_query(ds, conn_info, logger, model, offline, refresh))
+
+
+# max num of SOPInstanceUIDs in a movescu command line. Windows limits a command line to 32767 characters
+DCMTK_MAX_UIDS = 200
+
+
+def retrieve_dcmtk(ds,
+                   outdir,
+                   conn_info: ConnectionInformation,
+                   logger=None,
+                   handler=None):
     '''
     Retrieve using dcmtk.
     dcmtk is used because retrieving with pynetdicom is slow on a laptop for some reason.
+    handler is not supported since movescu writes instances into outdir.
     '''
     logger = logger or default_logger
+    if handler is not None:
+        raise ValueError('C-STORE handler is not supported by dcmtk')
     series_uid = ds.SeriesInstanceUID
     if not isinstance(series_uid, str):
         series_uid = '\\'.join(series_uid)
@@ -85,24 +207,357 @@ def retrieve_dcmtk(ds, outdir, conn_info: ConnectionInformation, logger=None):
     pid_arg = '-k 0010,0020={}'.format(ds.PatientID)
     study_arg = '-k 0020,000D={}'.format(ds.StudyInstanceUID)
     series_arg = '-k 0020,000E={}'.format(series_uid)
+    sop_args = ['']
+    if 'SOPInstanceUID' in ds:
+        level_arg = '-k 0008,0052=IMAGE'
+        sop_uids = ds.SOPInstanceUID
+        if isinstance(sop_uids, str):
+            sop_uids = sop_uids.split('\\')
+        # one movescu per batch to keep the command line short
+        sop_args = [
+            '-k 0008,0018={}'.format('\\'.join(
+                sop_uids[i:i + DCMTK_MAX_UIDS]))
+            for i in range(0, len(sop_uids), DCMTK_MAX_UIDS)
+        ]
     od_arg = '-od {}'.format(outdir)
 
-    args = sum([
-        base_arg.split(),
-        '+P {}'.format(conn_info.receive_port).split(),
-        level_arg.split(),
-        pid_arg.split(),
-        study_arg.split(),
-        series_arg.split(),
-        od_arg.split(),
-    ], [])
+    for sop_arg in sop_args:
+        args = sum([
+            base_arg.split(),
+            '+P {}'.format(conn_info.receive_port).split(),
+            level_arg.split(),
+            pid_arg.split(),
+            study_arg.split(),
+            series_arg.split(),
+            sop_arg.split(),
+            od_arg.split(),
+        ], [])
+
+        logger.debug(' '.join(args))
+        subprocess.check_call(args)
+
+    logger.debug('end retrieve %s', ds.SeriesInstanceUID)
+
+
+def check_retrieve_responses(responses, name):
+    '''
+    Consume C-MOVE/C-GET responses and raise RuntimeError on failure.
+    '''
+    for (status, identifier) in responses:
+        if not status:
+            raise RuntimeError(
+                'Connection timed out, was aborted or received invalid response'
+            )
+        if status.Status in (0xFF00, 0xFF01):
+            continue
+        if status.Status == 0x0000:
+            return
+        if status.Status == 0xB000:
+            raise RuntimeError(
+                '{} completed with {} failed sub-operations'.format(
+                    name, status.get('NumberOfFailedSuboperations', '?')))
+        raise RuntimeError('{} failed with status 0x{:04X}'.format(
+            name, status.Status))
+
+
+def _retrieve_dataset(ds):
+    '''
+    Return (list of SeriesInstanceUIDs, identifier for SERIES level C-MOVE/C-GET)
+    The identifier is IMAGE level if ds has SOPInstanceUID.
+    '''
+    series_uid = ds.SeriesInstanceUID
+    if isinstance(series_uid, str):
+        series_uid = series_uid.split('\\')
+    series_uid = list(series_uid)
+
+    retrieve_ds = Dataset()
+    retrieve_ds.QueryRetrieveLevel = 'SERIES'
+    retrieve_ds.PatientID = ds.PatientID
+    retrieve_ds.StudyInstanceUID = ds.StudyInstanceUID
+    retrieve_ds.SeriesInstanceUID = series_uid
+    if 'SOPInstanceUID' in ds:
+        sop_uid = ds.SOPInstanceUID
+        if isinstance(sop_uid, str):
+            sop_uid = sop_uid.split('\\')
+        retrieve_ds.QueryRetrieveLevel = 'IMAGE'
+        retrieve_ds.SOPInstanceUID = list(sop_uid)
+    return series_uid, retrieve_ds
+
+
+def retrieve_move(ds,
+                  outdir,
+                  conn_info: ConnectionInformation,
+                  logger=None,
+                  handler=None):
+    '''
+    Retrieve using C-MOVE over a pooled association.
+    Instances are received by the storage SCP that keeps listening on conn_info.receive_port.
+
+    Args:
+        handler (callable): C-STORE handler for received instances. Instances are saved in outdir if None.
+    '''
+    logger = logger or default_logger
+    series_uid, move_ds = _retrieve_dataset(ds)
+    logger.debug('start retrieve %s', '\\'.join(series_uid))
+
+    server = storage_scp.get_server(conn_info.receive_port, conn_info.aet,
+                                    logger)
+    with server.router.route(
+            series_uid, handler or storage_scp.save_to_directory(outdir)):
+        with move_pool.acquire(conn_info) as assoc:
+            responses = assoc.send_c_move(
+                move_ds, conn_info.aet,
+                PatientRootQueryRetrieveInformationModelMove)
+            check_retrieve_responses(responses, 'C-MOVE')
+
+    logger.debug('end retrieve %s', ds.SeriesInstanceUID)
+
+
+def retrieve_get(ds,
+                 outdir,
+                 conn_info: ConnectionInformation,
+                 logger=None,
+                 handler=None):
+    '''
+    Retrieve using C-GET over a pooled association.
+    Instances come back on the same association, so conn_info.receive_port is not used.
+
+    Args:
+        handler (callable): C-STORE handler for received instances. Instances are saved in outdir if None.
+    '''
+    logger = logger or default_logger
+    series_uid, get_ds = _retrieve_dataset(ds)
+    logger.debug('start retrieve %s', '\\'.join(series_uid))
 
-    logger.debug(' '.join(args))
-    subprocess.check_call(args)
+    with get_router.route(series_uid, handler
+                          or storage_scp.save_to_directory(outdir)):
+        with get_pool.acquire(conn_info) as assoc:
+            responses = assoc.send_c_get(
+                get_ds, PatientRootQueryRetrieveInformationModelGet)
+            check_retrieve_responses(responses, 'C-GET')
 
     logger.debug('end retrieve %s', ds.SeriesInstanceUID)
 
 
+RETRIEVE_METHODS = {
+    'dcmtk': retrieve_dcmtk,
+    'move': retrieve_move,
+    'get': retrieve_get,
+}
+
+
+def retrieve(ds,
+             outdir,
+             conn_info: ConnectionInformation,
+             logger=None,
+             handler=None):
+    '''
+    Retrieve with the method selected by settings.RETRIEVE_METHOD
+    '''
+    return RETRIEVE_METHODS[settings.RETRIEVE_METHOD](ds,
+                                                      outdir,
+                                                      conn_info,
+                                                      logger=logger,
+                                                      handler=handler)
+
+
+def n_instances(ds: Dataset, default=1):
+    '''
+    Return NumberOfSeriesRelatedInstances of the identifier, or default if unknown.
+    '''
+    try:
+        return int(ds.get('NumberOfSeriesRelatedInstances', None) or default)
+    except (TypeError, ValueError):
+        return default
+
+
+def retrieve_split(ds,
+                   outdir,
+                   conn_info: ConnectionInformation,
+                   series,
+                   logger=None,
+                   handler=None):
+    '''
+    Retrieve series of a study in up to settings.SERIES_SPLIT concurrent parts
+    balanced by the number of instances. All parts are saved in outdir (or passed to handler).
+
+    Args:
+        series (list): Series identifiers of ds.SeriesInstanceUID.
+    '''
+    logger = logger or default_logger
+    groups = utils.balanced_split(series, settings.SERIES_SPLIT, n_instances)
+    conn_infos = [conn_info]
+    spare = []
+    if settings.RETRIEVE_METHOD == 'dcmtk':
+        # movescu listens on its own port. Borrow receive ports not used by the workers.
+        for _ in groups[1:]:
+            try:
+                spare.append(spare_receivers.get_nowait())
+            except Empty:
+                break
+        conn_infos += [
+            conn_info._replace(aet=aet, receive_port=port)
+            for aet, port in spare
+        ]
+        groups = utils.balanced_split(series, len(conn_infos), n_instances)
+    else:
+        # instances are routed by SeriesInstanceUID
+        conn_infos = conn_infos * len(groups)
+
+    try:
+        if len(groups) <= 1:
+            return retrieve(ds,
+                            outdir,
+                            conn_info,
+                            logger=logger,
+                            handler=handler)
+        logger.debug('Split %d series into %d parts', len(series), len(groups))
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            futures = []
+            for group, info in zip(groups, conn_infos):
+                part_ds = Dataset()
+                part_ds.PatientID = ds.PatientID
+                part_ds.StudyInstanceUID = ds.StudyInstanceUID
+                part_ds.SeriesInstanceUID = '\\'.join(dcm.SeriesInstanceUID
+                                                      for dcm in group)
+                futures.append(
+                    executor.submit(retrieve,
+                                    part_ds,
+                                    outdir,
+                                    info,
+                                    logger=logger,
+                                    handler=handler))
+            for future in futures:
+                future.result()
+    finally:
+        for pair in spare:
+            spare_receivers.put(pair)
+
+
+def partial_root():
+    return Path(settings.SCRATCH_DIR
+                or tempfile.gettempdir()) / 'autoqr_partial'
+
+
+# partial directories of running jobs
+partial_in_use = set()
+# directories of concurrent jobs, which are not resumed
+partial_private = set()
+partial_lock = Lock()
+
+
+def partial_directory(StudyInstanceUID: str):
+    '''
+    Return the directory that receives instances of the study. It is in use until release_partial_directory.
+    The directory is kept when the retrieval fails so that the next try resumes from it.
+    A job of the same study running at the same time (e.g. a duplicated row) gets a directory of its own,
+    which is removed when it is released.
+    '''
+    with partial_lock:
+        outdir = partial_root() / StudyInstanceUID
+        if outdir in partial_in_use:
+            outdir = partial_root() / '{}_{}'.format(StudyInstanceUID,
+                                                     uuid.uuid4().hex[:8])
+            partial_private.add(outdir)
+        partial_in_use.add(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    return outdir
+
+
+def release_partial_directory(outdir):
+    outdir = Path(outdir)
+    with partial_lock:
+        partial_in_use.discard(outdir)
+        if outdir not in partial_private:
+            return
+        partial_private.discard(outdir)
+    # no later run would find it
+    shutil.rmtree(outdir, ignore_errors=True)
+
+
+def received_instances(outdir, logger=None):
+    '''
+    Return SOPInstanceUIDs of the files in outdir.
+    Unreadable or incomplete (e.g. partially written) files are removed.
+    '''
+    logger = logger or default_logger
+    sop_uids = set()
+    for entry in os.scandir(outdir):
+        if not entry.is_file():
+            continue
+        try:
+            if not dcm_utils.is_complete(entry.path):
+                raise RuntimeError('Truncated file')
+            dcm = pydicom.dcmread(entry.path,
+                                  specific_tags=['SOPInstanceUID'],
+                                  stop_before_pixels=True,
+                                  force=True)
+            sop_uids.add(dcm.SOPInstanceUID)
+        except Exception as e:
+            logger.warning('Remove unreadable file %s (%s)', entry.path, e)
+            os.remove(entry.path)
+    return sop_uids
+
+
+def image_query_dataset(PatientID: str, StudyInstanceUID: str,
+                        SeriesInstanceUID: str):
+    '''
+    Identifier for IMAGE level C-FIND used to resume retrieval
+    '''
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'IMAGE'
+    ds.PatientID = PatientID
+    ds.StudyInstanceUID = StudyInstanceUID
+    ds.SeriesInstanceUID = SeriesInstanceUID
+    ds.SOPInstanceUID = ''
+    return ds
+
+
+def retrieve_missing(series,
+                     outdir,
+                     conn_info: ConnectionInformation,
+                     logger=None,
+                     arrived=None,
+                     handler=None):
+    '''
+    Retrieve only the instances of the series that are not in outdir yet.
+
+    Args:
+        series (list): Series identifiers to retrieve.
+        arrived (set): SOPInstanceUIDs already received. Read from outdir if None.
+        handler (callable): C-STORE handler passed to retrieve.
+    '''
+    logger = logger or default_logger
+    if arrived is None:
+        arrived = received_instances(outdir, logger)
+    n_missing = 0
+    for dcm in series:
+        ds = image_query_dataset(dcm.PatientID, dcm.StudyInstanceUID,
+                                 dcm.SeriesInstanceUID)
+        sop_uids = [
+            identifier.SOPInstanceUID
+            for identifier in iter_query(
+                ds, conn_info, logger=logger, refresh=True)
+        ]
+        missing = [uid for uid in sop_uids if uid not in arrived]
+        if len(missing) == 0:
+            continue
+        n_missing += len(missing)
+        retrieve_ds = Dataset()
+        retrieve_ds.PatientID = dcm.PatientID
+        retrieve_ds.StudyInstanceUID = dcm.StudyInstanceUID
+        retrieve_ds.SeriesInstanceUID = dcm.SeriesInstanceUID
+        if len(missing) < len(sop_uids):
+            retrieve_ds.SOPInstanceUID = '\\'.join(missing)
+        retrieve(retrieve_ds,
+                 outdir,
+                 conn_info,
+                 logger=logger,
+                 handler=handler)
+    logger.info('Resume retrieval: %d instances had arrived, %d retrieved',
+                len(arrived), n_missing)
+
+
 def qr_dcmtk(ds: Dataset,
              outdir,
              conn_info: ConnectionInformation = None,
@@ -128,7 +583,7 @@ def qr_dcmtk(ds: Dataset,
         ds.SeriesInstanceUID = found_ds.SeriesInstanceUID
         series_dir = outdir / found_ds.SeriesInstanceUID
         series_dir.mkdir(parents=True, exist_ok=True)
-        retrieve_dcmtk(ds, series_dir, conn_info, logger=logger)
+        retrieve(ds, series_dir, conn_info, logger=logger)
 
     return found_datasets
 
@@ -149,22 +604,10 @@ def get_output_directory(basedir: Path, year: str, date: str, patient_id: str,
     return zipdir
 
 
-def qr_anonymize_save(PatientID: str,
-                      AccessionNumber: str,
-                      StudyInstanceUID: str,
-                      outdir: str,
-                      conn_info: ConnectionInformation = None,
-                      predicate=None,
-                      logger=None):
+def series_query_dataset(PatientID: str, StudyInstanceUID: str):
     '''
-    Q/R and save
+    Identifier for SERIES level C-FIND used before retrieval
     '''
-    logger = logger or default_logger
-    if conn_info is None:
-        conn_info = ConnectionInformation(settings.DICOM_SERVERS[0],
-                                          settings.AECS[0], settings.PORTS[0],
-                                          settings.AETS[0],
-                                          settings.RECEIVE_PORTS[0])
     ds = Dataset()
     ds.PatientID = PatientID
     ds.StudyDate = ''
@@ -175,59 +618,343 @@ def qr_anonymize_save(PatientID: str,
     ds.StudyInstanceUID = StudyInstanceUID
     ds.SeriesDescription = ''
     ds.SeriesNumber = ''
+    ds.NumberOfSeriesRelatedInstances = ''
+    return ds
+
+
+def study_series_counts(study_uids,
+                        conn_info: ConnectionInformation = None,
+                        logger=None):
+    '''
+    Query NumberOfStudyRelatedSeries of studies with one STUDY level C-FIND using UID list matching.
+
+    Returns:
+        dict: StudyInstanceUID -> num of series, or None if the server did not return the count. Studies not found are not included.
+    '''
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.StudyInstanceUID = '\\'.join(study_uids)
+    ds.NumberOfStudyRelatedSeries = ''
+    counts = {}
+    for identifier in iter_query(
+            ds,
+            conn_info,
+            logger=logger,
+            model=StudyRootQueryRetrieveInformationModelFind):
+        count = identifier.get('NumberOfStudyRelatedSeries', None)
+        counts[identifier.StudyInstanceUID] = int(count) if count not in (
+            None, '') else None
+    return counts
+
+
+# (server, port, aec) that do not return NumberOfStudyRelatedSeries
+unbatched_servers = set()
+
+
+def resolve_series(studies,
+                   conn_info: ConnectionInformation = None,
+                   predicate=None,
+                   logger=None):
+    '''
+    Query series of multiple studies with one C-FIND using UID list matching.
+    The StudyInstanceUID list at SERIES level is not a part of the hierarchical query,
+    so the num of series of each study is checked against NumberOfStudyRelatedSeries.
+    Studies whose series are missing (e.g. results capped by the server) or not countable
+    are queried one by one. A server that does not return the count at all is remembered,
+    and its studies are queried one by one from then on.
 
-    temp = tempfile.mkdtemp()
-    tmp_dir = Path(temp)
-    all_datasets = query(ds, conn_info, logger=logger)
+    Args:
+        studies (list): List of (PatientID, StudyInstanceUID)
+    Returns:
+        dict: StudyInstanceUID -> list of series identifiers that satisfy the predicate.
+              Studies without any result are not included.
+    '''
+    logger = logger or default_logger
+    if conn_info is None:
+        conn_info = ConnectionInformation(settings.DICOM_SERVERS[0],
+                                          settings.AECS[0], settings.PORTS[0],
+                                          settings.AETS[0],
+                                          settings.RECEIVE_PORTS[0])
+    study2pid = {study_uid: pid for pid, study_uid in studies}
+    server_key = (conn_info.server, conn_info.port, conn_info.aec)
+    counts = {}
+    if server_key not in unbatched_servers:
+        counts = study_series_counts(study2pid.keys(),
+                                     conn_info,
+                                     logger=logger)
+        if None in counts.values():
+            logger.info(
+                '%s:%s does not return NumberOfStudyRelatedSeries. Studies are resolved one by one',
+                conn_info.server, conn_info.port)
+            unbatched_servers.add(server_key)
+            counts = {}
+    study2series = {}
+    if len(counts) > 0:
+        ds = series_query_dataset('', '\\'.join(study2pid.keys()))
+        for identifier in iter_query(
+                ds,
+                conn_info,
+                logger=logger,
+                model=StudyRootQueryRetrieveInformationModelFind,
+                refresh=True):
+            pid = study2pid.get(identifier.StudyInstanceUID, None)
+            if pid is None:
+                continue
+            if identifier.get('PatientID', '') == '':
+                identifier.PatientID = pid
+            elif identifier.PatientID != pid:
+                logger.warning('PatientID mismatch for %s',
+                               identifier.StudyInstanceUID)
+                continue
+            study2series.setdefault(identifier.StudyInstanceUID,
+                                    []).append(identifier)
+    n_fallbacks = 0
+    for study_uid, pid in study2pid.items():
+        if len(study2series.get(study_uid, [])) == counts.get(study_uid, -1):
+            continue
+        n_fallbacks += 1
+        datasets = query(series_query_dataset(pid, study_uid),
+                         conn_info,
+                         logger=logger,
+                         refresh=True)
+        if len(datasets) > 0:
+            study2series[study_uid] = datasets
+        else:
+            study2series.pop(study_uid, None)
+    if n_fallbacks > 0:
+        logger.debug('%d of %d studies are resolved one by one', n_fallbacks,
+                     len(study2pid))
+    if predicate is not None:
+        study2series = {
+            study_uid: [ds for ds in datasets if predicate(ds)]
+            for study_uid, datasets in study2series.items()
+        }
+    return study2series
+
+
+def query_series(PatientID: str,
+                 StudyInstanceUID: str,
+                 conn_info: ConnectionInformation = None,
+                 predicate=None,
+                 logger=None):
+    '''
+    Query series of a study and return identifiers that satisfy the predicate.
+    '''
+    logger = logger or default_logger
+    ds = series_query_dataset(PatientID, StudyInstanceUID)
+    all_datasets = query(ds, conn_info, logger=logger, refresh=True)
     if len(all_datasets) == 0:
         raise RuntimeError('No result for query:%{}'.format(ds))
 
     if predicate is not None:
         all_datasets = [ds for ds in all_datasets if predicate(ds)]
         logger.debug('Filtering done %d', len(all_datasets))
+    return all_datasets
+
+
+def qr_anonymize_save(PatientID: str,
+                      AccessionNumber: str,
+                      StudyInstanceUID: str,
+                      outdir: str,
+                      conn_info: ConnectionInformation = None,
+                      predicate=None,
+                      logger=None,
+                      series=None,
+                      stats=None,
+                      on_anonymized=None,
+                      expected_bytes=None,
+                      on_retrieved=None,
+                      replace_outputs=False):
+    '''
+    Q/R and save
+
+    Args:
+        series (list): Series identifiers resolved in advance (e.g. by resolve_series). SERIES level query and predicate are skipped if given.
+        stats (dict): Filled with 'latency' (seconds before retrieval starts), 'n_instances' (num of retrieved instances) and 'n_bytes' (bytes of retrieved instances, without STREAM_ANONYMIZE) if given.
+        on_anonymized (callable): Called with the future of the anonymization, whose result is the list of written output filenames. Outputs of a failed anonymization are removed before the call.
+        expected_bytes (int): Estimated size of the study. The study is staged in memory if it fits in MEMORY_STAGING_MB and the num of instances of every series is known. It is moved to the scratch directory if it outgrows MEMORY_STAGING_MB during the retrieval.
+        on_retrieved (callable): Called without arguments when the retrieval is over, before the anonymization is scheduled.
+        replace_outputs (bool): Remove outputs of the series left by an earlier run (e.g. one interrupted by a crash) instead of writing new ones beside them.
+    '''
+    logger = logger or default_logger
+    start = time.monotonic()
+    if conn_info is None:
+        conn_info = ConnectionInformation(settings.DICOM_SERVERS[0],
+                                          settings.AECS[0], settings.PORTS[0],
+                                          settings.AETS[0],
+                                          settings.RECEIVE_PORTS[0])
+    if series is None:
+        all_datasets = query_series(PatientID,
+                                    StudyInstanceUID,
+                                    conn_info,
+                                    predicate=predicate,
+                                    logger=logger)
+    else:
+        all_datasets = series
+    if len(all_datasets) == 0:
+        raise RuntimeError(
+            'No series to retrieve for {}'.format(StudyInstanceUID))
 
-    zip_root = Path(outdir)
+    out_root = Path(outdir)
 
     list_suid = [dcm.SeriesInstanceUID for dcm in all_datasets]
     dcm = all_datasets[0]
-    new_pid = hash_utils.hash_id(dcm.PatientID)
+    new_pid = anonymize.anonymize_patient_id(dcm)
     new_study_uid = anonymize.anonymize_study_uid(dcm)
 
     ds = Dataset()
     ds.PatientID = dcm.PatientID
     ds.StudyInstanceUID = dcm.StudyInstanceUID
     ds.SeriesInstanceUID = '\\'.join(list_suid)
-    retrieve_dcmtk(ds, temp, conn_info, logger=logger)
-
-    def target():
-        logger.info('Start anonymize %s', StudyInstanceUID)
-        for dcm in all_datasets:
-            series_dir = tmp_dir / dcm.SeriesInstanceUID
-            series_dir.mkdir(parents=True, exist_ok=True)
-        for dcm_fn in sorted(tmp_dir.glob('*')):
-            if dcm_fn.is_dir():
-                continue
-            dcm = pydicom.dcmread(str(dcm_fn),
-                                  specific_tags=['SeriesInstanceUID'],
-                                  stop_before_pixels=True)
-            shutil.move(str(dcm_fn),
-                        tmp_dir / dcm.SeriesInstanceUID / dcm_fn.name)
-        for dcm in all_datasets:
-            year, date = dcm.StudyDate[:4], dcm.StudyDate[4:]
-            new_series_uid = anonymize.anonymize_series_uid(dcm)
-            zipdir = get_output_directory(zip_root, year, date, dcm.PatientID,
-                                          dcm.StudyInstanceUID)
-            zipdir.mkdir(parents=True, exist_ok=True)
-            zip_filename = anonymize.get_available_filename(
-                str(zipdir / new_series_uid), '.zip')
-
-            anonymize.anonymize_dcm_dir(tmp_dir / dcm.SeriesInstanceUID,
-                                        str(zip_filename))
-        shutil.rmtree(temp)
-        logger.info('End anonymize %s', StudyInstanceUID)
-
-    thread_pool.submit(target)
-    new_an = hash_utils.hash_id(
+
+    filenames = {}
+    for dcm in all_datasets:
+        year, date = dcm.StudyDate[:4], dcm.StudyDate[4:]
+        new_series_uid = anonymize.anonymize_series_uid(dcm)
+        study_dir = get_output_directory(out_root, year, date, dcm.PatientID,
+                                         dcm.StudyInstanceUID)
+        study_dir.mkdir(parents=True, exist_ok=True)
+        filenames[dcm.SeriesInstanceUID] = anonymize.output_filename(
+            study_dir, new_series_uid, replace_outputs)
+
+    writer = None
+    stage = None
+    handler = None
+    temp = None
+    resume = False
+    if settings.STREAM_ANONYMIZE:
+        # instances are anonymized into the outputs as they are received
+        writer = anonymize.StreamWriter(
+            filenames,
+            {dcm.SeriesInstanceUID: n_instances(dcm, None)
+             for dcm in all_datasets})
+        handler = writer.handle_store
+    elif (expected_bytes is not None and settings.RETRIEVE_METHOD != 'dcmtk'
+          and settings.MEMORY_STAGING_MB > 0
+          and all(n_instances(dcm, None) for dcm in all_datasets)
+          and memory_budget.try_acquire(expected_bytes)):
+        # small studies are staged in memory instead of the scratch directory
+        stage = anonymize.MemoryStage(
+            memory_budget, expected_bytes,
+            partial(partial_directory, StudyInstanceUID))
+        handler = stage.handle_store
+    else:
+        tmp_dir = partial_directory(StudyInstanceUID)
+        temp = str(tmp_dir)
+        resume = any(tmp_dir.iterdir())
+    receiver = writer or stage
+
+    latency = time.monotonic() - start
+    if temp is not None:
+        # hold the retrieval while anonymization is behind
+        backlog.acquire(logger)
+    for n_retries in range(settings.RETRIEVE_RETRIES + 1):
+        try:
+            if resume:
+                retrieve_missing(
+                    all_datasets,
+                    temp,
+                    conn_info,
+                    logger=logger,
+                    arrived=receiver.received if receiver else None,
+                    handler=handler)
+            elif settings.SERIES_SPLIT > 1:
+                retrieve_split(ds,
+                               temp,
+                               conn_info,
+                               all_datasets,
+                               logger=logger,
+                               handler=handler)
+            else:
+                retrieve(ds, temp, conn_info, logger=logger, handler=handler)
+            break
+        except Exception as e:
+            if isinstance(e, AssociationError
+                          ) or n_retries == settings.RETRIEVE_RETRIES:
+                if writer is not None:
+                    writer.abort()
+                elif stage is not None:
+                    memory_budget.release(stage.reserved)
+                    if stage.spill_dir is not None:
+                        release_partial_directory(stage.spill_dir)
+                else:
+                    backlog.release()
+                    release_partial_directory(temp)
+                raise
+            logger.warning('Retrieval of %s failed (%s). Resume',
+                           StudyInstanceUID, e)
+            resume = True
+    if stage is not None and stage.spill_dir is not None:
+        # the study outgrew the memory budget and continues as a partial directory
+        logger.info('%s is moved to the scratch directory', StudyInstanceUID)
+        memory_budget.release(stage.reserved)
+        temp = str(stage.spill_dir)
+        stage = None
+        backlog.acquire(logger)
+    if stats is not None:
+        stats['latency'] = latency
+        stats['n_instances'] = len(
+            receiver.received) if receiver else len(os.listdir(temp))
+    n_bytes = 0
+    if stage is not None:
+        n_bytes = stage.n_bytes
+        # account the actual size instead of the estimate
+        memory_budget.add_bytes(n_bytes - stage.reserved)
+    elif temp is not None:
+        n_bytes = utils.directory_size(temp)
+        backlog.add_bytes(n_bytes)
+        logger.info('Anonymization backlog: %s', backlog.status())
+    if stats is not None and writer is None:
+        stats['n_bytes'] = n_bytes
+
+    def done(future):
+        if stage is not None:
+            memory_budget.release(n_bytes)
+        elif temp is not None:
+            backlog.release(n_bytes)
+            release_partial_directory(temp)
+        if future.exception() is not None:
+            logger.error('Anonymization of %s failed: %s', StudyInstanceUID,
+                         future.exception())
+            for filename in filenames.values():
+                sink.remove_output(filename)
+        else:
+            logger.info('End anonymize %s (%d series)', StudyInstanceUID,
+                        len(future.result()))
+        if on_anonymized is not None:
+            on_anonymized(future)
+
+    if on_retrieved is not None:
+        on_retrieved()
+    if writer is not None:
+        future = Future()
+        future.add_done_callback(done)
+        try:
+            future.set_result(writer.close())
+        except Exception as e:
+            writer.abort()
+            future.set_exception(e)
+    else:
+        try:
+            if stage is not None:
+                logger.info('Start anonymize %s in memory', StudyInstanceUID)
+                future = anonymize_pool.submit(
+                    anonymize.anonymize_study_memory, stage.series(),
+                    filenames)
+            else:
+                logger.info('Start anonymize %s', StudyInstanceUID)
+                future = anonymize_pool.submit(anonymize.anonymize_study_dir,
+                                               temp, filenames)
+        except Exception:
+            # e.g. the pool is shut down. done() is never called
+            if stage is not None:
+                memory_budget.release(n_bytes)
+            else:
+                backlog.release(n_bytes)
+                release_partial_directory(temp)
+            raise
+        future.add_done_callback(done)
+    new_an = anonymize.anonymize_accession_number(
         AccessionNumber) if AccessionNumber != '' else ''
     return new_pid, new_an, new_study_uid, dcm.StudyDate
 
@@ -236,7 +963,14 @@ def shutdown():
     '''
     Call at the very end of the program to join all threads
     '''
-    thread_pool.shutdown()
+    anonymize_pool.shutdown()
+    anonymize.registry.close()
+    find_pool.close_all()
+    move_pool.close_all()
+    get_pool.close_all()
+    storage_scp.shutdown()
+    if catalog is not None:
+        catalog.close()
 
 
 def is_original_image(ds: Dataset):
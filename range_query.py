@@ -3,18 +3,29 @@ import sys
 import io
 
 import pandas as pd
+import pydicom
 from pydicom.dataset import Dataset
+from pydicom.dataelem import DataElement
 from logzero import logger
 import tqdm
 
 import qr
 import date_utils
+import utils
+from config import settings
 
 EXT_TABLE = {
     '.csv': 'to_csv',
     '.xlsx': 'to_excel',
 }
 
+# attribute used to drop duplicated results
+UNIQUE_KEYS = {
+    'PATIENT': 'PatientID',
+    'STUDY': 'StudyInstanceUID',
+    'SERIES': 'SeriesInstanceUID',
+}
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -63,6 +74,24 @@ def main():
     parser.add_argument('--progress',
                         help="Show progress bar",
                         action='store_true')
+    parser.add_argument(
+        '--limit',
+        help=
+        "Maximum number of results the server returns for a query. Query ranges are split adaptively (down to StudyTime ranges) so that no query reaches the limit, and grown while results are sparse. 0 to use fixed --step. Default: QUERY_LIMIT in the config (%(default)s)",
+        default=settings.QUERY_LIMIT,
+        type=int,
+        metavar='<int>')
+    parser.add_argument(
+        '--workers',
+        help=
+        "Number of concurrent queries. Date ranges are spread across DICOM_SERVERS and queries in flight per server are capped by MAX_ASSOCIATIONS. Default: %(default)s",
+        default=1,
+        type=int,
+        metavar='<int>')
+    parser.add_argument(
+        '--offline',
+        help="Query the local catalog (CATALOG in the config) only",
+        action='store_true')
 
     args = parser.parse_args()
 
@@ -94,40 +123,118 @@ def main():
         if key not in attributes:
             attributes.append(key)
 
-    logger.info('Start querying')
-    all_result = []
-    generator = date_utils.split(start_date, end_date, args.step)
-    if args.progress:
-        generator = tqdm.tqdm(generator,
-                              total=date_utils.split_size(
-                                  start_date, end_date, args.step))
-    for part_start, part_end in generator:
-        study_date = '{}-{}'.format(date_utils.date2str(part_start),
-                                    date_utils.date2str(part_end))
-        logger.debug(study_date)
+    conn_infos = [
+        qr.ConnectionInformation(server, aec, port, settings.AETS[0],
+                                 settings.RECEIVE_PORTS[0]) for server, aec,
+        port in zip(settings.DICOM_SERVERS, settings.AECS, settings.PORTS)
+    ]
+
+    def make_dataset(part_start, part_end):
+        study_date, study_time = date_utils.part2query(part_start, part_end)
+        logger.debug('%s %s', study_date, study_time)
 
         ds = Dataset()
         for attr in attributes:
             setattr(ds, attr, '')
         ds.StudyDate = study_date
+        if study_time == date_utils.EMPTY_TIME:
+            # not a valid TM, but the standard value for empty value matching
+            ds.add(
+                DataElement('StudyTime',
+                            'TM',
+                            study_time,
+                            validation_mode=pydicom.config.IGNORE))
+        elif study_time:
+            ds.StudyTime = study_time
         ds.QueryRetrieveLevel = args.qrlevel
         for key, value in kvs:
             setattr(ds, key, value)
+        return ds
+
+    def adaptive_query(part_start, part_end, conn_info, max_step):
+        def query(s, e):
+            return qr.query(make_dataset(s, e),
+                            conn_info,
+                            logger=logger,
+                            offline=args.offline)
+
+        for s, e, results in date_utils.adaptive_split(part_start,
+                                                       part_end,
+                                                       args.step,
+                                                       query,
+                                                       args.limit,
+                                                       max_step=max_step):
+            if len(results) >= args.limit:
+                logger.warning('%d results for %s. Results may be truncated.',
+                               len(results), date_utils.part2query(s, e))
+            yield results
+
+    def query_part(indexed_part):
+        i, (part_start, part_end) = indexed_part
+        if args.workers > 1:
+            conn_info = conn_infos[i % len(conn_infos)]
+        else:
+            conn_info = None
+        if args.limit > 0:
+            # bisect within the part
+            return sum(
+                adaptive_query(part_start, part_end, conn_info, args.step), [])
+        if args.workers > 1:
+            return qr.query(make_dataset(part_start, part_end),
+                            conn_info,
+                            logger=logger,
+                            offline=args.offline)
+        return qr.iter_query(make_dataset(part_start, part_end),
+                             logger=logger,
+                             offline=args.offline)
+
+    def iter_results():
+        parts = enumerate(date_utils.split(start_date, end_date, args.step))
+        if args.limit > 0 and args.workers == 1:
+            # one adaptive pass over the whole range
+            yield from adaptive_query(start_date, end_date, None, None)
+        elif args.workers > 1:
+            yield from utils.ordered_map(query_part, parts, args.workers)
+        else:
+            yield from map(query_part, parts)
+
+    def iter_rows():
+        results = iter_results()
+        if args.progress:
+            total = None
+            if args.limit <= 0 or args.workers > 1:
+                total = date_utils.split_size(start_date, end_date, args.step)
+            results = tqdm.tqdm(results, total=total)
+        unique_key = UNIQUE_KEYS[args.qrlevel]
+        seen = set()
+        for result in results:
+            for r in result:
+                uid = r.get(unique_key, None)
+                if uid:
+                    if uid in seen:
+                        continue
+                    seen.add(uid)
+                yield [getattr(r, attr) for attr in attributes]
 
-        query_result = qr.query(ds, logger=logger)
-        if query_result:
-            all_result.extend([[getattr(r, attr) for attr in attributes]
-                               for r in query_result])
+    logger.info('Start querying')
+    rows = iter_rows()
+    try:
+        if args.ext == '.csv':
+            n_results = utils.write_csv(output_filename, attributes, rows)
+        else:
+            df = pd.DataFrame(list(rows), columns=attributes)
+            n_results = len(df)
+            if output_filename == '-':
+                s = io.StringIO()
+                getattr(df, EXT_TABLE[args.ext])(s, index=False)
+                print(s.getvalue())
+            else:
+                getattr(df, EXT_TABLE[args.ext])(output_filename, index=False)
+    finally:
+        rows.close()  # abort the C-FIND if it is still running
+        qr.shutdown()  # release pooled associations
     logger.info('End querying')
-    logger.info('%d query results', len(all_result))
-
-    df = pd.DataFrame(all_result, columns=attributes)
-    if output_filename == '-':
-        s = io.StringIO()
-        getattr(df, EXT_TABLE[args.ext])(s, index=False)
-        print(s.getvalue())
-    else:
-        getattr(df, EXT_TABLE[args.ext])(output_filename, index=False)
+    logger.info('%d query results', n_results)
     return 0
 
 
@@ -72,6 +72,7 @@ class ScheduledEvent():
         self.event = Event()
         self.event.clear()
         self.interval = 1
+        self.conditions = []  # callables that return False to hold the event
 
         self.thread = Thread(target=self._loop)
         self.thread.daemon = True
@@ -82,8 +83,16 @@ class ScheduledEvent():
             self.update()
             time.sleep(self.interval)
 
+    def add_condition(self, condition):
+        '''
+        Args:
+            condition (callable): The event is set only while it returns True.
+        '''
+        self.conditions.append(condition)
+
     def update(self):
-        if self.periods.between(HMClock.now()) is not None:
+        if self.periods.between(HMClock.now()) is not None and all(
+                condition() for condition in self.conditions):
             if not self.event.is_set() and self._enabled:
                 self.logger.info('Set event')
                 self.event.set()
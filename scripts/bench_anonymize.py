@@ -0,0 +1,104 @@
+import sys
+import io
+import timeit
+import argparse
+from pathlib import Path
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.datadict import keyword_for_tag
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid, CTImageStorage
+
+# run from the repository root: python scripts/bench_anonymize.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import anonymize  # noqa: E402
+import dcm_utils  # noqa: E402
+
+
+def create_dataset(size):
+    dcm = Dataset()
+    dcm.file_meta = FileMetaDataset()
+    dcm.file_meta.MediaStorageSOPClassUID = CTImageStorage
+    dcm.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm.file_meta.ImplementationClassUID = generate_uid()
+    dcm.file_meta.ImplementationVersionName = 'BENCH'
+    dcm.SOPClassUID = CTImageStorage
+    dcm.SOPInstanceUID = dcm.file_meta.MediaStorageSOPInstanceUID
+    dcm.AccessionNumber = '12345'
+    dcm.InstitutionName = 'Hospital'
+    dcm.PatientName = 'Doe^John'
+    dcm.PatientID = 'PID'
+    dcm.PatientBirthDate = '19700101'
+    dcm.StudyInstanceUID = generate_uid()
+    dcm.SeriesInstanceUID = generate_uid()
+    dcm.StudyID = '1'
+    dcm.Rows = size
+    dcm.Columns = size
+    dcm.BitsAllocated = 16
+    dcm.PixelData = b'\x00' * (size * size * 2)
+    with io.BytesIO() as bio:
+        dcm.save_as(bio, enforce_file_format=True)
+        return bio.getvalue()
+
+
+def interpret_rules(dcm, replace_rules, remove_rules):
+    '''
+    Rules interpreted for each instance (the loop before AnonymizationPlan)
+    '''
+    for tag, new_value in replace_rules:
+        if hasattr(new_value, '__call__'):
+            new_value = new_value(dcm)
+        if tag[0] == 0x0002:
+            dcm.file_meta[tag].value = new_value
+        else:
+            if tag in dcm:
+                dcm[tag].value = new_value
+            else:
+                kw = keyword_for_tag(tag)
+                setattr(dcm, kw, new_value)
+
+    for tag in remove_rules:
+        if tag[0] == 0x0002 and tag in dcm.file_meta:
+            del dcm.file_meta[tag]
+        elif tag in dcm:
+            del dcm[tag]
+    return dcm
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmark of per-instance anonymization.')
+    parser.add_argument('--size',
+                        help="Rows and columns of images. default:%(default)s",
+                        metavar='<int>',
+                        type=int,
+                        default=512)
+    parser.add_argument('-n',
+                        help="Num of repeats. default:%(default)s",
+                        metavar='<int>',
+                        type=int,
+                        default=1000)
+    args = parser.parse_args()
+
+    data = create_dataset(args.size)
+    dcm = pydicom.dcmread(io.BytesIO(data))
+    replace_rules = anonymize.series_replace_rules(
+        dcm, dcm.file_meta.MediaStorageSOPInstanceUID)
+    remove_rules = anonymize.remove_rules
+    plan = dcm_utils.AnonymizationPlan(replace_rules, remove_rules)
+
+    benchmarks = [
+        ('interpret rules',
+         lambda: interpret_rules(dcm, replace_rules, remove_rules)),
+        ('AnonymizationPlan.apply', lambda: plan.apply(dcm)),
+        ('dcmread + apply + dcm2bytes', lambda: dcm_utils.dcm2bytes(
+            plan.apply(pydicom.dcmread(io.BytesIO(data))))),
+        ('rewrite_bytes', lambda: dcm_utils.rewrite_bytes(data, plan)),
+    ]
+    for name, f in benchmarks:
+        seconds = min(timeit.repeat(f, number=args.n, repeat=3)) / args.n
+        print('{:<30}{:>10.1f} us/instance'.format(name, seconds * 1e6))
+
+
+if __name__ == "__main__":
+    main()
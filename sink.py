@@ -0,0 +1,195 @@
+import io
+import os
+import shutil
+import tarfile
+import time
+import zipfile
+import dcm_utils
+
+PART_SUFFIX = '.part'
+
+
+class Sink():
+    '''
+    Output of an anonymized series.
+    Members are added one by one with write() and close(), or at once with save().
+    The output is written as filename + PART_SUFFIX and renamed to filename when it is closed, so an interrupted output is never taken for a finished one.
+
+    Args:
+        filename (str): Output filename including the extension.
+        workers (int): Num of threads to compress members if the sink supports it.
+    '''
+    extension = ''
+
+    def __init__(self, filename, workers=1):
+        self.filename = str(filename)
+        self.part_filename = self.filename + PART_SUFFIX
+        self.workers = workers
+
+    def write(self, name, content):
+        raise NotImplementedError()
+
+    def _release(self):
+        '''
+        Close the part file without renaming it
+        '''
+        pass
+
+    def close(self):
+        self._release()
+        if os.path.exists(self.part_filename):
+            os.replace(self.part_filename, self.filename)
+
+    def save(self, contents):
+        '''
+        Args:
+            contents (iterable): Iterable object that returns (name, content(bytes))
+        '''
+        for name, content in contents:
+            self.write(name, content)
+        self.close()
+
+    def abort(self):
+        '''
+        Close and remove the output
+        '''
+        self._release()
+        remove_output(self.filename)
+
+    @classmethod
+    def is_output(cls, entry: os.DirEntry):
+        return entry.is_file() and entry.name.endswith(cls.extension)
+
+
+class DirectorySink(Sink):
+    '''
+    Plain files in a directory. Nothing is re-encoded.
+    '''
+    def __init__(self, filename, workers=1):
+        super().__init__(filename, workers)
+        os.makedirs(self.part_filename, exist_ok=True)
+
+    def write(self, name, content):
+        with open(os.path.join(self.part_filename, name), 'wb') as f:
+            f.write(content)
+
+    @classmethod
+    def is_output(cls, entry: os.DirEntry):
+        return entry.is_dir() and not entry.name.endswith(PART_SUFFIX)
+
+
+class ZipSink(Sink):
+    '''
+    Zip file. Members are deflated or stored according to dcm_utils.zip_compression.
+    '''
+    extension = '.zip'
+    compresslevel = 1
+
+    def __init__(self, filename, workers=1):
+        super().__init__(filename, workers)
+        self.zf = None
+
+    def write(self, name, content):
+        if self.zf is None:
+            self.zf = zipfile.ZipFile(self.part_filename, 'w')
+        self.zf.writestr(name,
+                         content,
+                         compress_type=dcm_utils.zip_compression(
+                             content, self.compresslevel),
+                         compresslevel=self.compresslevel)
+
+    def _release(self):
+        if self.zf is not None:
+            self.zf.close()
+            self.zf = None
+
+    def save(self, contents):
+        dcm_utils.save_as_zip(contents, self.compresslevel,
+                              self.part_filename, self.workers)
+        self.close()
+
+
+class StoredZipSink(ZipSink):
+    '''
+    Zip file without compression
+    '''
+    compresslevel = -1
+
+
+class TarSink(Sink):
+    '''
+    Uncompressed tar file
+    '''
+    extension = '.tar'
+
+    def __init__(self, filename, workers=1):
+        super().__init__(filename, workers)
+        self.tf = None
+
+    def _open(self):
+        return tarfile.open(self.part_filename, 'w')
+
+    def write(self, name, content):
+        if self.tf is None:
+            self.tf = self._open()
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = time.time()
+        info.mode = 0o600
+        self.tf.addfile(info, io.BytesIO(content))
+
+    def _release(self):
+        if self.tf is not None:
+            self.tf.close()
+            self.tf = None
+
+
+class ZstdTarSink(TarSink):
+    '''
+    Tar file compressed with Zstandard. Requires zstandard package.
+    '''
+    extension = '.tar.zst'
+
+    def _open(self):
+        import zstandard
+        compressor = zstandard.ZstdCompressor(
+            level=3, threads=self.workers if self.workers > 1 else 0)
+        self.zst = compressor.stream_writer(open(self.part_filename, 'wb'))
+        return tarfile.open(fileobj=self.zst, mode='w|')
+
+    def _release(self):
+        if self.tf is not None:
+            super()._release()
+            self.zst.close()
+
+
+SINKS = {
+    'zip': ZipSink,
+    'zip_stored': StoredZipSink,
+    'tar': TarSink,
+    'tar_zst': ZstdTarSink,
+    'directory': DirectorySink,
+}
+
+
+def remove_output(filename):
+    '''
+    Remove the output of any sink and its part file (e.g. a partially written one).
+    '''
+    for name in [filename, str(filename) + PART_SUFFIX]:
+        if os.path.isdir(name):
+            shutil.rmtree(name, ignore_errors=True)
+        elif os.path.exists(name):
+            os.remove(name)
+
+
+def output_exists(dirname):
+    '''
+    Return True if dirname contains output of any sink.
+    '''
+    if not os.path.isdir(dirname):
+        return False
+    with os.scandir(dirname) as it:
+        return any(
+            any(sink.is_output(entry) for sink in SINKS.values())
+            for entry in it)
@@ -0,0 +1,129 @@
+from pathlib import Path
+from threading import Lock
+from contextlib import contextmanager
+
+from pynetdicom import AE, evt, AllStoragePresentationContexts, ALL_TRANSFER_SYNTAXES
+from pynetdicom.sop_class import Verification
+from logzero import logger as default_logger
+
+STATUS_SUCCESS = 0x0000
+STATUS_UNEXPECTED = 0xC000  # Error: Cannot understand
+
+
+class StorageRouter():
+    '''
+    Route incoming C-STORE requests to handlers registered by SeriesInstanceUID or StudyInstanceUID.
+    '''
+    def __init__(self, logger=None):
+        self.logger = logger or default_logger
+        self._routes = {}
+        self._lock = Lock()
+
+    def register(self, uid, handler):
+        with self._lock:
+            if uid in self._routes:
+                self.logger.warning('Overwrite route for %s', uid)
+            self._routes[uid] = handler
+
+    def unregister(self, uid):
+        with self._lock:
+            self._routes.pop(uid, None)
+
+    @contextmanager
+    def route(self, uids, handler):
+        '''
+        Route instances of uids to handler while in the context.
+
+        Args:
+            uids (list): SeriesInstanceUIDs or StudyInstanceUIDs
+            handler (callable): Function that takes pynetdicom's C-STORE event and returns a status.
+        '''
+        for uid in uids:
+            self.register(uid, handler)
+        try:
+            yield
+        finally:
+            for uid in uids:
+                self.unregister(uid)
+
+    def lookup(self, ds):
+        with self._lock:
+            for uid in [
+                    ds.get('SeriesInstanceUID', None),
+                    ds.get('StudyInstanceUID', None)
+            ]:
+                if uid in self._routes:
+                    return self._routes[uid]
+        return None
+
+    def handle_store(self, event):
+        handler = self.lookup(event.dataset)
+        if handler is None:
+            self.logger.warning('Unexpected instance %s',
+                                event.request.AffectedSOPInstanceUID)
+            return STATUS_UNEXPECTED
+        return handler(event)
+
+
+def save_to_directory(outdir):
+    '''
+    Create C-STORE handler that writes received instances into outdir.
+    '''
+    outdir = Path(outdir)
+
+    def handler(event):
+        filename = outdir / event.request.AffectedSOPInstanceUID
+        with open(filename, 'wb') as f:
+            f.write(event.encoded_dataset())
+        return STATUS_SUCCESS
+
+    return handler
+
+
+class StorageServer():
+    def __init__(self, port, ae_title, logger=None):
+        '''
+        Long-lived storage SCP that receives instances for C-MOVE requests.
+
+        Args:
+            port (int): Port to listen.
+            ae_title (str): AE title of the SCP.
+        '''
+        self.logger = logger or default_logger
+        self.port = port
+        self.router = StorageRouter(self.logger)
+        self.ae = AE(ae_title=ae_title)
+        for context in AllStoragePresentationContexts:
+            self.ae.add_supported_context(context.abstract_syntax,
+                                          ALL_TRANSFER_SYNTAXES)
+        self.ae.add_supported_context(Verification)
+        self.server = self.ae.start_server(
+            ('', port),
+            block=False,
+            evt_handlers=[(evt.EVT_C_STORE, self.router.handle_store)])
+        self.logger.info('Storage SCP started %s:%d', ae_title, port)
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.logger.info('Storage SCP stopped :%d', self.port)
+
+
+_servers = {}
+_servers_lock = Lock()
+
+
+def get_server(port, ae_title, logger=None):
+    '''
+    Return the storage SCP listening on the port. The SCP is started on the first call.
+    '''
+    with _servers_lock:
+        if port not in _servers:
+            _servers[port] = StorageServer(port, ae_title, logger)
+        return _servers[port]
+
+
+def shutdown():
+    with _servers_lock:
+        for server in _servers.values():
+            server.shutdown()
+        _servers.clear()
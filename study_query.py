@@ -1,18 +1,11 @@
 import argparse
 import sys
-import io
 
-import pandas as pd
 from pydicom.dataset import Dataset
 from logzero import logger
 
 import qr
-from utils import swallow_exceptions
-
-EXT_TABLE = {
-    '.csv': 'to_csv',
-    '.xlsx': 'to_excel',
-}
+from utils import swallow_exceptions, write_csv
 
 
 def main():
@@ -30,6 +23,10 @@ def main():
         '--output',
         help="Output filename. Specify - to use stdout. Default: <UID>.csv",
         metavar='<output>')
+    parser.add_argument(
+        '--offline',
+        help="Query the local catalog (CATALOG in the config) only",
+        action='store_true')
     parser.add_argument(
         '--loglevel',
         help="Loglevel. default:%(default)s. choices:[%(choices)s]",
@@ -58,18 +55,20 @@ def main():
     ds.QueryRetrieveLevel = 'SERIES'
     ds.StudyInstanceUID = args.UID
 
-    query_result = qr.query(ds, logger=logger)
-    df = pd.DataFrame(
-        [[swallow_exceptions(logger)(getattr)(r, attr) for attr in attributes]
-         for r in query_result],
-        columns=attributes)
-    logger.info('%d query results', len(df))
-    if output_filename == '-':
-        s = io.StringIO()
-        df.to_csv(s)
-        print(s.getvalue())
-    else:
-        df.to_csv(output_filename, index=False)
+    rows = ([
+        swallow_exceptions(logger)(getattr)(r, attr) for attr in attributes
+    ] for r in qr.iter_query(ds, logger=logger, offline=args.offline))
+    try:
+        if output_filename == '-':
+            # with index column
+            n_results = write_csv('-', [''] + attributes,
+                                  ([i] + row for i, row in enumerate(rows)))
+        else:
+            n_results = write_csv(output_filename, attributes, rows)
+    finally:
+        rows.close()  # abort the C-FIND if it is still running
+        qr.shutdown()  # release pooled associations
+    logger.info('%d query results', n_results)
     return 0
 
 
@@ -0,0 +1,271 @@
+import io
+import threading
+import unittest
+import multiprocessing
+from concurrent.futures.process import ProcessPoolExecutor
+import tempfile
+import zipfile
+from pathlib import Path
+from types import SimpleNamespace
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+import storage_scp
+import utils
+
+try:
+    import anonymize
+except FileNotFoundError:  # config/.salt is not in the repository
+    anonymize = None
+
+SOP_UID_TAGS = [(0x0002, 0x0003), (0x0008, 0x0018)]
+
+
+def create_study(n_series=2, n_instances=3):
+    '''
+    Return C-STORE events of a small study
+    '''
+    study_uid = generate_uid()
+    events = []
+    for i in range(n_series):
+        series_uid = generate_uid()
+        for j in range(n_instances):
+            dcm = Dataset()
+            dcm.file_meta = FileMetaDataset()
+            dcm.file_meta.MediaStorageSOPClassUID = CTImageStorage
+            dcm.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+            dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            dcm.SOPClassUID = CTImageStorage
+            dcm.SOPInstanceUID = dcm.file_meta.MediaStorageSOPInstanceUID
+            dcm.AccessionNumber = 'AN1'
+            dcm.InstitutionName = 'Hospital'
+            dcm.PatientName = 'Doe^John'
+            dcm.PatientID = 'PID1'
+            dcm.StudyInstanceUID = study_uid
+            dcm.SeriesInstanceUID = series_uid
+            dcm.StudyDate = '20200101'
+            dcm.InstanceNumber = j + 1
+            dcm.Rows = 2
+            dcm.Columns = 2
+            dcm.BitsAllocated = 16
+            dcm.PixelData = bytes([i, j]) * 4
+            with io.BytesIO() as bio:
+                dcm.save_as(bio, enforce_file_format=True)
+                data = bio.getvalue()
+            events.append(
+                SimpleNamespace(
+                    dataset=dcm,
+                    encoded_dataset=lambda data=data: data,
+                    request=SimpleNamespace(
+                        AffectedSOPInstanceUID=dcm.SOPInstanceUID)))
+    return events
+
+
+def output_filenames(events, outdir):
+    outdir.mkdir()
+    return {
+        uid: str(outdir / (uid + '.zip'))
+        for uid in sorted({e.dataset.SeriesInstanceUID
+                           for e in events})
+    }
+
+
+def read_outputs(filenames):
+    '''
+    Returns:
+        list: (member name, dataset) of the outputs in the order of filenames
+    '''
+    members = []
+    for filename in filenames:
+        with zipfile.ZipFile(filename) as zf:
+            for name in zf.namelist():
+                members.append(
+                    (name, pydicom.dcmread(io.BytesIO(zf.read(name)))))
+    return members
+
+
+@unittest.skipIf(anonymize is None, 'config/.salt is required')
+class TestAnonymizeStudy(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.tempdir_path = Path(self.tempdir.name)
+        self.events = create_study()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def anonymize_dir(self):
+        '''
+        Outputs of the temp directory path as the reference
+        '''
+        indir = self.tempdir_path / 'partial'
+        indir.mkdir()
+        handler = storage_scp.save_to_directory(indir)
+        for event in self.events:
+            handler(event)
+        filenames = output_filenames(self.events, self.tempdir_path / 'dir')
+        written = anonymize.anonymize_study_dir(str(indir), filenames)
+        self.assertFalse(indir.exists())
+        return read_outputs(written)
+
+    def test_output_filename(self):
+        filename = anonymize.output_filename(self.tempdir_path, '13.1')
+        Path(filename).write_bytes(b'')
+        self.assertNotEqual(
+            anonymize.output_filename(self.tempdir_path, '13.1'), filename)
+        self.assertEqual(
+            anonymize.output_filename(self.tempdir_path, '13.1', True),
+            filename)
+        self.assertFalse(Path(filename).exists())
+
+    def test_memory_stage(self):
+        stage = anonymize.MemoryStage()
+        for event in reversed(self.events):
+            self.assertEqual(stage.handle_store(event), 0x0000)
+        # resent instances are counted once
+        stage.handle_store(self.events[0])
+        self.assertEqual(stage.received,
+                         {e.dataset.SOPInstanceUID
+                          for e in self.events})
+        self.assertEqual(
+            stage.n_bytes,
+            sum(len(e.encoded_dataset()) for e in self.events))
+
+        filenames = output_filenames(self.events,
+                                     self.tempdir_path / 'memory')
+        written = anonymize.anonymize_study_memory(stage.series(), filenames)
+        self.assertEqual(written, list(filenames.values()))
+
+        expected = self.anonymize_dir()
+        actual = read_outputs(written)
+        self.assertEqual(len(actual), len(expected))
+        for (name, dcm), (expected_name, expected_dcm) in zip(
+                actual, expected):
+            self.assertEqual(name, expected_name)
+            self.assertEqual(dcm.file_meta, expected_dcm.file_meta)
+            self.assertEqual(dcm, expected_dcm)
+
+    def test_memory_stage_spill(self):
+        size = len(self.events[0].encoded_dataset())
+        budget = utils.Backlog(max_bytes=size * 4)
+        self.assertTrue(budget.try_acquire(size))
+        spill_dir = self.tempdir_path / 'spill'
+        spill_dir.mkdir()
+        stage = anonymize.MemoryStage(budget, size, lambda: spill_dir)
+        for event in self.events:
+            stage.handle_store(event)
+        # the reservation grows until the budget is used up
+        self.assertGreater(stage.reserved, size)
+        self.assertEqual(budget.bytes, stage.reserved)
+        self.assertEqual(stage.instances, {})
+        self.assertEqual(stage.received,
+                         {e.dataset.SOPInstanceUID
+                          for e in self.events})
+        self.assertEqual(sorted(p.name for p in spill_dir.iterdir()),
+                         sorted(stage.received))
+
+        filenames = output_filenames(self.events,
+                                     self.tempdir_path / 'spilled')
+        written = anonymize.anonymize_study_dir(str(spill_dir), filenames)
+        expected = self.anonymize_dir()
+        actual = read_outputs(written)
+        self.assertEqual([name for name, _ in actual],
+                         [name for name, _ in expected])
+        for (_, dcm), (_, expected_dcm) in zip(actual, expected):
+            self.assertEqual(dcm, expected_dcm)
+
+    def test_process_pool(self):
+        # same as ANONYMIZE_BACKEND = 'process'
+        indir = self.tempdir_path / 'partial'
+        indir.mkdir()
+        handler = storage_scp.save_to_directory(indir)
+        stage = anonymize.MemoryStage()
+        for event in self.events:
+            handler(event)
+            stage.handle_store(event)
+        with ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context('spawn')) as pool:
+            dir_future = pool.submit(
+                anonymize.anonymize_study_dir, str(indir),
+                output_filenames(self.events, self.tempdir_path / 'dir'))
+            memory_future = pool.submit(
+                anonymize.anonymize_study_memory, stage.series(),
+                output_filenames(self.events, self.tempdir_path / 'memory'))
+            dir_outputs = read_outputs(dir_future.result(60))
+            memory_outputs = read_outputs(memory_future.result(60))
+        self.assertFalse(indir.exists())
+        self.assertEqual(len(dir_outputs), len(self.events))
+        self.assertEqual(memory_outputs, dir_outputs)
+
+    def test_stream_writer(self):
+        filenames = output_filenames(self.events,
+                                     self.tempdir_path / 'stream')
+        writer = anonymize.StreamWriter(filenames, {uid: 3 for uid in filenames})
+        # the order of arrival is the order of the files in the temp directory
+        for event in sorted(self.events,
+                            key=lambda e: e.request.AffectedSOPInstanceUID):
+            self.assertEqual(writer.handle_store(event), 0x0000)
+        # duplicated instances are ignored
+        writer.handle_store(self.events[0])
+        written = writer.close()
+        self.assertEqual(sorted(written), sorted(filenames.values()))
+
+        expected = self.anonymize_dir()
+        actual = read_outputs(sorted(written))
+        self.assertEqual(len(actual), len(expected))
+        for (name, dcm), (expected_name, expected_dcm) in zip(
+                actual, expected):
+            self.assertEqual(name, expected_name)
+            # anonymized SOPInstanceUIDs are derived from the SeriesInstanceUID
+            for tag in SOP_UID_TAGS:
+                if tag[0] == 0x0002:
+                    del dcm.file_meta[tag], expected_dcm.file_meta[tag]
+                else:
+                    del dcm[tag], expected_dcm[tag]
+            self.assertEqual(dcm.file_meta, expected_dcm.file_meta)
+            self.assertEqual(dcm, expected_dcm)
+            self.assertNotEqual(dcm.PatientID, 'PID1')
+            self.assertNotIn('InstitutionName', dcm)
+
+    def test_stream_writer_unknown_count(self):
+        filenames = output_filenames(self.events,
+                                     self.tempdir_path / 'stream')
+        writer = anonymize.StreamWriter(filenames)
+        for event in self.events:
+            writer.handle_store(event)
+        names = [name for name, _ in read_outputs(sorted(writer.close()))]
+        self.assertEqual(names,
+                         ['IMG00000.dcm', 'IMG00001.dcm', 'IMG00002.dcm'] * 2)
+        self.assertEqual(anonymize.member_name_format(3).format(2),
+                         'IMG2.dcm')
+
+    def test_stream_writer_resent(self):
+        filenames = output_filenames(self.events,
+                                     self.tempdir_path / 'stream')
+        writer = anonymize.StreamWriter(filenames)
+        barrier = threading.Barrier(4)
+
+        def store():
+            barrier.wait()
+            writer.handle_store(self.events[0])
+
+        threads = [threading.Thread(target=store) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the instance is written once even if it is resent during the first write
+        self.assertEqual(len(read_outputs(writer.close())), 1)
+
+    def test_stream_writer_abort(self):
+        filenames = output_filenames(self.events,
+                                     self.tempdir_path / 'stream')
+        writer = anonymize.StreamWriter(filenames)
+        writer.handle_store(self.events[0])
+        writer.abort()
+        self.assertEqual(list((self.tempdir_path / 'stream').iterdir()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+import unittest
+import threading
+import time
+from collections import namedtuple
+
+from pynetdicom import build_context, ALL_TRANSFER_SYNTAXES, DEFAULT_TRANSFER_SYNTAXES
+from pynetdicom.sop_class import CTImageStorage, PatientRootQueryRetrieveInformationModelGet
+
+from assoc_pool import AssociationPool
+
+ConnectionInformation = namedtuple(
+    'ConnectionInformation', ['server', 'aec', 'port', 'aet', 'receive_port'])
+
+
+class FakeAssociation():
+    def __init__(self):
+        self.is_established = True
+        self.n_echo = 0
+
+    def release(self):
+        self.is_established = False
+
+    def abort(self):
+        self.is_established = False
+
+    def send_c_echo(self):
+        self.n_echo += 1
+        Status = namedtuple('Status', ['Status'])
+        return Status(0x0000)
+
+
+class FakePool(AssociationPool):
+    def __init__(self, *args, **kwargs):
+        super(FakePool, self).__init__([], *args, **kwargs)
+        self.created = []
+
+    def _associate(self, conn_info):
+        assoc = FakeAssociation()
+        self.created.append(assoc)
+        return assoc
+
+
+class TestAssociationPool(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestAssociationPool, self).__init__(*args, **kwargs)
+        self.conn_info = ConnectionInformation('localhost', 'ANY-SCP', 4242,
+                                               'AUTOQR', 104)
+
+    def test_reuse(self):
+        pool = FakePool()
+        for _ in range(3):
+            with pool.acquire(self.conn_info) as assoc:
+                self.assertTrue(assoc.is_established)
+        self.assertEqual(len(pool.created), 1)
+
+        # different server
+        with pool.acquire(self.conn_info._replace(server='remote')):
+            pass
+        self.assertEqual(len(pool.created), 2)
+
+        # receive_port is not a part of the key
+        with pool.acquire(self.conn_info._replace(receive_port=105)):
+            pass
+        self.assertEqual(len(pool.created), 2)
+
+    def test_dead_association(self):
+        pool = FakePool()
+        with pool.acquire(self.conn_info) as assoc:
+            pass
+        assoc.is_established = False
+        with pool.acquire(self.conn_info) as new_assoc:
+            self.assertIsNot(assoc, new_assoc)
+
+    def test_echo(self):
+        pool = FakePool(echo_after=0)
+        with pool.acquire(self.conn_info) as assoc:
+            pass
+        with pool.acquire(self.conn_info):
+            pass
+        self.assertEqual(assoc.n_echo, 1)
+
+    def test_exception(self):
+        pool = FakePool()
+        with self.assertRaises(RuntimeError):
+            with pool.acquire(self.conn_info) as assoc:
+                raise RuntimeError('Test AssociationPool')
+        self.assertFalse(assoc.is_established)
+        with pool.acquire(self.conn_info) as new_assoc:
+            self.assertIsNot(assoc, new_assoc)
+
+    def test_idle_timeout(self):
+        pool = FakePool(idle_timeout=0)
+        with pool.acquire(self.conn_info) as assoc:
+            pass
+        time.sleep(0.01)
+        with pool.acquire(self.conn_info) as new_assoc:
+            self.assertIsNot(assoc, new_assoc)
+        self.assertFalse(assoc.is_established)
+
+    def test_reaper(self):
+        pool = FakePool(idle_timeout=0.1)
+        with pool.acquire(self.conn_info) as assoc:
+            pass
+        # released without another checkout
+        for _ in range(50):
+            if not assoc.is_established:
+                break
+            time.sleep(0.05)
+        self.assertFalse(assoc.is_established)
+        self.assertEqual(pool._count[pool._key(self.conn_info)], 0)
+
+    def test_max_per_server(self):
+        pool = FakePool(max_per_server=1)
+        acquired = threading.Event()
+
+        def target():
+            with pool.acquire(self.conn_info):
+                acquired.set()
+
+        with pool.acquire(self.conn_info):
+            thread = threading.Thread(target=target)
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+        thread.join(1)
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(len(pool.created), 1)
+
+    def test_close_all(self):
+        pool = FakePool()
+        with pool.acquire(self.conn_info) as assoc:
+            pass
+        pool.close_all()
+        self.assertFalse(assoc.is_established)
+
+    def test_transfer_syntaxes(self):
+        pool = AssociationPool([
+            PatientRootQueryRetrieveInformationModelGet,
+            build_context(CTImageStorage, ALL_TRANSFER_SYNTAXES)
+        ])
+        contexts = {
+            cx.abstract_syntax: cx.transfer_syntax
+            for cx in pool._ae('AUTOQR').requested_contexts
+        }
+        self.assertEqual(
+            contexts[PatientRootQueryRetrieveInformationModelGet],
+            DEFAULT_TRANSFER_SYNTAXES)
+        self.assertEqual(contexts[CTImageStorage], ALL_TRANSFER_SYNTAXES)
@@ -0,0 +1,271 @@
+import unittest
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+from concurrent.futures import Future
+from pathlib import Path
+from logzero import logger
+import pandas as pd
+from pydicom.dataset import Dataset
+import journal
+from config import settings
+
+try:
+    import qr
+    import autoqr
+except FileNotFoundError:  # config/.salt is not in the repository
+    autoqr = None
+
+
+def fake_qr_anonymize_save(PatientID,
+                           AccessionNumber,
+                           StudyInstanceUID,
+                           outdir,
+                           conn_info=None,
+                           error=None,
+                           on_anonymized=None,
+                           on_retrieved=None,
+                           **kwargs):
+    '''
+    Retrieval followed by an anonymization that is over immediately like STREAM_ANONYMIZE
+    '''
+    on_retrieved()
+    future = Future()
+    future.add_done_callback(on_anonymized)
+    if error is None:
+        future.set_result([])
+    else:
+        future.set_exception(error)
+    return 'new_pid', 'new_an', 'new_study_uid', '20200101'
+
+
+@unittest.skipIf(autoqr is None, 'config/.salt is required')
+class TestJournalState(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.interval = settings.INTERVAL
+        settings.INTERVAL = 0
+        self.autoqr = autoqr.AutoQR(self.tempdir.name, logger)
+        self.autoqr.tid2conn_info[threading.get_ident(
+        )] = qr.ConnectionInformation(None, None, None, 'AUTOQR', 104)
+        self.args = ('PID1', 'AN1', '1.2.3')
+        self.autoqr.set_df(
+            pd.DataFrame([self.args],
+                         columns=[
+                             settings.COL_PATIENT_ID,
+                             settings.COL_ACCESSION_NUMBER,
+                             settings.COL_STUDY_INSTANCE_UID
+                         ]))
+
+    def tearDown(self):
+        self.autoqr.journal.close()
+        settings.INTERVAL = self.interval
+        self.tempdir.cleanup()
+
+    def run_job(self, error=None):
+        with mock.patch.object(qr, 'qr_anonymize_save',
+                               side_effect=lambda *args, **kwargs:
+                               fake_qr_anonymize_save(
+                                   *args, error=error, **kwargs)):
+            self.autoqr._job(self.args, [])
+        return self.autoqr.journal.states([self.args[2]])[self.args[2]][0]
+
+    def test_anonymized(self):
+        self.assertEqual(self.run_job(), journal.ANONYMIZED)
+
+    def test_failed(self):
+        self.assertEqual(self.run_job(RuntimeError('broken')), journal.FAILED)
+
+    def test_replace_outputs(self):
+        # outputs left by a crash are not finished since the study is queued again
+        with mock.patch.object(qr,
+                               'qr_anonymize_save',
+                               side_effect=fake_qr_anonymize_save) as save:
+            self.autoqr._job(self.args, [])
+        self.assertTrue(save.call_args.kwargs['replace_outputs'])
+
+
+def create_series(study_uid, source):
+    ds = Dataset()
+    ds.PatientID = 'PID1'
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = study_uid + '.1'
+    ds.SeriesDescription = source
+    ds.NumberOfSeriesRelatedInstances = 1
+    return [ds]
+
+
+@unittest.skipIf(autoqr is None, 'config/.salt is required')
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.interval = settings.INTERVAL
+        settings.INTERVAL = 0
+        self.resolve_gate = threading.Event()
+        self.saved = {}
+        self.all_saved = threading.Event()
+
+    def tearDown(self):
+        settings.INTERVAL = self.interval
+        self.tempdir.cleanup()
+
+    def resolve_series(self, studies, *args, **kwargs):
+        # the first batch is resolved after the worker took 1.2.3
+        self.resolve_gate.wait(10)
+        return {
+            study_uid: create_series(study_uid, 'resolved')
+            for _, study_uid in studies
+        }
+
+    def query_series(self, PatientID, StudyInstanceUID, *args, **kwargs):
+        self.resolve_gate.set()
+        # hold the prefetcher until the resolver is done with both studies
+        for _ in range(1000):
+            with self.aqr.resolve_cond:
+                if (StudyInstanceUID not in self.aqr.taken
+                        and '1.2.4' in self.aqr.resolved):
+                    break
+            time.sleep(0.01)
+        return create_series(StudyInstanceUID, 'queried')
+
+    def qr_anonymize_save(self, PatientID, AccessionNumber, StudyInstanceUID,
+                          outdir, conn_info, series, **kwargs):
+        self.saved.setdefault(StudyInstanceUID, []).append(
+            series[0].SeriesDescription)
+        if len(self.saved) == 2:
+            self.all_saved.set()
+        return fake_qr_anonymize_save(PatientID, AccessionNumber,
+                                      StudyInstanceUID, outdir, conn_info,
+                                      **kwargs)
+
+    def test_handoff(self):
+        self.aqr = autoqr.AutoQR(self.tempdir.name, logger)
+        with mock.patch.object(
+                qr, 'resolve_series',
+                side_effect=self.resolve_series), mock.patch.object(
+                    qr, 'query_series',
+                    side_effect=self.query_series) as query_series, \
+                mock.patch.object(qr, 'qr_anonymize_save',
+                                  side_effect=self.qr_anonymize_save):
+            self.aqr.set_df(
+                pd.DataFrame([('PID1', 'AN1', '1.2.3'),
+                              ('PID1', 'AN2', '1.2.4')],
+                             columns=[
+                                 settings.COL_PATIENT_ID,
+                                 settings.COL_ACCESSION_NUMBER,
+                                 settings.COL_STUDY_INSTANCE_UID
+                             ]))
+            self.aqr.sched_event.event.set()
+            self.assertTrue(self.all_saved.wait(10))
+            self.aqr.ready_queue.join()
+        self.aqr.sched_event.event.clear()
+        # 1.2.3 was taken before its batch was resolved, so it is queried by the prefetcher
+        self.assertEqual([call[0][1] for call in query_series.call_args_list],
+                         ['1.2.3'])
+        self.assertEqual(self.saved, {
+            '1.2.3': ['queried'],
+            '1.2.4': ['resolved']
+        })
+        # nothing is left behind for a later run of the same studies
+        self.assertEqual(self.aqr.resolved, {})
+        self.assertEqual(self.aqr.taken, set())
+        if self.aqr.journal is not None:
+            self.aqr.journal.close()
+
+
+@unittest.skipIf(autoqr is None, 'config/.salt is required')
+class TestSetDf(unittest.TestCase):
+    def test_set_df(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            aqr = autoqr.AutoQR(tempdir, logger)
+            df = pd.DataFrame([('PID1', 'AN1', '1.2.3'),
+                               ('PID1', 'AN1', '1.2.3'),
+                               ('PID2', 'AN2', '1.2.4')],
+                              columns=[
+                                  settings.COL_PATIENT_ID,
+                                  settings.COL_ACCESSION_NUMBER,
+                                  settings.COL_STUDY_INSTANCE_UID
+                              ])
+            df = aqr.set_df(df)
+            self.assertEqual(list(df[settings.COL_STUDY_INSTANCE_UID]),
+                             ['1.2.3', '1.2.4'])
+            self.assertEqual(aqr.task_queue.qsize(), 2)
+            if aqr.journal is not None:
+                aqr.journal.close()
+
+
+@unittest.skipIf(autoqr is None, 'config/.salt is required')
+class TestPartialDirectory(unittest.TestCase):
+    def test_partial_directory(self):
+        first = qr.partial_directory('1.2.3.999')
+        second = qr.partial_directory('1.2.3.999')
+        self.assertNotEqual(first, second)
+        for outdir in [first, second]:
+            (outdir / '1.2.3.999.1').write_bytes(b'')
+            qr.release_partial_directory(outdir)
+        # only the study directory is kept to resume from
+        self.assertTrue((first / '1.2.3.999.1').exists())
+        self.assertFalse(second.exists())
+        # the study directory is used again once released
+        self.assertEqual(qr.partial_directory('1.2.3.999'), first)
+        qr.release_partial_directory(first)
+        shutil.rmtree(first)
+
+
+def create_df(rows):
+    df = pd.DataFrame(rows,
+                      columns=[
+                          settings.COL_PATIENT_ID,
+                          settings.COL_ACCESSION_NUMBER,
+                          settings.COL_STUDY_INSTANCE_UID,
+                          settings.COL_STUDY_DATE
+                      ])
+    return autoqr.add_datetime(df)
+
+
+@unittest.skipIf(autoqr is None, 'config/.salt is required')
+class TestRemoveExisting(unittest.TestCase):
+    def test_layouts(self):
+        rows = [('PID{}'.format(i), 'AN{}'.format(i), '1.2.{}'.format(i),
+                 '2020010{}'.format(i % 2 + 1)) for i in range(6)]
+        with tempfile.TemporaryDirectory() as tempdir:
+            basedir = Path(tempdir)
+
+            def study_dir(i):
+                pid, _, study_uid, date = rows[i]
+                outdir = qr.get_output_directory(basedir, date[:4], date[4:],
+                                                 pid, study_uid)
+                outdir.mkdir(parents=True)
+                return outdir
+
+            # directory, zip and tar outputs
+            (study_dir(0) / '1.2.3.1').mkdir()
+            (study_dir(1) / '1.2.3.1.zip').write_bytes(b'')
+            (study_dir(3) / '1.2.3.1.tar').write_bytes(b'')
+            # study directory without output
+            study_dir(4)
+            # output of another patient with an original StudyInstanceUID
+            other = basedir / '2020' / '0101' / 'other' / '1.2.2'
+            other.mkdir(parents=True)
+            (other / '1.2.3.1.zip').write_bytes(b'')
+
+            df = autoqr.remove_existing(create_df(rows), basedir)
+            self.assertEqual(list(df[settings.COL_STUDY_INSTANCE_UID]),
+                             ['1.2.2', '1.2.4', '1.2.5'])
+
+    def test_empty(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            df = autoqr.remove_existing(create_df([]), Path(tempdir))
+            self.assertEqual(len(df), 0)
+
+            # no output directory
+            df = autoqr.remove_existing(
+                create_df([('PID1', 'AN1', '1.2.3', '20200101')]),
+                Path(tempdir) / 'none')
+            self.assertEqual(len(df), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
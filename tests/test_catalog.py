@@ -0,0 +1,186 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+from pydicom.dataset import Dataset
+from freezegun import freeze_time
+
+from catalog import Catalog, match
+
+
+def study(uid, date, modality='CT'):
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.StudyInstanceUID = uid
+    ds.StudyDate = date
+    ds.ModalitiesInStudy = modality
+    return ds
+
+
+def study_query(date, modality=''):
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.StudyInstanceUID = ''
+    ds.StudyDate = date
+    ds.ModalitiesInStudy = modality
+    return ds
+
+
+class FakeServer():
+    def __init__(self, identifiers):
+        self.identifiers = identifiers
+        self.queries = []
+
+    def fetch(self, ds):
+        self.queries.append(ds.StudyDate)
+        return (i for i in self.identifiers if match(i, ds))
+
+
+@freeze_time('2021-01-31')
+class TestCatalog(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestCatalog, self).__init__(*args, **kwargs)
+        self.server = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = Path(self.tmpdir.name) / 'catalog.sqlite'
+        self.server = FakeServer([
+            study('1.1', '20210101'),
+            study('1.2', '20210102', 'MR'),
+            study('1.3', '20210104'),
+            study('1.4', '20210130'),
+        ])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def uids(self, catalog, ds, **kwargs):
+        return [
+            i.StudyInstanceUID
+            for i in catalog.iter_query(ds, self.server.fetch, **kwargs)
+        ]
+
+    def test_cached(self):
+        catalog = Catalog(self.filename)
+        self.assertEqual(self.uids(catalog, study_query('20210101-20210103')),
+                         ['1.1', '1.2'])
+        self.assertEqual(self.uids(catalog, study_query('20210101-20210103')),
+                         ['1.1', '1.2'])
+        self.assertEqual(self.server.queries, ['20210101-20210103'])
+
+        # only unknown days are fetched
+        self.assertEqual(self.uids(catalog, study_query('20210102-20210105')),
+                         ['1.2', '1.3'])
+        self.assertEqual(self.server.queries[1:], ['20210104-20210105'])
+
+        # persisted
+        catalog.close()
+        catalog = Catalog(self.filename)
+        self.assertEqual(self.uids(catalog, study_query('20210101-20210105')),
+                         ['1.1', '1.2', '1.3'])
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_signature(self):
+        catalog = Catalog(self.filename)
+        self.uids(catalog, study_query('20210101-20210103'))
+        self.assertEqual(
+            self.uids(catalog, study_query('20210101-20210103', 'MR')),
+            ['1.2'])
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_recent_days(self):
+        catalog = Catalog(self.filename, recent_days=2)
+        self.uids(catalog, study_query('20210129-20210131'))
+        self.uids(catalog, study_query('20210129-20210131'))
+        self.assertEqual(self.server.queries,
+                         ['20210129-20210131', '20210129-20210131'])
+
+    def test_recent_study_uid(self):
+        def series(uid, study_uid, date):
+            ds = Dataset()
+            ds.QueryRetrieveLevel = 'SERIES'
+            ds.SeriesInstanceUID = uid
+            ds.StudyInstanceUID = study_uid
+            ds.StudyDate = date
+            return ds
+
+        server = FakeServer([
+            series('1.1.1', '1.1', '20210101'),
+            series('1.4.1', '1.4', '20210130'),
+        ])
+        queries = []
+
+        def fetch(ds):
+            queries.append(ds.StudyInstanceUID)
+            return server.fetch(ds)
+
+        def query(study_uids, **kwargs):
+            ds = series('', '\\'.join(study_uids), '')
+            return [
+                i.SeriesInstanceUID
+                for i in catalog.iter_query(ds, fetch, **kwargs)
+            ]
+
+        catalog = Catalog(self.filename, recent_days=2)
+        self.assertEqual(query(['1.1', '1.4']), ['1.1.1', '1.4.1'])
+        # the recent study is fetched again
+        self.assertEqual(query(['1.1', '1.4']), ['1.1.1', '1.4.1'])
+        self.assertEqual(queries, [['1.1', '1.4'], '1.4'])
+        self.assertEqual(query(['1.1'], refresh=True), ['1.1.1'])
+        self.assertEqual(queries[2:], ['1.1'])
+
+    def test_max_age(self):
+        with freeze_time('2021-01-31 00:00:00'):
+            catalog = Catalog(self.filename, max_age=3600)
+            self.uids(catalog, study_query('20210101'))
+        with freeze_time('2021-01-31 00:30:00'):
+            self.uids(catalog, study_query('20210101'))
+        self.assertEqual(len(self.server.queries), 1)
+        with freeze_time('2021-01-31 02:00:00'):
+            self.uids(catalog, study_query('20210101'))
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_limit(self):
+        catalog = Catalog(self.filename, limit=2)
+        self.uids(catalog, study_query('20210101-20210103'))
+        self.uids(catalog, study_query('20210101-20210103'))
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_closed_early(self):
+        catalog = Catalog(self.filename)
+        results = catalog.iter_query(study_query('20210101-20210103'),
+                                     self.server.fetch)
+        next(results)
+        results.close()
+        self.uids(catalog, study_query('20210101-20210103'))
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_offline(self):
+        catalog = Catalog(self.filename)
+        self.assertEqual(
+            self.uids(catalog, study_query('20210101-20210105'), offline=True),
+            [])
+        self.uids(catalog, study_query('20210101-20210103'))
+        self.assertEqual(
+            self.uids(catalog, study_query('20210101-20210105'), offline=True),
+            ['1.1', '1.2'])
+        self.assertEqual(len(self.server.queries), 1)
+
+
+class TestMatch(unittest.TestCase):
+    def test_match(self):
+        identifier = study('1.2.3', '20210102', 'MR')
+        identifier.PatientName = 'Doe^John'
+        query = study_query('20210101-20210103')
+        self.assertTrue(match(identifier, query))
+        query.StudyInstanceUID = '1.2.4\\1.2.3'
+        self.assertTrue(match(identifier, query))
+        query.PatientName = 'Doe*'
+        self.assertTrue(match(identifier, query))
+        query.ModalitiesInStudy = 'CT'
+        self.assertFalse(match(identifier, query))
+        query = study_query('20210103-')
+        self.assertFalse(match(identifier, query))
+        query.AccessionNumber = 'A1'
+        self.assertFalse(match(study('1.2.3', '20210104'), query))
@@ -1,5 +1,6 @@
 import unittest
-from datetime import datetime
+import random
+from datetime import datetime, timedelta, time
 
 import date_utils
 
@@ -77,3 +78,139 @@ class TestDateUtils(unittest.TestCase):
         self.assertEqual(split_result[1][1], datetime(2001, 1, 4))
         self.assertEqual(split_result[-1][0], datetime(2001, 1, 8))
         self.assertEqual(split_result[-1][1], end)
+
+    def test_part2query(self):
+        self.assertEqual(
+            date_utils.part2query(datetime(2000, 1, 1), datetime(2000, 1, 3)),
+            ('20000101-20000103', ''))
+        self.assertEqual(
+            date_utils.part2query(datetime(2000, 1, 1),
+                                  datetime(2000, 1, 1, 11, 59, 59)),
+            ('20000101', '000000-115959.999999'))
+        self.assertEqual(date_utils.part2query(datetime(2000, 1, 1), None),
+                         ('20000101', date_utils.EMPTY_TIME))
+
+
+def make_query(events, limit, calls, no_time=()):
+    '''
+    Fake query that matches StudyDate and StudyTime from part2query and returns at most limit events
+
+    Args:
+        no_time (list): Events without StudyTime
+    '''
+    def query(part_start, part_end):
+        calls.append((part_start, part_end))
+        study_date, study_time = date_utils.part2query(part_start, part_end)
+        if study_time == date_utils.EMPTY_TIME:
+            found = [
+                e for e in no_time if date_utils.date2str(e) == study_date
+            ]
+            return found[:limit]
+        dates = study_date.split('-')
+        times = (study_time or '000000-235959.999999').split('-')
+        found = [
+            e for e in events
+            if dates[0] <= date_utils.date2str(e) <= dates[-1]
+            and times[0] <= e.strftime('%H%M%S.%f') <= times[1]
+        ]
+        return found[:limit]
+
+    return query
+
+
+class TestAdaptiveSplit(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestAdaptiveSplit, self).__init__(*args, **kwargs)
+
+    def test_no_truncation(self):
+        random.seed(0)
+        start = datetime(2000, 1, 1)
+        end = datetime(2000, 3, 31)
+        events = [
+            start + timedelta(seconds=random.randrange(91 * 24 * 3600))
+            for _ in range(500)
+        ]
+        # busy day
+        events += [
+            datetime(2000, 2, 1, 8) + timedelta(seconds=i * 30)
+            for i in range(100)
+        ]
+        events.sort()
+        limit = 20
+        calls = []
+        parts = list(
+            date_utils.adaptive_split(start, end, 7,
+                                      make_query(events, limit, calls), limit))
+        found = sum([results for _, _, results in parts], [])
+        self.assertEqual(sorted(found), events)
+        for _, _, results in parts:
+            self.assertLess(len(results), limit)
+
+        # parts are contiguous
+        parts = [part for part in parts if part[1] is not None]
+        self.assertEqual(parts[0][0], start)
+        for (_, prev_end, _), (part_start, _, _) in zip(parts, parts[1:]):
+            if prev_end.time() == time(0):
+                prev_end = prev_end + timedelta(days=1)
+            else:
+                prev_end = prev_end + timedelta(seconds=1)
+            self.assertEqual(prev_end, part_start)
+
+    def test_sparse(self):
+        start = datetime(2000, 1, 1)
+        end = datetime(2000, 12, 31)
+        calls = []
+        parts = list(
+            date_utils.adaptive_split(start, end, 1, make_query([], 10, calls),
+                                      10))
+        self.assertEqual(parts[-1][1], end)
+        self.assertLess(len(calls), 10)
+
+        # max_step
+        calls = []
+        parts = list(
+            date_utils.adaptive_split(start,
+                                      end,
+                                      1,
+                                      make_query([], 10, calls),
+                                      10,
+                                      max_step=30))
+        self.assertEqual(len(calls), len(parts))
+        for part_start, part_end, _ in parts:
+            self.assertLessEqual((part_end - part_start).days + 1, 30)
+
+    def test_min_seconds(self):
+        start = datetime(2000, 1, 1)
+        events = [datetime(2000, 1, 1, 12)] * 5
+        calls = []
+        parts = list(
+            date_utils.adaptive_split(start,
+                                      start,
+                                      1,
+                                      make_query(events, 3, calls),
+                                      3,
+                                      min_seconds=3600))
+        truncated = [p for p in parts if len(p[2]) >= 3]
+        self.assertEqual(len(truncated), 1)
+        part_start, part_end, _ = truncated[0]
+        self.assertGreaterEqual((part_end - part_start).total_seconds() + 1,
+                                3600)
+
+    def test_time_boundaries(self):
+        start = datetime(2000, 1, 1)
+        # fractional seconds around the boundaries of the bisection
+        events = [
+            datetime(2000, 1, 1, 11, 59, 59, 500000),
+            datetime(2000, 1, 1, 12, 0, 0, 250000),
+            datetime(2000, 1, 1, 23, 59, 59, 999999),
+        ] + [datetime(2000, 1, 1, 8) + timedelta(minutes=i) for i in range(6)]
+        no_time = [start] * 2
+        limit = 4
+        calls = []
+        parts = list(
+            date_utils.adaptive_split(start, start, 1,
+                                      make_query(events, limit, calls,
+                                                 no_time), limit))
+        found = sum([results for _, _, results in parts], [])
+        self.assertEqual(sorted(found), sorted(events + no_time))
+        self.assertEqual([p[2] for p in parts if p[1] is None], [no_time])
@@ -0,0 +1,220 @@
+import io
+import os
+import unittest
+import zipfile
+import tempfile
+from pathlib import Path
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, ExplicitVRBigEndian, JPEGBaseline8Bit
+import dcm_utils
+
+
+def create_dataset(transfer_syntax=ExplicitVRLittleEndian):
+    dcm = Dataset()
+    dcm.file_meta = FileMetaDataset()
+    dcm.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    dcm.file_meta.MediaStorageSOPInstanceUID = '1.2.3.4.5'
+    dcm.file_meta.TransferSyntaxUID = transfer_syntax
+    dcm.file_meta.ImplementationClassUID = '1.2.3'
+    dcm.file_meta.SourceApplicationEntityTitle = 'SOURCE'
+    dcm.SOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    dcm.SOPInstanceUID = '1.2.3.4.5'
+    dcm.AccessionNumber = 'AN1'
+    dcm.InstitutionName = 'Hospital'
+    dcm.PatientName = 'Doe^John'
+    dcm.PatientID = 'PID1'
+    dcm.StudyInstanceUID = '1.2.3.4'
+    dcm.SeriesInstanceUID = '1.2.3.4.1'
+    item = Dataset()
+    item.ReferencedSOPInstanceUID = '1.2.3.9'
+    dcm.ReferencedImageSequence = Sequence([item])
+    dcm.Rows = 2
+    dcm.Columns = 2
+    dcm.BitsAllocated = 8
+    if transfer_syntax == JPEGBaseline8Bit:
+        dcm.PixelData = encapsulate([b'\xff\xd8\x00\xff\xd9\x00'])
+        dcm['PixelData'].VR = 'OB'
+    else:
+        dcm.PixelData = b'\x00\x01\x02\x03'
+    with io.BytesIO() as bio:
+        dcm.save_as(bio, enforce_file_format=True)
+        return bio.getvalue()
+
+
+REPLACE_RULES = [
+    ((0x0002, 0x0003), lambda dcm: dcm.file_meta.MediaStorageSOPInstanceUID + '.1'),
+    ((0x0008, 0x0018), lambda dcm: dcm.SOPInstanceUID + '.1'),
+    ((0x0008, 0x0050), 'NEWAN'),
+    ((0x0010, 0x0010), 'NEWPID'),
+    ((0x0010, 0x0020), 'NEWPID'),
+    ((0x0020, 0x000d), '1.2.3.44'),
+    ((0x0040, 0x1400), 'comment'),  # not in the dataset
+]
+REMOVE_RULES = [(0x0002, 0x0016), (0x0008, 0x0080), (0x0008, 0x1140)]
+PLAN = dcm_utils.AnonymizationPlan(REPLACE_RULES, REMOVE_RULES)
+
+
+class TestRewriteBytes(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestRewriteBytes, self).__init__(*args, **kwargs)
+
+    def assert_same_as_pydicom(self, data):
+        expected = pydicom.dcmread(io.BytesIO(data))
+        dcm_utils.apply_rules(expected, REPLACE_RULES, REMOVE_RULES)
+        expected = pydicom.dcmread(io.BytesIO(dcm_utils.dcm2bytes(expected)))
+        actual = pydicom.dcmread(
+            io.BytesIO(
+                dcm_utils.rewrite_bytes(data, PLAN)))
+        self.assertEqual(actual.file_meta, expected.file_meta)
+        self.assertEqual(actual, expected)
+        self.assertEqual(actual.RequestedProcedureComments, 'comment')
+        self.assertNotIn('SourceApplicationEntityTitle', actual.file_meta)
+
+    def test_explicit(self):
+        self.assert_same_as_pydicom(create_dataset(ExplicitVRLittleEndian))
+
+    def test_implicit(self):
+        self.assert_same_as_pydicom(create_dataset(ImplicitVRLittleEndian))
+
+    def test_encapsulated(self):
+        self.assert_same_as_pydicom(create_dataset(JPEGBaseline8Bit))
+
+    def test_unsupported(self):
+        data = create_dataset(ExplicitVRBigEndian)
+        with self.assertRaises(dcm_utils.UnsupportedDicom):
+            dcm_utils.rewrite_bytes(data, PLAN)
+        with self.assertRaises(dcm_utils.UnsupportedDicom):
+            dcm_utils.rewrite_bytes(b'\x00' * 128, PLAN)
+        with self.assertRaises(dcm_utils.UnsupportedDicom):
+            dcm_utils.rewrite_bytes(create_dataset()[:-3], PLAN)
+
+        # fall back to pydicom
+        dcm = pydicom.dcmread(
+            io.BytesIO(
+                dcm_utils.anonymized_bytes(data, PLAN)))
+        self.assertEqual(dcm.PatientID, 'NEWPID')
+        self.assertNotIn('InstitutionName', dcm)
+
+    def test_non_ascii(self):
+        plan = dcm_utils.AnonymizationPlan(
+            REPLACE_RULES + [((0x0008, 0x0080), 'Ünknown')], [])
+        data = create_dataset()
+        with self.assertRaises(dcm_utils.UnsupportedDicom):
+            dcm_utils.rewrite_bytes(data, plan)
+        # fall back to pydicom
+        dcm = pydicom.dcmread(
+            io.BytesIO(dcm_utils.anonymized_bytes(data, plan)))
+        self.assertEqual(dcm.PatientID, 'NEWPID')
+        self.assertEqual(dcm['InstitutionName'].value, 'Ünknown')
+
+
+class TestIndexSeries(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestIndexSeries, self).__init__(*args, **kwargs)
+
+    def test_read_series_uid(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for transfer_syntax in [
+                    ExplicitVRLittleEndian, ImplicitVRLittleEndian,
+                    ExplicitVRBigEndian, JPEGBaseline8Bit
+            ]:
+                filename = Path(tempdir) / 'test.dcm'
+                filename.write_bytes(create_dataset(transfer_syntax))
+                self.assertEqual(dcm_utils.read_series_uid(str(filename)),
+                                 '1.2.3.4.1')
+
+    def test_index_series(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            tempdir = Path(tempdir)
+            for i in range(4):
+                dcm = pydicom.dcmread(io.BytesIO(create_dataset()))
+                dcm.SeriesInstanceUID = '1.2.3.4.{}'.format(i % 2)
+                dcm.save_as(tempdir / 'IMG{}.dcm'.format(i))
+            (tempdir / 'subdir').mkdir()
+            index = dcm_utils.index_series(tempdir)
+            self.assertEqual(
+                index, {
+                    '1.2.3.4.0':
+                    [str(tempdir / 'IMG0.dcm'),
+                     str(tempdir / 'IMG2.dcm')],
+                    '1.2.3.4.1':
+                    [str(tempdir / 'IMG1.dcm'),
+                     str(tempdir / 'IMG3.dcm')],
+                })
+
+    def test_is_complete(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = Path(tempdir) / 'test.dcm'
+            for transfer_syntax in [
+                    ExplicitVRLittleEndian, ImplicitVRLittleEndian,
+                    ExplicitVRBigEndian, JPEGBaseline8Bit
+            ]:
+                data = create_dataset(transfer_syntax)
+                filename.write_bytes(data)
+                self.assertTrue(dcm_utils.is_complete(str(filename)))
+                # cut inside Pixel Data
+                filename.write_bytes(data[:-3])
+                self.assertFalse(dcm_utils.is_complete(str(filename)),
+                                 transfer_syntax)
+            filename.write_bytes(data[:100])
+            self.assertFalse(dcm_utils.is_complete(str(filename)))
+
+
+class TestSaveAsZip(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestSaveAsZip, self).__init__(*args, **kwargs)
+
+    def test_roundtrip(self):
+        contents = [('zeros', b'\x00' * 100000), ('random', os.urandom(100000)),
+                    ('jpeg', create_dataset(JPEGBaseline8Bit)),
+                    ('empty', b'')]
+        for workers in [1, 4]:
+            data = dcm_utils.save_as_zip(contents, 1, workers=workers)
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual([(info.filename, info.compress_type)
+                                  for info in zf.infolist()],
+                                 [('zeros', zipfile.ZIP_DEFLATED),
+                                  ('random', zipfile.ZIP_STORED),
+                                  ('jpeg', zipfile.ZIP_STORED),
+                                  ('empty', zipfile.ZIP_STORED)])
+                for filename, content in contents:
+                    self.assertEqual(zf.read(filename), content)
+
+    def test_no_compression(self):
+        data = dcm_utils.save_as_zip([('zeros', b'\x00' * 100000)], -1)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertEqual(zf.getinfo('zeros').compress_type,
+                             zipfile.ZIP_STORED)
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            zip_filename = str(Path(tempdir) / 'test.zip')
+            dcm_utils.save_as_zip([('IMG0.dcm', create_dataset())], 1,
+                                  zip_filename, 2)
+            with zipfile.ZipFile(zip_filename) as zf:
+                self.assertEqual(zf.read('IMG0.dcm'), create_dataset())
+
+
+class TestAnonymizationPlan(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestAnonymizationPlan, self).__init__(*args, **kwargs)
+
+    def test_apply(self):
+        dcms = [pydicom.dcmread(io.BytesIO(create_dataset())) for _ in range(2)]
+        dcms[1].SOPInstanceUID = '1.2.3.4.6'
+        generator = dcm_utils.DcmGenerator(dcms, REPLACE_RULES, REMOVE_RULES)
+        dcm0, dcm1 = list(generator)
+        self.assertEqual(dcm0.SOPInstanceUID, '1.2.3.4.5.1')
+        self.assertEqual(dcm1.SOPInstanceUID, '1.2.3.4.6.1')
+        self.assertEqual(dcm1.PatientID, 'NEWPID')
+        self.assertEqual(dcm1.RequestedProcedureComments, 'comment')
+        self.assertNotIn('InstitutionName', dcm1)
+        self.assertNotIn('SourceApplicationEntityTitle', dcm1.file_meta)
+
+        # elements of static values are not shared
+        dcm0.PatientID = 'changed'
+        self.assertEqual(dcm1.PatientID, 'NEWPID')
@@ -0,0 +1,63 @@
+import unittest
+
+from dispatcher import Dispatcher
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class TestDispatcher(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestDispatcher, self).__init__(*args, **kwargs)
+        self.servers = [('fast', 'FAST-SCP', 104), ('slow', 'SLOW-SCP', 104)]
+
+    def test_spread(self):
+        dispatcher = Dispatcher(self.servers)
+        # no measurement yet
+        self.assertEqual(sorted([dispatcher.acquire(),
+                                 dispatcher.acquire()]), [0, 1])
+
+    def test_throughput(self):
+        dispatcher = Dispatcher(self.servers)
+        for _ in range(3):
+            dispatcher.acquire(exclude=[1])
+            dispatcher.acquire(exclude=[0])
+            dispatcher.release(0, seconds=10, n_instances=100, latency=1)
+            dispatcher.release(1, seconds=40, n_instances=100, latency=1)
+        self.assertEqual(dispatcher.server(dispatcher.acquire())[0], 'fast')
+        # jobs in flight are taken into account
+        self.assertEqual([dispatcher.acquire() for _ in range(3)], [0, 0, 1])
+
+    def test_error_rate(self):
+        dispatcher = Dispatcher(self.servers)
+        for _ in range(3):
+            dispatcher.acquire(exclude=[1])
+            dispatcher.acquire(exclude=[0])
+            dispatcher.release(0, error=True)
+            dispatcher.release(1, seconds=10, n_instances=100, latency=1)
+        self.assertEqual(dispatcher.acquire(), 1)
+
+    def test_failover(self):
+        clock = FakeClock()
+        dispatcher = Dispatcher(self.servers, cooldown=60, clock=clock)
+        index = dispatcher.acquire()
+        dispatcher.release(index, refused=True)
+        self.assertEqual(dispatcher.acquire(exclude=[index]), 1 - index)
+        self.assertEqual(dispatcher.acquire(), 1 - index)
+
+        # all servers are down
+        clock.now = 10
+        dispatcher.release(1 - index, refused=True)
+        clock.now = 30
+        self.assertEqual(dispatcher.acquire(), index)
+        dispatcher.release(index, refused=True)
+        self.assertEqual(dispatcher.acquire(), 1 - index)
+
+        # cooldown expired
+        clock.now = 71
+        self.assertEqual(dispatcher.acquire(), 1 - index)
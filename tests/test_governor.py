@@ -0,0 +1,46 @@
+import unittest
+import tempfile
+import shutil
+from pathlib import Path
+from governor import DiskGovernor
+
+
+class TestDiskGovernor(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestDiskGovernor, self).__init__(*args, **kwargs)
+
+    def test_reserve(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            free = shutil.disk_usage(tempdir).free
+            self.assertTrue(DiskGovernor([tempdir], 0).is_ok())
+            self.assertFalse(DiskGovernor([tempdir], free + 2**30).is_ok())
+
+    def test_pending(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            governor = DiskGovernor([tempdir], 0)
+            n_bytes = shutil.disk_usage(tempdir).free + 2**30
+            governor.acquire(n_bytes)
+            self.assertFalse(governor.is_ok())
+            governor.release(n_bytes)
+            self.assertTrue(governor.is_ok())
+
+    def test_same_filesystem(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            # both directories need the pending bytes
+            governor = DiskGovernor([tempdir, Path(tempdir) / 'not_yet'], 0)
+            governor.acquire(shutil.disk_usage(tempdir).free // 2 + 2**30)
+            shortages = governor.shortages()
+            self.assertEqual(len(shortages), 1)
+            self.assertEqual(shortages[0][0], str(Path(tempdir).absolute()))
+
+    def test_estimate(self):
+        governor = DiskGovernor([], 0, instance_size=100, study_instances=10)
+        self.assertEqual(governor.estimate(5), 500)
+        self.assertEqual(governor.estimate(), 1000)
+        governor.observe(200 * 20, 20)
+        self.assertEqual(governor.estimate(5), 600)
+        self.assertEqual(governor.estimate(), 1440)
+
+
+if __name__ == "__main__":
+    unittest.main()
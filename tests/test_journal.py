@@ -0,0 +1,67 @@
+import unittest
+import tempfile
+from pathlib import Path
+import journal
+
+
+class TestJournal(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestJournal, self).__init__(*args, **kwargs)
+
+    def test_states(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = Path(tempdir) / 'journal.sqlite'
+            j = journal.Journal(filename)
+            j.queue([('PID{}'.format(i), '', '1.2.{}'.format(i))
+                     for i in range(1000)])
+            j.update('1.2.1', journal.QUERIED)
+            j.update('1.2.2', journal.ANONYMIZED)
+            j.update('1.2.3', journal.FAILED, RuntimeError('No series'))
+            j.close()
+
+            j = journal.Journal(filename)
+            states = j.states(['1.2.{}'.format(i) for i in range(4)] +
+                              ['9.9.9'])
+            self.assertEqual(
+                states, {
+                    '1.2.0': (journal.QUEUED, ''),
+                    '1.2.1': (journal.QUERIED, ''),
+                    '1.2.2': (journal.ANONYMIZED, ''),
+                    '1.2.3': (journal.FAILED, 'No series'),
+                })
+            self.assertEqual(
+                j.counts(), {
+                    journal.QUEUED: 997,
+                    journal.QUERIED: 1,
+                    journal.ANONYMIZED: 1,
+                    journal.FAILED: 1
+                })
+
+            # queued again
+            j.queue([('PID3', '', '1.2.3')])
+            self.assertEqual(j.states(['1.2.3']),
+                             {'1.2.3': (journal.QUEUED, '')})
+            j.close()
+
+    def test_no_going_back(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            j = journal.Journal(Path(tempdir) / 'journal.sqlite')
+            j.queue([('PID1', '', '1.2.1'), ('PID2', '', '1.2.2')])
+            self.assertTrue(j.update('1.2.1', journal.RETRIEVED))
+            self.assertTrue(j.update('1.2.1', journal.ANONYMIZED))
+            # late update of the retrieval
+            self.assertFalse(j.update('1.2.1', journal.RETRIEVED))
+            self.assertFalse(j.update('1.2.1', journal.QUERIED))
+            self.assertTrue(j.update('1.2.2', journal.FAILED, 'error'))
+            self.assertFalse(j.update('1.2.2', journal.RETRIEVED))
+            self.assertFalse(j.update('1.2.2', journal.ANONYMIZED))
+            self.assertEqual(
+                j.states(['1.2.1', '1.2.2']), {
+                    '1.2.1': (journal.ANONYMIZED, ''),
+                    '1.2.2': (journal.FAILED, 'error'),
+                })
+            j.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import tempfile
+from pathlib import Path
+from pseudonym import PseudonymRegistry
+
+
+class Counter():
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, value):
+        self.count += 1
+        return 'pseudo_' + value
+
+
+class TestPseudonymRegistry(unittest.TestCase):
+    def test_memory(self):
+        registry = PseudonymRegistry()
+        counter = Counter()
+        for _ in range(3):
+            self.assertEqual(registry.get('PatientID', 'a',
+                                          lambda: counter('a')), 'pseudo_a')
+        self.assertEqual(counter.count, 1)
+
+    def test_lru(self):
+        registry = PseudonymRegistry(maxsize=2)
+        counter = Counter()
+        for value in ['a', 'b', 'a', 'c', 'a', 'b']:
+            registry.get('PatientID', value, lambda: counter(value))
+        # 'b' was evicted by 'c'
+        self.assertEqual(counter.count, 4)
+
+    def test_kinds(self):
+        registry = PseudonymRegistry()
+        registry.get('PatientID', 'a', lambda: 'x')
+        self.assertEqual(registry.get('AccessionNumber', 'a', lambda: 'y'),
+                         'y')
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = Path(tempdir) / 'pseudonyms.db'
+            registry = PseudonymRegistry(filename, fingerprint='salt')
+            registry.get('PatientID', 'a', lambda: 'x')
+            registry.close()
+
+            registry = PseudonymRegistry(filename, fingerprint='salt')
+            counter = Counter()
+            self.assertEqual(
+                registry.get('PatientID', 'a', lambda: counter('a')), 'x')
+            self.assertEqual(counter.count, 0)
+            registry.close()
+
+    def test_precompute(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = Path(tempdir) / 'pseudonyms.db'
+            registry = PseudonymRegistry(filename)
+            counter = Counter()
+            originals = [str(i) for i in range(1200)] * 2
+            self.assertEqual(registry.precompute('PatientID', originals,
+                                                 counter), 1200)
+            self.assertEqual(registry.precompute('PatientID', originals,
+                                                 counter), 0)
+            self.assertEqual(counter.count, 1200)
+            self.assertEqual(registry.get('PatientID', '5', lambda: 'x'),
+                             'pseudo_5')
+            registry.close()
+
+            registry = PseudonymRegistry(filename)
+            self.assertEqual(
+                registry.precompute('PatientID', originals + ['new'],
+                                    counter), 1)
+            registry.close()
+
+    def test_fingerprint(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = Path(tempdir) / 'pseudonyms.db'
+            PseudonymRegistry(filename, fingerprint='salt').close()
+            with self.assertRaises(RuntimeError):
+                PseudonymRegistry(filename, fingerprint='another salt')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,395 @@
+import io
+import os
+import unittest
+import tempfile
+from pathlib import Path
+from unittest import mock
+from types import SimpleNamespace
+from concurrent.futures import Future
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage
+from config import settings
+import storage_scp
+
+try:
+    import qr
+except FileNotFoundError:  # config/.salt is not in the repository
+    qr = None
+
+
+def create_series():
+    ds = Dataset()
+    ds.PatientID = 'PID1'
+    ds.StudyInstanceUID = '1.2.3'
+    ds.SeriesInstanceUID = '1.2.3.1'
+    ds.StudyDate = '20200101'
+    ds.SeriesNumber = 1
+    ds.NumberOfSeriesRelatedInstances = 1
+    return [ds]
+
+
+def create_instance(sop_uid, series_uid='1.2.3.1'):
+    '''
+    Return an encoded instance of the series created by create_series
+    '''
+    dcm = Dataset()
+    dcm.file_meta = FileMetaDataset()
+    dcm.file_meta.MediaStorageSOPClassUID = CTImageStorage
+    dcm.file_meta.MediaStorageSOPInstanceUID = sop_uid
+    dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm.SOPClassUID = CTImageStorage
+    dcm.SOPInstanceUID = sop_uid
+    dcm.PatientID = 'PID1'
+    dcm.StudyInstanceUID = '1.2.3'
+    dcm.SeriesInstanceUID = series_uid
+    dcm.BitsAllocated = 8
+    dcm.PixelData = b'\x00' * 64
+    with io.BytesIO() as bio:
+        dcm.save_as(bio, enforce_file_format=True)
+        return bio.getvalue()
+
+
+def image_identifiers(sop_uids):
+    identifiers = []
+    for sop_uid in sop_uids:
+        ds = Dataset()
+        ds.SOPInstanceUID = sop_uid
+        identifiers.append(ds)
+    return identifiers
+
+
+@unittest.skipIf(qr is None, 'config/.salt is required')
+class TestRetrieveMissing(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.outdir = Path(self.tempdir.name) / 'partial'
+        self.outdir.mkdir()
+        self.scratch_dir = settings.SCRATCH_DIR
+        settings.SCRATCH_DIR = self.tempdir.name
+
+    def tearDown(self):
+        settings.SCRATCH_DIR = self.scratch_dir
+        self.tempdir.cleanup()
+
+    def test_received_instances(self):
+        for sop_uid in ['1.2.3.1.1', '1.2.3.1.2']:
+            (self.outdir / sop_uid).write_bytes(create_instance(sop_uid))
+        # partially written when the retrieval was interrupted
+        (self.outdir / '1.2.3.1.3').write_bytes(
+            create_instance('1.2.3.1.3')[:-10])
+        self.assertEqual(qr.received_instances(self.outdir),
+                         {'1.2.3.1.1', '1.2.3.1.2'})
+        self.assertEqual(sorted(p.name for p in self.outdir.iterdir()),
+                         ['1.2.3.1.1', '1.2.3.1.2'])
+
+    def retrieve_missing(self, sop_uids):
+        with mock.patch.object(qr,
+                               'iter_query',
+                               return_value=image_identifiers(
+                                   sop_uids)), mock.patch.object(
+                                       qr, 'retrieve') as retrieve:
+            qr.retrieve_missing(create_series(), str(self.outdir), None)
+        return [call[0][0] for call in retrieve.call_args_list]
+
+    def test_missing_only(self):
+        (self.outdir / '1.2.3.1.1').write_bytes(create_instance('1.2.3.1.1'))
+        requested = self.retrieve_missing(
+            ['1.2.3.1.1', '1.2.3.1.2', '1.2.3.1.3'])
+        self.assertEqual(len(requested), 1)
+        self.assertEqual(list(requested[0].SOPInstanceUID),
+                         ['1.2.3.1.2', '1.2.3.1.3'])
+        self.assertEqual(requested[0].SeriesInstanceUID, '1.2.3.1')
+
+    def test_nothing_arrived(self):
+        # the whole series is retrieved at once
+        requested = self.retrieve_missing(['1.2.3.1.1', '1.2.3.1.2'])
+        self.assertEqual(len(requested), 1)
+        self.assertNotIn('SOPInstanceUID', requested[0])
+
+    def test_all_arrived(self):
+        (self.outdir / '1.2.3.1.1').write_bytes(create_instance('1.2.3.1.1'))
+        self.assertEqual(self.retrieve_missing(['1.2.3.1.1']), [])
+
+    def test_dcmtk_batches(self):
+        sop_uids = ['1.2.3.1.{}'.format(i) for i in range(450)]
+        ds = Dataset()
+        ds.PatientID = 'PID1'
+        ds.StudyInstanceUID = '1.2.3'
+        ds.SeriesInstanceUID = '1.2.3.1'
+        ds.SOPInstanceUID = '\\'.join(sop_uids)
+        conn_info = qr.ConnectionInformation('localhost', 'PACS', 104,
+                                             'AUTOQR', 11112)
+        with mock.patch.object(qr.subprocess, 'check_call') as check_call:
+            qr.retrieve_dcmtk(ds, str(self.outdir), conn_info)
+        batches = []
+        for call in check_call.call_args_list:
+            for arg in call[0][0]:
+                if arg.startswith('0008,0018='):
+                    batches.append(arg[len('0008,0018='):].split('\\'))
+        self.assertEqual([len(batch) for batch in batches], [200, 200, 50])
+        self.assertEqual(sum(batches, []), sop_uids)
+
+    def test_failed_retrieve(self):
+        def retrieve(ds, outdir, *args, **kwargs):
+            (Path(outdir) / '1.2.3.1.1').write_bytes(
+                create_instance('1.2.3.1.1'))
+            raise RuntimeError('connection lost')
+
+        retries = settings.RETRIEVE_RETRIES
+        settings.RETRIEVE_RETRIES = 0
+        try:
+            with mock.patch.object(qr, 'retrieve', side_effect=retrieve):
+                with self.assertRaises(RuntimeError):
+                    qr.qr_anonymize_save('PID1',
+                                         'AN1',
+                                         '1.2.3',
+                                         str(Path(self.tempdir.name) / 'out'),
+                                         series=create_series())
+        finally:
+            settings.RETRIEVE_RETRIES = retries
+        # kept for a later run, which retrieves the rest only
+        outdir = qr.partial_root() / '1.2.3'
+        self.assertEqual(qr.received_instances(outdir), {'1.2.3.1.1'})
+        self.assertNotIn(outdir, qr.partial_in_use)
+        self.assertEqual(qr.partial_directory('1.2.3'), outdir)
+        qr.release_partial_directory(outdir)
+
+
+class FakeFindServer():
+    '''
+    C-FIND of STUDY and SERIES levels over studies of {StudyInstanceUID: num of series}
+    '''
+    def __init__(self, studies, series_counts=True, limit=0):
+        self.studies = studies
+        self.series_counts = series_counts
+        self.limit = limit
+        self.queries = []
+
+    def iter_query(self, ds, *args, **kwargs):
+        study_uids = ds.StudyInstanceUID
+        if isinstance(study_uids, str):
+            study_uids = study_uids.split('\\')
+        study_uids = [uid for uid in study_uids if uid in self.studies]
+        self.queries.append((ds.QueryRetrieveLevel, len(study_uids)))
+        identifiers = []
+        for study_uid in study_uids:
+            if ds.QueryRetrieveLevel == 'STUDY':
+                identifier = Dataset()
+                identifier.StudyInstanceUID = study_uid
+                identifier.NumberOfStudyRelatedSeries = self.studies[
+                    study_uid] if self.series_counts else ''
+                identifiers.append(identifier)
+                continue
+            for i in range(self.studies[study_uid]):
+                identifier = Dataset()
+                identifier.PatientID = 'PID1'
+                identifier.StudyInstanceUID = study_uid
+                identifier.SeriesInstanceUID = '{}.{}'.format(study_uid, i)
+                identifier.Modality = 'CT' if i == 0 else 'SR'
+                identifiers.append(identifier)
+        if self.limit > 0:
+            identifiers = identifiers[:self.limit]
+        return iter(identifiers)
+
+
+@unittest.skipIf(qr is None, 'config/.salt is required')
+class TestResolveSeries(unittest.TestCase):
+    def setUp(self):
+        self.conn_info = qr.ConnectionInformation('localhost', 'PACS', 104,
+                                                  'AUTOQR', 11112)
+        qr.unbatched_servers.clear()
+
+    def tearDown(self):
+        qr.unbatched_servers.clear()
+
+    def resolve(self, server, study_uids=('1.1', '1.2', '1.3'), **kwargs):
+        with mock.patch.object(qr, 'iter_query', server.iter_query):
+            study2series = qr.resolve_series(
+                [('PID1', uid) for uid in study_uids], self.conn_info,
+                **kwargs)
+        return {
+            uid: [ds.SeriesInstanceUID for ds in datasets]
+            for uid, datasets in study2series.items()
+        }
+
+    def test_study_series_counts(self):
+        server = FakeFindServer({'1.1': 2, '1.2': 1})
+        with mock.patch.object(qr, 'iter_query', server.iter_query):
+            self.assertEqual(
+                qr.study_series_counts(['1.1', '1.2', '1.3'], self.conn_info),
+                {'1.1': 2, '1.2': 1})
+            server.series_counts = False
+            self.assertEqual(
+                qr.study_series_counts(['1.1', '1.2'], self.conn_info),
+                {'1.1': None, '1.2': None})
+
+    def test_batched(self):
+        server = FakeFindServer({'1.1': 2, '1.2': 1})
+        self.assertEqual(self.resolve(server), {
+            '1.1': ['1.1.0', '1.1.1'],
+            '1.2': ['1.2.0']
+        })
+        # a study not found is queried one by one
+        self.assertEqual(server.queries, [('STUDY', 2), ('SERIES', 2),
+                                          ('SERIES', 0)])
+
+    def test_capped(self):
+        server = FakeFindServer({'1.1': 2, '1.2': 2}, limit=3)
+        self.assertEqual(self.resolve(server, ['1.1', '1.2']), {
+            '1.1': ['1.1.0', '1.1.1'],
+            '1.2': ['1.2.0', '1.2.1']
+        })
+        self.assertEqual(server.queries, [('STUDY', 2), ('SERIES', 2),
+                                          ('SERIES', 1)])
+
+    def test_predicate(self):
+        server = FakeFindServer({'1.1': 2})
+        self.assertEqual(
+            self.resolve(server, ['1.1'],
+                         predicate=lambda ds: ds.Modality == 'CT'),
+            {'1.1': ['1.1.0']})
+
+    def test_no_series_counts(self):
+        server = FakeFindServer({'1.1': 2, '1.2': 1}, series_counts=False)
+        expected = {'1.1': ['1.1.0', '1.1.1'], '1.2': ['1.2.0']}
+        self.assertEqual(self.resolve(server, ['1.1', '1.2']), expected)
+        self.assertEqual(server.queries, [('STUDY', 2), ('SERIES', 1),
+                                          ('SERIES', 1)])
+        # batching is off for the server from then on
+        server.queries.clear()
+        self.assertEqual(self.resolve(server, ['1.1', '1.2']), expected)
+        self.assertEqual(server.queries, [('SERIES', 1), ('SERIES', 1)])
+
+
+@unittest.skipIf(qr is None, 'config/.salt is required')
+class TestRetrieveMove(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.router = storage_scp.StorageRouter()
+        self.conn_info = qr.ConnectionInformation('localhost', 'PACS', 104,
+                                                  'AUTOQR', 11112)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def store(self, sop_uid, series_uid='1.2.3.1'):
+        ds = Dataset()
+        ds.StudyInstanceUID = '1.2.3'
+        ds.SeriesInstanceUID = series_uid
+        data = create_instance(sop_uid, series_uid)
+        return self.router.handle_store(
+            SimpleNamespace(
+                dataset=ds,
+                encoded_dataset=lambda: data,
+                request=SimpleNamespace(AffectedSOPInstanceUID=sop_uid)))
+
+    def retrieve_move(self, send_c_move, handler=None):
+        assoc = mock.MagicMock()
+        assoc.send_c_move.side_effect = send_c_move
+        acquire = mock.MagicMock()
+        acquire.return_value.__enter__.return_value = assoc
+        with mock.patch.object(
+                qr.storage_scp,
+                'get_server',
+                return_value=SimpleNamespace(
+                    router=self.router)), mock.patch.object(
+                        qr.move_pool, 'acquire', acquire):
+            qr.retrieve_move(create_series()[0],
+                             self.tempdir.name,
+                             self.conn_info,
+                             handler=handler)
+        return assoc.send_c_move.call_args
+
+    def test_retrieve_move(self):
+        def send_c_move(ds, move_aet, model):
+            # the storage SCP receives the instances during C-MOVE
+            pending = Dataset()
+            pending.Status = 0xFF00
+            yield pending, None
+            self.assertEqual(self.store('1.2.3.1.1'),
+                             storage_scp.STATUS_SUCCESS)
+            success = Dataset()
+            success.Status = 0x0000
+            yield success, None
+
+        call = self.retrieve_move(send_c_move)
+        move_ds, move_aet, _ = call[0]
+        self.assertEqual(move_ds.QueryRetrieveLevel, 'SERIES')
+        self.assertEqual(move_ds.SeriesInstanceUID, '1.2.3.1')
+        self.assertEqual(move_aet, 'AUTOQR')
+        self.assertEqual(os.listdir(self.tempdir.name), ['1.2.3.1.1'])
+        # the route is closed after the retrieval
+        self.assertEqual(self.store('1.2.3.1.2'),
+                         storage_scp.STATUS_UNEXPECTED)
+
+    def test_failure(self):
+        def send_c_move(ds, move_aet, model):
+            failure = Dataset()
+            failure.Status = 0xA701
+            yield failure, None
+
+        with self.assertRaises(RuntimeError):
+            self.retrieve_move(send_c_move, handler=lambda event: 0x0000)
+        self.assertEqual(self.store('1.2.3.1.1'),
+                         storage_scp.STATUS_UNEXPECTED)
+
+
+@unittest.skipIf(qr is None, 'config/.salt is required')
+class TestQrAnonymizeSave(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.scratch_dir = settings.SCRATCH_DIR
+        settings.SCRATCH_DIR = self.tempdir.name
+
+    def tearDown(self):
+        settings.SCRATCH_DIR = self.scratch_dir
+        self.tempdir.cleanup()
+
+    def test_submit_failure(self):
+        items = qr.backlog.items
+        with mock.patch.object(qr, 'retrieve'), mock.patch.object(
+                qr.anonymize_pool,
+                'submit',
+                side_effect=RuntimeError('shut down')):
+            with self.assertRaises(RuntimeError):
+                qr.qr_anonymize_save('PID1',
+                                     'AN1',
+                                     '1.2.3',
+                                     str(Path(self.tempdir.name) / 'out'),
+                                     series=create_series())
+        # the slot and the partial directory are released
+        self.assertEqual(qr.backlog.items, items)
+        self.assertEqual(qr.backlog.bytes, 0)
+        self.assertNotIn(qr.partial_root() / '1.2.3', qr.partial_in_use)
+
+    def submitted_function(self, series):
+        future = Future()
+        future.set_result([])
+        with mock.patch.object(settings, 'RETRIEVE_METHOD',
+                               'move'), mock.patch.object(
+                                   qr, 'retrieve'), mock.patch.object(
+                                       qr.anonymize_pool,
+                                       'submit',
+                                       return_value=future) as submit:
+            qr.qr_anonymize_save('PID1',
+                                 'AN1',
+                                 '1.2.3',
+                                 str(Path(self.tempdir.name) / 'out'),
+                                 series=series,
+                                 expected_bytes=100)
+        return submit.call_args[0][0]
+
+    def test_memory_staging(self):
+        self.assertIs(self.submitted_function(create_series()),
+                      qr.anonymize.anonymize_study_memory)
+        # the reservation would underestimate a study of unknown size
+        series = create_series()
+        del series[0].NumberOfSeriesRelatedInstances
+        self.assertIs(self.submitted_function(series),
+                      qr.anonymize.anonymize_study_dir)
+        self.assertEqual(qr.memory_budget.bytes, 0)
+        self.assertEqual(qr.backlog.bytes, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -86,3 +86,17 @@ class TestScheduledEvent(unittest.TestCase):
             self.assertTrue(se.event.is_set())
             se.stop()
             self.assertFalse(se.event.is_set())
+
+    def test_condition(self):
+        se = ScheduledEvent([('0600', '0800')])
+        ok = [False]
+        se.add_condition(lambda: ok[0])
+        with freezegun.freeze_time('2020-1-1 7:00:00'):
+            se.start()
+            self.assertFalse(se.event.is_set())
+            ok[0] = True
+            se.update()
+            self.assertTrue(se.event.is_set())
+            ok[0] = False
+            se.update()
+            self.assertFalse(se.event.is_set())
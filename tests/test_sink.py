@@ -0,0 +1,110 @@
+import io
+import os
+import unittest
+import tempfile
+import tarfile
+import zipfile
+import importlib.util
+from pathlib import Path
+import sink
+
+CONTENTS = [('IMG0.dcm', b'\x00' * 100000), ('IMG1.dcm', os.urandom(1000))]
+
+
+def read_output(filename):
+    if os.path.isdir(filename):
+        return [(fn, (Path(filename) / fn).read_bytes())
+                for fn in sorted(os.listdir(filename))]
+    if filename.endswith('.zip'):
+        with zipfile.ZipFile(filename) as zf:
+            return [(fn, zf.read(fn)) for fn in zf.namelist()]
+    if filename.endswith('.tar.zst'):
+        import zstandard
+        with open(filename, 'rb') as f:
+            data = zstandard.ZstdDecompressor().stream_reader(f).read()
+        fileobj = io.BytesIO(data)
+    else:
+        fileobj = open(filename, 'rb')
+    with tarfile.open(fileobj=fileobj) as tf:
+        return [(info.name, tf.extractfile(info).read()) for info in tf]
+
+
+class TestSink(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestSink, self).__init__(*args, **kwargs)
+
+    def formats(self):
+        for name, cls in sink.SINKS.items():
+            if name == 'tar_zst' and importlib.util.find_spec(
+                    'zstandard') is None:
+                continue
+            yield cls
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for cls in self.formats():
+                for workers in [1, 2]:
+                    filename = os.path.join(
+                        tempdir, 'save{}{}'.format(workers, cls.extension))
+                    cls(filename, workers).save(CONTENTS)
+                    self.assertEqual(read_output(filename), CONTENTS)
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for cls in self.formats():
+                filename = os.path.join(tempdir, 'write' + cls.extension)
+                output = cls(filename)
+                for name, content in CONTENTS:
+                    output.write(name, content)
+                output.close()
+                self.assertEqual(read_output(filename), CONTENTS)
+
+    def test_abort(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for cls in self.formats():
+                filename = os.path.join(tempdir, 'abort' + cls.extension)
+                output = cls(filename)
+                output.write(*CONTENTS[0])
+                output.abort()
+                self.assertFalse(os.path.exists(filename))
+
+    def test_part_file(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for cls in self.formats():
+                filename = os.path.join(tempdir, 'part' + cls.extension)
+                output = cls(filename)
+                output.write(*CONTENTS[0])
+                # an interrupted output is left with the part suffix
+                self.assertFalse(os.path.exists(filename))
+                self.assertFalse(sink.output_exists(tempdir))
+                output.write(*CONTENTS[1])
+                output.close()
+                self.assertEqual(read_output(filename), CONTENTS)
+                self.assertFalse(
+                    os.path.exists(filename + sink.PART_SUFFIX))
+                sink.remove_output(filename)
+
+    def test_remove_output(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for cls in self.formats():
+                filename = os.path.join(tempdir, 'remove' + cls.extension)
+                cls(filename).write(*CONTENTS[0])
+                sink.remove_output(filename)
+                self.assertEqual(os.listdir(tempdir), [])
+
+    def test_output_exists(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            tempdir = Path(tempdir)
+            self.assertFalse(sink.output_exists(tempdir / 'missing'))
+            self.assertFalse(sink.output_exists(tempdir))
+            (tempdir / 'note.txt').write_text('')
+            self.assertFalse(sink.output_exists(tempdir))
+            for cls in self.formats():
+                with tempfile.TemporaryDirectory() as outdir:
+                    cls(Path(outdir) / ('1.2.3' + cls.extension)).save(
+                        CONTENTS)
+                    self.assertTrue(sink.output_exists(outdir))
+
+
+if __name__ == "__main__":
+    unittest.main()
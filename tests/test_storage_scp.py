@@ -0,0 +1,96 @@
+import unittest
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+from pydicom.dataset import Dataset
+import storage_scp
+
+
+def create_event(sop_uid, series_uid='1.2.3.1', study_uid='1.2.3'):
+    '''
+    Return a C-STORE event with the attributes used by the router
+    '''
+    ds = Dataset()
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.SOPInstanceUID = sop_uid
+    return SimpleNamespace(
+        dataset=ds,
+        encoded_dataset=lambda: sop_uid.encode('ascii'),
+        request=SimpleNamespace(AffectedSOPInstanceUID=sop_uid))
+
+
+class TestStorageRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = storage_scp.StorageRouter()
+        self.received = []
+
+    def handler(self, name):
+        def handle_store(event):
+            self.received.append(
+                (name, event.request.AffectedSOPInstanceUID))
+            return storage_scp.STATUS_SUCCESS
+
+        return handle_store
+
+    def test_route(self):
+        self.router.register('1.2.3.1', self.handler('series'))
+        self.router.register('1.2.4', self.handler('study'))
+        for event in [
+                create_event('1.2.3.1.1'),
+                create_event('1.2.4.1.1', '1.2.4.1', '1.2.4'),
+                create_event('1.2.3.2.1', '1.2.3.2')
+        ]:
+            self.router.handle_store(event)
+        self.assertEqual(self.received, [('series', '1.2.3.1.1'),
+                                         ('study', '1.2.4.1.1')])
+
+    def test_series_first(self):
+        self.router.register('1.2.3', self.handler('study'))
+        self.router.register('1.2.3.1', self.handler('series'))
+        self.router.handle_store(create_event('1.2.3.1.1'))
+        self.router.handle_store(create_event('1.2.3.2.1', '1.2.3.2'))
+        self.assertEqual(self.received, [('series', '1.2.3.1.1'),
+                                         ('study', '1.2.3.2.1')])
+
+    def test_unknown(self):
+        self.assertEqual(self.router.handle_store(create_event('1.2.3.1.1')),
+                         storage_scp.STATUS_UNEXPECTED)
+        self.assertEqual(self.received, [])
+
+    def test_unregister(self):
+        with self.router.route(['1.2.3.1', '1.2.3.2'], self.handler('route')):
+            self.assertEqual(
+                self.router.handle_store(create_event('1.2.3.1.1')),
+                storage_scp.STATUS_SUCCESS)
+        # instances arriving after the retrieval are not accepted
+        self.assertEqual(self.router.handle_store(create_event('1.2.3.1.2')),
+                         storage_scp.STATUS_UNEXPECTED)
+        self.router.register('1.2.3.1', self.handler('series'))
+        self.router.unregister('1.2.3.1')
+        self.router.unregister('1.2.3.9')
+        self.assertIsNone(self.router.lookup(create_event('1.2.3.1.3').dataset))
+        self.assertEqual(self.received, [('route', '1.2.3.1.1')])
+
+    def test_unregister_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.router.route(['1.2.3.1'], self.handler('route')):
+                raise RuntimeError('retrieval failed')
+        self.assertIsNone(self.router.lookup(create_event('1.2.3.1.1').dataset))
+
+
+class TestSaveToDirectory(unittest.TestCase):
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            handler = storage_scp.save_to_directory(tempdir)
+            for sop_uid in ['1.2.3.1.1', '1.2.3.1.2']:
+                self.assertEqual(handler(create_event(sop_uid)),
+                                 storage_scp.STATUS_SUCCESS)
+            self.assertEqual(
+                sorted((p.name, p.read_bytes())
+                       for p in Path(tempdir).iterdir()),
+                [('1.2.3.1.1', b'1.2.3.1.1'), ('1.2.3.1.2', b'1.2.3.1.2')])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
 import unittest
 import tempfile
+import time
 from pathlib import Path
 import random
+import threading
 import pandas as pd
 import utils
 
@@ -34,6 +36,147 @@ class TestCsvWriter(unittest.TestCase):
         self.assertTrue(df.equals(df_read))
 
 
+class TestWriteCsv(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestWriteCsv, self).__init__(*args, **kwargs)
+
+    def test_write_csv(self):
+        columns = ['c1', 'c2', 'c3']
+        random_data = [[random.randint(0, 100) for _ in range(3)]
+                       for _ in range(3)]
+        df = pd.DataFrame(random_data, columns=columns)
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = Path(tempdir) / 'test.csv'
+            count = utils.write_csv(filename, columns,
+                                    (row for row in random_data))
+            df_read = pd.read_csv(filename)
+        self.assertEqual(count, len(random_data))
+        self.assertTrue(df.equals(df_read))
+
+    def test_write_csv_empty(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = Path(tempdir) / 'test.csv'
+            count = utils.write_csv(filename, ['c1', 'c2'], [])
+            df_read = pd.read_csv(filename)
+        self.assertEqual(count, 0)
+        self.assertEqual(list(df_read.columns), ['c1', 'c2'])
+
+
+class TestOrderedMap(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestOrderedMap, self).__init__(*args, **kwargs)
+
+    def test_order(self):
+        def f(i):
+            time.sleep(random.random() * 0.01)
+            return i * 2
+
+        result = list(utils.ordered_map(f, range(20), 4))
+        self.assertEqual(result, [i * 2 for i in range(20)])
+
+    def test_close(self):
+        calls = []
+
+        def f(i):
+            calls.append(i)
+            return i
+
+        generator = utils.ordered_map(f, range(100), 2, prefetch=2)
+        self.assertEqual(next(generator), 0)
+        generator.close()
+        self.assertLess(len(calls), 100)
+
+    def test_exception(self):
+        def f(i):
+            if i == 3:
+                raise RuntimeError('Test ordered_map')
+            return i
+
+        with self.assertRaises(RuntimeError):
+            list(utils.ordered_map(f, range(10), 2))
+
+
+class TestBalancedSplit(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestBalancedSplit, self).__init__(*args, **kwargs)
+
+    def test_balanced_split(self):
+        items = [1000, 300, 300, 200, 100, 100, 50]
+        groups = utils.balanced_split(items, 2, lambda x: x)
+        self.assertEqual(sorted(sum(groups, [])), sorted(items))
+        self.assertEqual(sorted(sum(g) for g in groups), [1000, 1050])
+
+        # fewer items than groups
+        groups = utils.balanced_split([1, 2], 4, lambda x: x)
+        self.assertEqual(sorted(groups), [[1], [2]])
+        self.assertEqual(utils.balanced_split([], 4, lambda x: x), [])
+
+
+class TestBacklog(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestBacklog, self).__init__(*args, **kwargs)
+
+    def acquire_in_thread(self, backlog):
+        acquired = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (backlog.acquire(), acquired.set()))
+        thread.start()
+        return thread, acquired
+
+    def test_max_items(self):
+        backlog = utils.Backlog(max_items=2)
+        backlog.acquire()
+        backlog.acquire()
+        thread, acquired = self.acquire_in_thread(backlog)
+        self.assertFalse(acquired.wait(0.1))
+        backlog.release()
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+        self.assertEqual(backlog.items, 2)
+
+    def test_max_bytes(self):
+        backlog = utils.Backlog(max_bytes=100)
+        backlog.acquire()
+        backlog.add_bytes(100)
+        thread, acquired = self.acquire_in_thread(backlog)
+        self.assertFalse(acquired.wait(0.1))
+        backlog.release(100)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+        self.assertEqual((backlog.items, backlog.bytes), (1, 0))
+
+    def test_try_acquire(self):
+        backlog = utils.Backlog(max_bytes=100)
+        self.assertTrue(backlog.try_acquire(60))
+        self.assertFalse(backlog.try_acquire(50))
+        self.assertTrue(backlog.try_acquire(40))
+        backlog.release(60)
+        self.assertTrue(backlog.try_acquire(50))
+        self.assertEqual((backlog.items, backlog.bytes), (2, 90))
+
+    def test_try_add_bytes(self):
+        backlog = utils.Backlog(max_bytes=100)
+        self.assertTrue(backlog.try_acquire(60))
+        self.assertTrue(backlog.try_add_bytes(40))
+        self.assertFalse(backlog.try_add_bytes(1))
+        self.assertEqual((backlog.items, backlog.bytes), (1, 100))
+
+    def test_no_limit(self):
+        backlog = utils.Backlog()
+        for _ in range(10):
+            backlog.acquire()
+            backlog.add_bytes(2**20)
+        self.assertEqual(backlog.status(), '10 pending, 10.0 MB')
+
+    def test_directory_size(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            tempdir = Path(tempdir)
+            (tempdir / 'a').write_bytes(b'0' * 10)
+            (tempdir / 'b').write_bytes(b'0' * 5)
+            (tempdir / 'sub').mkdir()
+            self.assertEqual(utils.directory_size(tempdir), 15)
+
+
 class TestLocker(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super(TestLocker, self).__init__(*args, **kwargs)
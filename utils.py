@@ -1,5 +1,10 @@
-from threading import Lock
+import os
+import sys
+import csv
+from collections import deque
+from threading import Lock, Condition
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 
 def swallow_exceptions(exception_logger=None):
@@ -63,6 +68,162 @@ class CsvWriter:
                 file.write('\n')
 
 
+def write_csv(filename, header, rows):
+    '''
+    Write rows to a CSV file as they are generated.
+
+    Args:
+        filename: filename. Specify '-' to use stdout.
+        header (list): Column names
+        rows (iterable): Iterable object that returns a list for each row
+    Returns:
+        Number of written rows
+    '''
+    if filename == '-':
+        file = sys.stdout
+        writer = csv.writer(file, lineterminator='\n')
+    else:
+        file = open(filename, 'w', newline='', encoding='utf8')
+        writer = csv.writer(file, lineterminator=os.linesep)
+    count = 0
+    try:
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    finally:
+        if file is not sys.stdout:
+            file.close()
+    return count
+
+
+def ordered_map(f, iterable, max_workers, prefetch=None):
+    '''
+    Map f over iterable with threads and yield the results in the input order.
+    Pending calls are cancelled when the generator is closed.
+
+    Args:
+        max_workers (int): Number of threads
+        prefetch (int): Maximum number of results computed ahead of the consumer. Default: 2 * max_workers
+    '''
+    prefetch = prefetch or 2 * max_workers
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = deque()
+    try:
+        for item in iterable:
+            futures.append(executor.submit(f, item))
+            if len(futures) >= prefetch:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+
+
+def balanced_split(items, n, weight):
+    '''
+    Split items into at most n non-empty groups with balanced total weight.
+    Heaviest items are assigned first to the lightest group (LPT).
+
+    Args:
+        weight (callable): Function that returns the weight of an item.
+    '''
+    n = max(1, min(n, len(items)))
+    groups = [[] for _ in range(n)]
+    totals = [0] * n
+    for item in sorted(items, key=weight, reverse=True):
+        i = totals.index(min(totals))
+        groups[i].append(item)
+        totals[i] += weight(item)
+    return [g for g in groups if g]
+
+
+def directory_size(dirname):
+    '''
+    Total size of the files directly under dirname in bytes
+    '''
+    with os.scandir(dirname) as it:
+        return sum(entry.stat().st_size for entry in it if entry.is_file())
+
+
+class Backlog:
+    '''
+    Num and bytes of pending items with limits.
+    acquire() blocks while the backlog is full. 0 for no limit.
+
+    Args:
+        max_items (int): Maximum num of pending items
+        max_bytes (int): acquire() blocks while the pending bytes are at or over this
+    '''
+    def __init__(self, max_items=0, max_bytes=0):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = 0
+        self.bytes = 0
+        self.cond = Condition()
+
+    def _is_full(self):
+        return (self.max_items > 0 and self.items >= self.max_items) or (
+            self.max_bytes > 0 and self.bytes >= self.max_bytes)
+
+    def acquire(self, logger=None):
+        '''
+        Wait for a room and add an item with 0 bytes
+        '''
+        with self.cond:
+            if self._is_full() and logger is not None:
+                logger.info('Backlog is full (%s). Waiting', self.status())
+            self.cond.wait_for(lambda: not self._is_full())
+            self.items += 1
+
+    def try_acquire(self, n_bytes):
+        '''
+        Add an item with n_bytes if it fits in the limits without waiting
+
+        Returns:
+            bool: True if the item is added
+        '''
+        with self.cond:
+            if (self.max_items > 0 and self.items >= self.max_items) or (
+                    self.max_bytes > 0
+                    and self.bytes + n_bytes > self.max_bytes):
+                return False
+            self.items += 1
+            self.bytes += n_bytes
+            return True
+
+    def try_add_bytes(self, n_bytes):
+        '''
+        Add n_bytes to the pending bytes if they fit in max_bytes without waiting
+
+        Returns:
+            bool: True if the bytes are added
+        '''
+        with self.cond:
+            if self.max_bytes > 0 and self.bytes + n_bytes > self.max_bytes:
+                return False
+            self.bytes += n_bytes
+            return True
+
+    def add_bytes(self, n_bytes):
+        with self.cond:
+            self.bytes += n_bytes
+
+    def release(self, n_bytes=0):
+        '''
+        Remove an item with n_bytes
+        '''
+        with self.cond:
+            self.items -= 1
+            self.bytes -= n_bytes
+            self.cond.notify_all()
+
+    def status(self):
+        return '{} pending, {:.1f} MB'.format(self.items, self.bytes / 2**20)
+
+
 class Locker:
     def __init__(self):
         self.lock_obj = Lock()